@@ -2,11 +2,17 @@
 from __future__ import annotations
 
 import argparse
+import glob
 import json
 import math
+import re
 import shutil
+import statistics
 import subprocess
 from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
 
 
 @dataclass(frozen=True)
@@ -14,6 +20,7 @@ class Setup:
     name: str
     gpu_name: str
     num_gpus: int
+    # Prior only: used to scale a measured GPU to one without step profiles.
     single_gpu_speed_factor_vs_3090: float
     min_disk_gb: int
 
@@ -40,8 +47,43 @@ def parse_args() -> argparse.Namespace:
         description="Estimate Stage 3 wall-clock and cost across Vast setups."
     )
     p.add_argument("--steps", type=int, default=1200)
-    p.add_argument("--causal-sec-per-step", type=float, default=3.318)
-    p.add_argument("--bidir-sec-per-step", type=float, default=3.908)
+    p.add_argument(
+        "--profiles",
+        nargs="*",
+        default=[],
+        help="Step-profile JSONL files or globs written by prefill-finetune --profile-jsonl.",
+    )
+    p.add_argument("--causal-mode", default="causal", help="Profile attention_mode of the causal run.")
+    p.add_argument("--bidir-mode", default="prefix_lm", help="Profile attention_mode of the ablated run.")
+    p.add_argument(
+        "--seq-len",
+        type=float,
+        default=None,
+        help="Mean padded row length of the planned run. Defaults to the profiled median, else 1024.",
+    )
+    p.add_argument("--micro-batch-size", type=int, default=1)
+    p.add_argument(
+        "--grad-accum",
+        type=int,
+        default=16,
+        help="Micro-batches per optimizer step on one GPU; split across GPUs at constant effective batch.",
+    )
+    p.add_argument("--warmup-steps", type=int, default=2, help="Profile records skipped at the start of each run.")
+    p.add_argument("--confidence", type=float, default=0.90)
+    p.add_argument(
+        "--prior-rel-error",
+        type=float,
+        default=0.25,
+        help="Relative error assumed wherever a prior constant replaces a measurement.",
+    )
+    p.add_argument(
+        "--gpu-alias",
+        action="append",
+        default=[],
+        help="VAST_GPU=substring of torch.cuda.get_device_name(), e.g. 'H100_SXM=H100 80GB HBM3'.",
+    )
+    p.add_argument("--causal-sec-per-step", type=float, default=3.318, help="Used only without profiles (1x 3090).")
+    p.add_argument("--bidir-sec-per-step", type=float, default=3.908, help="Used only without profiles (1x 3090).")
     p.add_argument(
         "--startup-minutes",
         type=float,
@@ -67,6 +109,7 @@ def parse_args() -> argparse.Namespace:
 
 
 def parallel_efficiency(num_gpus: int) -> float:
+    # Prior for GPU counts that have no multi-GPU profiles.
     # Constant-effective-batch assumption:
     # reduce grad accumulation as GPUs increase.
     if num_gpus <= 1:
@@ -84,6 +127,239 @@ def speedup_vs_3090(setup: Setup) -> float:
     return setup.single_gpu_speed_factor_vs_3090 * setup.num_gpus * parallel_efficiency(setup.num_gpus)
 
 
+def _norm(name: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+def gpu_matches(vast_gpu: str, device_name: str, aliases: dict[str, str]) -> bool:
+    return _norm(aliases.get(vast_gpu, vast_gpu)) in _norm(device_name)
+
+
+def load_profile_records(patterns: list[str], warmup_steps: int) -> list[dict]:
+    """Profile records minus the first `warmup_steps` of every run (a step counter reset starts a run)."""
+    records: list[dict] = []
+    paths = sorted({path for pattern in patterns for path in (glob.glob(pattern) or [pattern])})
+    for path in paths:
+        since_start = 0
+        last_step = None
+        for line in Path(path).read_text().splitlines():
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if last_step is None or record["step"] <= last_step:
+                since_start = 0
+            last_step = record["step"]
+            since_start += 1
+            if since_start > warmup_steps and record.get("micro_batches", 0) > 0:
+                records.append(record)
+    return records
+
+
+def _varies(values: np.ndarray) -> bool:
+    return values.size > 1 and float(values.std()) > 0.02 * max(float(abs(values.mean())), 1e-12)
+
+
+def _nonneg_lstsq(x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Least squares with negative coefficients dropped and refit; returns (coef, covariance)."""
+    active = list(range(x.shape[1]))
+    while True:
+        xa = x[:, active]
+        coef_a, *_ = np.linalg.lstsq(xa, y, rcond=None)
+        if (coef_a >= 0).all() or len(active) == 1:
+            break
+        active.pop(int(np.argmin(coef_a)))
+    residual = y - xa @ coef_a
+    dof = max(len(y) - len(active), 1)
+    sigma2 = float(residual @ residual) / dof
+    cov_a = sigma2 * np.linalg.pinv(xa.T @ xa)
+    coef = np.zeros(x.shape[1])
+    cov = np.zeros((x.shape[1], x.shape[1]))
+    coef[active] = np.clip(coef_a, 0.0, None)
+    cov[np.ix_(active, active)] = cov_a
+    return coef, cov
+
+
+@dataclass
+class ThroughputFit:
+    """Step time of one (GPU, attention mode) as fixed per-step cost + per-micro-batch work.
+
+    Per micro-batch: c0 + c1 * kilo-tokens + c2 * kilo-tokens * seq_len / 1e3 (the
+    attention term), using only the terms the profiles actually vary; with a single
+    tokens-per-micro-batch value the work is taken as proportional to tokens. Per
+    step: optimizer + other time, plus a (n - 1) / n all-reduce term when profiles
+    span several GPU counts.
+    """
+
+    gpu_name: str
+    attention_mode: str
+    n: int
+    micro_terms: list[str]
+    micro_coef: np.ndarray
+    micro_cov: np.ndarray
+    fixed_terms: list[str]
+    fixed_coef: np.ndarray
+    fixed_cov: np.ndarray
+    step_sigma: float
+    median_seq_len: float
+    world_sizes: list[int]
+    r2: float
+
+    def _micro_x(self, tokens: float, seq_len: float) -> np.ndarray:
+        values = {"intercept": 1.0, "ktokens": tokens / 1e3, "ktokens_x_seq": tokens * seq_len / 1e6}
+        return np.array([values[t] for t in self.micro_terms])
+
+    def _fixed_x(self, num_gpus: int) -> np.ndarray:
+        values = {"intercept": 1.0, "allreduce": (num_gpus - 1) / num_gpus}
+        return np.array([values[t] for t in self.fixed_terms])
+
+    def predict_step(self, *, micro_batches: int, micro_batch_size: int, seq_len: float, num_gpus: int):
+        """Mean step time and its standard error for the given per-GPU micro-batch count."""
+        xm = self._micro_x(micro_batch_size * seq_len, seq_len)
+        xf = self._fixed_x(num_gpus)
+        mean = micro_batches * float(xm @ self.micro_coef) + float(xf @ self.fixed_coef)
+        var = micro_batches**2 * float(xm @ self.micro_cov @ xm) + float(xf @ self.fixed_cov @ xf)
+        return mean, math.sqrt(max(var, 0.0))
+
+
+def fit_throughput(gpu_name: str, attention_mode: str, records: list[dict]) -> ThroughputFit:
+    micro = np.array([r["micro_batches"] for r in records], dtype=float)
+    rows = np.array([max(r["rows"], 1) for r in records], dtype=float)
+    padded = np.array([r["padded_tokens"] for r in records], dtype=float)
+    step = np.array([r["step_s"] for r in records], dtype=float)
+    fixed = np.array([r["optimizer_s"] + r["other_s"] for r in records], dtype=float)
+    world = np.array([r.get("world_size", 1) for r in records], dtype=float)
+    tokens = padded / micro
+    seq = padded / rows
+    per_micro = (step - fixed) / micro
+
+    columns = {"intercept": np.ones_like(tokens), "ktokens": tokens / 1e3, "ktokens_x_seq": tokens * seq / 1e6}
+    if not _varies(tokens):
+        micro_terms = ["ktokens"]
+    elif not _varies(seq):
+        micro_terms = ["intercept", "ktokens"]
+    else:
+        micro_terms = ["intercept", "ktokens", "ktokens_x_seq"]
+    micro_x = np.stack([columns[t] for t in micro_terms], axis=1)
+    micro_coef, micro_cov = _nonneg_lstsq(micro_x, per_micro)
+
+    fixed_terms = ["intercept"] + (["allreduce"] if _varies(world) else [])
+    fixed_columns = {"intercept": np.ones_like(world), "allreduce": (world - 1) / world}
+    fixed_x = np.stack([fixed_columns[t] for t in fixed_terms], axis=1)
+    fixed_coef, fixed_cov = _nonneg_lstsq(fixed_x, fixed)
+
+    fit = ThroughputFit(
+        gpu_name=gpu_name,
+        attention_mode=attention_mode,
+        n=len(records),
+        micro_terms=micro_terms,
+        micro_coef=micro_coef,
+        micro_cov=micro_cov,
+        fixed_terms=fixed_terms,
+        fixed_coef=fixed_coef,
+        fixed_cov=fixed_cov,
+        step_sigma=0.0,
+        median_seq_len=float(np.median(seq)),
+        world_sizes=sorted({int(w) for w in world}),
+        r2=0.0,
+    )
+    predicted = micro * (micro_x @ micro_coef) + fixed_x @ fixed_coef
+    residual = step - predicted
+    fit.step_sigma = float(residual.std(ddof=min(len(step) - 1, 1))) if len(step) > 1 else 0.0
+    total = float(((step - step.mean()) ** 2).sum())
+    fit.r2 = 1.0 - float((residual**2).sum()) / total if total > 0 else 1.0
+    return fit
+
+
+def fit_profiles(records: list[dict]) -> dict[tuple[str, str], ThroughputFit]:
+    groups: dict[tuple[str, str], list[dict]] = {}
+    for record in records:
+        groups.setdefault((record.get("gpu_name", "unknown"), record["attention_mode"]), []).append(record)
+    return {key: fit_throughput(key[0], key[1], group) for key, group in groups.items()}
+
+
+@dataclass
+class Estimate:
+    hours: float
+    low: float
+    high: float
+    source: str
+
+
+def estimate_hours(
+    setup: Setup,
+    mode: str,
+    fits: dict[tuple[str, str], ThroughputFit],
+    args: argparse.Namespace,
+    aliases: dict[str, str],
+    z: float,
+) -> Estimate | None:
+    """Run time of `args.steps` steps plus startup, with a `z`-sigma band."""
+    mode_fits = [fit for (gpu, m), fit in fits.items() if m == mode]
+    if not mode_fits:
+        return None
+    own = [fit for fit in mode_fits if gpu_matches(setup.gpu_name, fit.gpu_name, aliases)]
+    scale, scale_err, source = 1.0, 0.0, "fit"
+    if own:
+        fit = own[0]
+    else:
+        # Borrow a measured GPU and scale by the prior speed factors.
+        reference = None
+        for candidate in mode_fits:
+            for preset in PRESETS:
+                if gpu_matches(preset.gpu_name, candidate.gpu_name, aliases):
+                    reference = (candidate, preset)
+                    break
+            if reference:
+                break
+        if reference is None:
+            return None
+        fit, ref_setup = reference
+        scale = ref_setup.single_gpu_speed_factor_vs_3090 / setup.single_gpu_speed_factor_vs_3090
+        scale_err = args.prior_rel_error
+        source = f"prior x {ref_setup.gpu_name}"
+
+    seq_len = args.seq_len or fit.median_seq_len
+    micro_batches = math.ceil(args.grad_accum / setup.num_gpus)
+    step_s, step_se = fit.predict_step(
+        micro_batches=micro_batches,
+        micro_batch_size=args.micro_batch_size,
+        seq_len=seq_len,
+        num_gpus=setup.num_gpus,
+    )
+    if setup.num_gpus > 1 and max(fit.world_sizes) == 1:
+        # No multi-GPU profiles: the all-reduce cost comes from the prior efficiency table.
+        efficiency = parallel_efficiency(setup.num_gpus)
+        step_s /= efficiency
+        step_se /= efficiency
+        scale_err = math.hypot(scale_err, args.prior_rel_error * (1.0 - efficiency))
+        source += "+prior scaling"
+
+    train_s = args.steps * step_s * scale
+    # Model uncertainty moves every step together; step noise averages out over the run.
+    train_se = math.sqrt(
+        (args.steps * step_se * scale) ** 2
+        + args.steps * (fit.step_sigma * scale) ** 2
+        + (train_s * scale_err) ** 2
+    )
+    startup_h = args.startup_minutes / 60.0
+    hours = startup_h + train_s / 3600.0
+    return Estimate(
+        hours=hours,
+        low=max(startup_h, hours - z * train_se / 3600.0),
+        high=hours + z * train_se / 3600.0,
+        source=source,
+    )
+
+
+def legacy_estimate(setup: Setup, sec_per_step: float, args: argparse.Namespace, z: float) -> Estimate:
+    sp = speedup_vs_3090(setup)
+    startup_h = args.startup_minutes / 60.0
+    train_h = (args.steps * sec_per_step) / (3600.0 * sp)
+    band = z * args.prior_rel_error * train_h
+    return Estimate(startup_h + train_h, startup_h + max(train_h - band, 0.0), startup_h + train_h + band, "prior")
+
+
 def find_cheapest_offer(setup: Setup, reliability_min: float, inet_down_min: float) -> Offer:
     if shutil.which("vastai") is None:
         return Offer(None, None, None)
@@ -118,15 +394,42 @@ def fmt(x: float | None, nd: int = 2) -> str:
     return f"{x:.{nd}f}"
 
 
+def fmt_band(estimate: Estimate | None, scale: float = 1.0) -> str:
+    if estimate is None:
+        return "-"
+    return f"{estimate.hours * scale:.2f} [{estimate.low * scale:.2f}-{estimate.high * scale:.2f}]"
+
+
 def main() -> None:
     args = parse_args()
+    aliases = dict(item.split("=", 1) for item in args.gpu_alias)
+    z = statistics.NormalDist().inv_cdf(0.5 + args.confidence / 2)
+
+    records = load_profile_records(args.profiles, args.warmup_steps) if args.profiles else []
+    fits = fit_profiles(records) if records else {}
 
     print("Assumption: constant effective batch across GPU counts (adjust grad accumulation with N GPUs).")
-    print("Modeling: runtime ~= startup + (measured_train_time / speedup).\n")
+    if fits:
+        print(
+            f"Modeling: per (GPU, attention mode) fit of step time on {len(records)} profiled steps; "
+            f"runtime ~= startup + steps * predicted step time. Bands: {args.confidence:.0%}.\n"
+        )
+        print("gpu | mode | steps | seq_len | micro terms (s) | fixed terms (s) | step_sigma | r2")
+        print(" | ".join(["---"] * 8))
+        for fit in fits.values():
+            micro = ", ".join(f"{t}={c:.4g}" for t, c in zip(fit.micro_terms, fit.micro_coef))
+            fixed = ", ".join(f"{t}={c:.4g}" for t, c in zip(fit.fixed_terms, fit.fixed_coef))
+            print(
+                f"{fit.gpu_name} | {fit.attention_mode} | {fit.n} | {fit.median_seq_len:.0f} | {micro} | {fixed} | "
+                f"{fit.step_sigma:.3f} | {fit.r2:.3f}"
+            )
+        print()
+    else:
+        print("Modeling: runtime ~= startup + (measured_train_time / speedup) from prior speed factors.\n")
 
     headers = [
         "setup",
-        "speedup",
+        "source",
         "causal_h",
         "bidir_h",
         "pair_parallel_h",
@@ -138,36 +441,48 @@ def main() -> None:
     print(" | ".join(["---"] * len(headers)))
 
     for setup in PRESETS:
-        sp = speedup_vs_3090(setup)
-        causal_h = args.startup_minutes / 60.0 + (args.steps * args.causal_sec_per_step) / (3600.0 * sp)
-        bidir_h = args.startup_minutes / 60.0 + (args.steps * args.bidir_sec_per_step) / (3600.0 * sp)
-        pair_parallel_h = max(causal_h, bidir_h)
+        if fits:
+            causal = estimate_hours(setup, args.causal_mode, fits, args, aliases, z)
+            bidir = estimate_hours(setup, args.bidir_mode, fits, args, aliases, z)
+        else:
+            causal = legacy_estimate(setup, args.causal_sec_per_step, args, z)
+            bidir = legacy_estimate(setup, args.bidir_sec_per_step, args, z)
+
+        pair_parallel = None
+        if causal is not None and bidir is not None:
+            pair_parallel = Estimate(
+                max(causal.hours, bidir.hours), max(causal.low, bidir.low), max(causal.high, bidir.high), ""
+            )
 
         offer = Offer(None, None, None)
         if not args.no_live_offers:
             offer = find_cheapest_offer(setup, args.reliability_min, args.inet_down_min)
 
         pair_parallel_cost = None
-        if offer.dph_total is not None:
+        if offer.dph_total is not None and causal is not None and bidir is not None:
             # Two simultaneous runs (3A + 3B), same setup type.
-            pair_parallel_cost = offer.dph_total * (causal_h + bidir_h)
+            pair_parallel_cost = Estimate(
+                causal.hours + bidir.hours, causal.low + bidir.low, causal.high + bidir.high, ""
+            )
 
+        sources = {e.source for e in (causal, bidir) if e is not None}
         row = [
             setup.name,
-            fmt(sp, 2),
-            fmt(causal_h, 2),
-            fmt(bidir_h, 2),
-            fmt(pair_parallel_h, 2),
+            "/".join(sorted(sources)) if sources else "no profile",
+            fmt_band(causal),
+            fmt_band(bidir),
+            fmt_band(pair_parallel),
             str(offer.offer_id) if offer.offer_id is not None else "-",
             fmt(offer.dph_total, 2),
-            fmt(pair_parallel_cost, 2),
+            fmt_band(pair_parallel_cost, offer.dph_total) if pair_parallel_cost is not None else "-",
         ]
         print(" | ".join(row))
 
     print("\nNotes:")
     print("- Pair metrics assume 3A and 3B run on separate instances in parallel.")
     print("- Costs use cheapest currently visible offer; availability can change quickly.")
-    print("- For fixed hyperparameters across GPU counts, throughput scaling can be worse than shown.")
+    print("- Bands combine fit uncertainty, step noise and --prior-rel-error wherever a prior constant is used.")
+    print("- Profile more setups (prefill-finetune --profile-jsonl) to replace prior rows with fits.")
 
 
 if __name__ == "__main__":
@@ -22,7 +22,7 @@ echo "Local checkpoint dir: ${LOCAL_CHECKPOINT_DIR}"
 echo "Output dir: ${OUTPUT_DIR}"
 
 # Download checkpoint from HuggingFace if not already present
-if [ ! -f "${LOCAL_CHECKPOINT_DIR}/pytorch_model.bin" ]; then
+if [ ! -f "${LOCAL_CHECKPOINT_DIR}/checkpoint_meta.json" ]; then
     echo "Downloading checkpoint from HuggingFace..."
     mkdir -p "${LOCAL_CHECKPOINT_DIR}"
     # Use huggingface-hub CLI to download the subfolder
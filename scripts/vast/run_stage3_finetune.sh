@@ -8,10 +8,14 @@ MAX_STEPS="${MAX_STEPS:-1200}"
 TRAIN_SAMPLES="${TRAIN_SAMPLES:-50000}"
 EVAL_SAMPLES="${EVAL_SAMPLES:-250}"
 EVAL_STEPS="${EVAL_STEPS:-200}"
-# Default to no intermediate checkpoint save during training loop.
-# This model class can fail in Trainer.save_pretrained on step-saves; final save is handled separately.
-SAVE_STEPS="${SAVE_STEPS:-$((MAX_STEPS + 1))}"
+# Raw checkpoints are written in the background every SAVE_STEPS steps (0 disables).
+# After a preemption, rerun with RUN_DIR=<previous run dir> RESUME=1 to continue from the latest one.
+SAVE_STEPS="${SAVE_STEPS:-200}"
+RESUME="${RESUME:-0}"
 GRAD_ACCUM="${GRAD_ACCUM:-16}"
+# PROFILE=1 writes per-step timings for scripts/local/estimate_vast_plan.py --profiles. Off by default:
+# the per-phase CUDA syncs slow the run a little, so profile a short calibration run instead.
+PROFILE="${PROFILE:-0}"
 LR="${LR:-2e-5}"
 LR_SCHEDULER="${LR_SCHEDULER:-cosine}"
 WARMUP_RATIO="${WARMUP_RATIO:-0.03}"
@@ -36,8 +40,14 @@ case "$MODE" in
 esac
 
 TS="$(date +%Y%m%d-%H%M%S)"
-RUN_DIR="runs/${STAGE_NAME}/${TS}"
+RUN_DIR="${RUN_DIR:-runs/${STAGE_NAME}/${TS}}"
 mkdir -p "$RUN_DIR"
+if [ "$RESUME" = "1" ]; then
+  EXTRA_FLAGS+=(--resume)
+fi
+if [ "$PROFILE" = "1" ]; then
+  EXTRA_FLAGS+=(--profile-jsonl "$RUN_DIR/profile.jsonl")
+fi
 
 echo "[$STAGE_NAME] model=$MODEL_ID dataset=$DATASET_ID max_steps=$MAX_STEPS"
 echo "[$STAGE_NAME] lr=$LR scheduler=$LR_SCHEDULER warmup_ratio=$WARMUP_RATIO"
@@ -61,6 +71,6 @@ uv run prefill-finetune \
   --hf-repo-id "$HF_REPO_ID" \
   --gradient-checkpointing \
   "${EXTRA_FLAGS[@]}" \
-  2>&1 | tee "$RUN_DIR/log.txt"
+  2>&1 | tee -a "$RUN_DIR/log.txt"
 
 echo "[$STAGE_NAME] summary: $RUN_DIR/summary.json"
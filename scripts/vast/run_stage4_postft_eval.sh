@@ -3,6 +3,8 @@ set -euo pipefail
 
 LIMIT="${LIMIT:-500}"
 TASKS="${TASKS:-hellaswag,piqa,arc_easy,arc_challenge,winogrande}"
+# Comma-separated attention modes evaluated from one model load, e.g. causal,prefill_bidirectional.
+ATTENTION_MODES="${ATTENTION_MODES:-prefill_bidirectional}"
 
 if [ "$#" -lt 1 ]; then
   echo "Usage: $0 <checkpoint_path_or_model_id> [more_checkpoints...]"
@@ -15,14 +17,14 @@ for MODEL_PATH in "$@"; do
   RUN_DIR="runs/stage4_postft_eval/${TS}_${SAFE_NAME}"
   mkdir -p "$RUN_DIR"
 
-  echo "[stage4] evaluating $MODEL_PATH"
+  echo "[stage4] evaluating $MODEL_PATH modes=$ATTENTION_MODES"
   uv run prefill-eval \
     --model-id "$MODEL_PATH" \
     --tasks "$TASKS" \
     --limit "$LIMIT" \
     --split validation \
     --length-normalize \
-    --prefill-bidirectional \
+    --attention-modes "$ATTENTION_MODES" \
     --output-json "$RUN_DIR/metrics.json" \
     2>&1 | tee "$RUN_DIR/log.txt"
 
@@ -0,0 +1,214 @@
+"""Background upload of run artifacts (checkpoints, summaries) to a pluggable backend.
+
+`ArtifactSink` uploads finished files (one unit per submitted directory) from a
+worker thread while training goes on. Every unit is retried with backoff, and
+completed uploads are appended to a manifest (`<output_dir>/artifact_manifest.jsonl`),
+so a relaunched run skips files that already left the box. Backends are chosen
+with a spec string:
+
+  local:<dir>        copy into a local directory (offline runs and tests)
+  hub:<repo_id>      upload to a HuggingFace Hub model repo
+
+The local backend copies in chunks through a `.partial` file and resumes an
+interrupted copy from where it stopped; the Hub client chunks large files itself
+and skips content it already stores.
+"""
+from __future__ import annotations
+
+import fnmatch
+import json
+import queue
+import shutil
+import threading
+import time
+from pathlib import Path
+
+
+class ArtifactBackend:
+    name = "base"
+
+    def put_files(self, files: list[tuple[Path, str]], *, message: str) -> None:
+        """Upload `(local_path, remote_path)` pairs as one unit; raise to trigger a retry."""
+        raise NotImplementedError
+
+    def url(self, remote_path: str) -> str:
+        return remote_path
+
+
+class LocalDirBackend(ArtifactBackend):
+    name = "local"
+
+    def __init__(self, root: str | Path, *, chunk_bytes: int = 64 << 20):
+        self.root = Path(root)
+        self.chunk_bytes = chunk_bytes
+
+    def put_files(self, files: list[tuple[Path, str]], *, message: str) -> None:
+        for local_path, remote_path in files:
+            self._copy(local_path, remote_path)
+
+    def _copy(self, local_path: Path, remote_path: str) -> None:
+        target = self.root / remote_path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # The partial name pins the source version, so a rewritten file starts over.
+        stat = local_path.stat()
+        partial = target.with_name(f"{target.name}.{stat.st_size}-{stat.st_mtime_ns}.partial")
+        done = partial.stat().st_size if partial.exists() else 0
+        with local_path.open("rb") as src, partial.open("ab") as dst:
+            src.seek(done)
+            shutil.copyfileobj(src, dst, self.chunk_bytes)
+        partial.rename(target)
+
+    def url(self, remote_path: str) -> str:
+        return str(self.root / remote_path)
+
+
+class HubBackend(ArtifactBackend):
+    name = "hub"
+
+    def __init__(self, repo_id: str):
+        from huggingface_hub import HfApi
+
+        self.repo_id = repo_id
+        self.api = HfApi()
+
+    def put_files(self, files: list[tuple[Path, str]], *, message: str) -> None:
+        from huggingface_hub import CommitOperationAdd
+
+        # One commit per batch keeps a checkpoint directory atomic on the Hub and
+        # stays under the commit rate limit.
+        operations = [CommitOperationAdd(path_in_repo=remote, path_or_fileobj=str(local)) for local, remote in files]
+        self.api.create_commit(repo_id=self.repo_id, operations=operations, commit_message=message)
+
+    def url(self, remote_path: str) -> str:
+        return f"https://huggingface.co/{self.repo_id}/tree/main/{remote_path}"
+
+
+def artifact_backend(spec: str) -> ArtifactBackend | None:
+    kind, _, target = spec.partition(":")
+    if not target:
+        raise ValueError(f"Artifact sink spec must be local:<dir> or hub:<repo_id>, got {spec!r}")
+    if kind == "local":
+        return LocalDirBackend(target)
+    if kind == "hub":
+        try:
+            return HubBackend(target)
+        except ImportError:
+            print("[warn] huggingface_hub not installed; skipping upload")
+            return None
+    raise ValueError(f"Unknown artifact sink backend: {kind!r}")
+
+
+class ArtifactSink:
+    """Upload files from a background thread with retries and a resumable manifest."""
+
+    def __init__(
+        self,
+        backend: ArtifactBackend,
+        *,
+        manifest_path: str | Path,
+        retries: int = 5,
+        max_backoff: float = 60.0,
+    ):
+        self.backend = backend
+        self.manifest_path = Path(manifest_path)
+        self.retries = retries
+        self.max_backoff = max_backoff
+        self.failed: list[str] = []
+        self.uploaded_bytes = 0
+        self._done = self._load_manifest()
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name="artifact-sink", daemon=True)
+        self._worker.start()
+
+    def _load_manifest(self) -> dict[str, tuple[int, int]]:
+        done: dict[str, tuple[int, int]] = {}
+        if not self.manifest_path.exists():
+            return done
+        for line in self.manifest_path.read_text().splitlines():
+            try:
+                entry = json.loads(line)
+                done[entry["remote"]] = (int(entry["size"]), int(entry["mtime_ns"]))
+            except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                # A run killed mid-append can leave a truncated final line.
+                continue
+        return done
+
+    def submit_file(self, local_path: str | Path, remote_path: str) -> None:
+        self._queue.put(([(Path(local_path), remote_path)], f"Upload {remote_path}"))
+
+    def submit_dir(self, local_dir: str | Path, remote_prefix: str, *, exclude: tuple[str, ...] = ()) -> None:
+        """Queue every file under `local_dir` except those whose name matches a glob in `exclude`."""
+        local_dir = Path(local_dir)
+        files = [
+            (path, f"{remote_prefix}/{path.relative_to(local_dir).as_posix()}")
+            for path in sorted(local_dir.rglob("*"))
+            if path.is_file() and not any(fnmatch.fnmatch(path.name, pattern) for pattern in exclude)
+        ]
+        self._queue.put((files, f"Upload {remote_prefix}"))
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._upload(*item)
+            finally:
+                self._queue.task_done()
+
+    def _upload(self, files: list[tuple[Path, str]], message: str) -> None:
+        todo = []
+        try:
+            for local_path, remote_path in files:
+                stat = local_path.stat()
+                key = (stat.st_size, stat.st_mtime_ns)
+                if self._done.get(remote_path) != key:
+                    todo.append((local_path, remote_path, key))
+        except FileNotFoundError:
+            # Superseded before its turn, e.g. a pruned older checkpoint.
+            print(f"[sink] skipping {message}: files no longer exist")
+            return
+        if not todo:
+            return
+        for attempt in range(self.retries + 1):
+            try:
+                self.backend.put_files([(local, remote) for local, remote, _ in todo], message=message)
+                break
+            except FileNotFoundError:
+                print(f"[sink] skipping {message}: files removed during upload")
+                return
+            except Exception as exc:
+                if attempt == self.retries:
+                    print(f"[warn] {message} failed after {attempt + 1} attempts: {exc}")
+                    self.failed.extend(remote for _, remote, _ in todo)
+                    return
+                delay = min(2.0**attempt, self.max_backoff)
+                print(f"[sink] retrying {message} in {delay:.0f}s ({type(exc).__name__}: {exc})")
+                time.sleep(delay)
+        with self._lock, self.manifest_path.open("a") as f:
+            for _, remote, key in todo:
+                self._done[remote] = key
+                self.uploaded_bytes += key[0]
+                f.write(json.dumps({"remote": remote, "size": key[0], "mtime_ns": key[1]}) + "\n")
+        print(f"[sink] {message}: {len(todo)} files -> {self.backend.url(todo[0][1].rsplit('/', 1)[0])}")
+
+    def pending(self) -> int:
+        return self._queue.unfinished_tasks
+
+    def close(self) -> None:
+        """Wait for every queued upload to finish, then stop the worker.
+
+        This drains the whole queue, including mid-run checkpoints that were still
+        waiting, not only what was submitted last.
+        """
+        start = time.perf_counter()
+        pending = self.pending()
+        if pending:
+            print(f"[sink] waiting for {pending} queued uploads")
+        self._queue.put(None)
+        self._worker.join()
+        print(
+            f"[sink] {self.backend.name}: drained in {time.perf_counter() - start:.1f}s "
+            f"({self.uploaded_bytes / 1e9:.2f} GB uploaded, {len(self.failed)} failed)"
+        )
@@ -1,9 +1,11 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Callable
+from typing import Callable, Iterable
+import inspect
 import types
 
+import torch
 from torch import nn
 
 
@@ -55,6 +57,14 @@ def _build_wrapped_forward(original_forward: Callable) -> Callable:
     return wrapped_forward
 
 
+def is_prefill_bidirectional_active(model: nn.Module) -> bool:
+    """Return True if `model` currently has either prefill ablation (patch or mask) applied."""
+    return any(
+        getattr(module, "_prefill_bidirectional_patch", False) or getattr(module, "_prefill_bidirectional_mask", False)
+        for module in model.modules()
+    )
+
+
 def apply_prefill_bidirectional_patch(model: nn.Module, *, verbose: bool = True) -> PrefillBidirectionalPatch:
     """Patch attention modules so prefill uses bidirectional attention.
 
@@ -86,3 +96,718 @@ def apply_prefill_bidirectional_patch(model: nn.Module, *, verbose: bool = True)
     if verbose:
         print(f"[patch] applied prefill bidirectional mask ablation to {patch.patched_module_count} modules")
     return patch
+
+
+class PrefillMaskAblation:
+    """Handle for the mask-based prefill ablation; interchangeable with `PrefillBidirectionalPatch`."""
+
+    def __init__(self, model: nn.Module, handle):
+        self._model = model
+        self._handle = handle
+
+    @property
+    def patched_module_count(self) -> int:
+        return 1
+
+    def remove(self) -> None:
+        """Detach the mask hook."""
+        self._handle.remove()
+        if hasattr(self._model, "_prefill_bidirectional_mask"):
+            delattr(self._model, "_prefill_bidirectional_mask")
+
+
+def _past_length(past_key_values) -> int:
+    if past_key_values is None:
+        return 0
+    if hasattr(past_key_values, "get_seq_length"):
+        return int(past_key_values.get_seq_length())
+    # Legacy tuple-of-tuples cache: (key, value) per layer, key is [B, H, T, D].
+    return int(past_key_values[0][0].shape[-2]) if len(past_key_values) else 0
+
+
+def _mask_dtype(model: nn.Module) -> torch.dtype:
+    for param in model.parameters():
+        if param.dtype.is_floating_point:
+            return param.dtype
+    return torch.float32
+
+
+def build_prefill_bidirectional_mask(
+    key_padding_mask: torch.Tensor,
+    q_len: int,
+    *,
+    dtype: torch.dtype,
+) -> torch.Tensor:
+    """Additive `[B, 1, q_len, kv_len]` mask letting every query see every non-padding key."""
+    blocked = ~key_padding_mask.bool()[:, None, None, :]
+    mask = torch.zeros(
+        (key_padding_mask.shape[0], 1, q_len, key_padding_mask.shape[1]),
+        dtype=dtype,
+        device=key_padding_mask.device,
+    )
+    return mask.masked_fill(blocked, torch.finfo(dtype).min)
+
+
+def _prefill_mask_pre_hook(module: nn.Module, args, kwargs):
+    input_ids = kwargs.get("input_ids", args[0] if args else None)
+    reference = input_ids if input_ids is not None else kwargs.get("inputs_embeds")
+    # Same prefill test as the patch: decode steps (q_len == 1) keep the model's mask.
+    if reference is None or reference.ndim < 2 or int(reference.shape[1]) <= 1:
+        return None
+
+    attention_mask = kwargs.get("attention_mask")
+    if attention_mask is not None and attention_mask.ndim == 4:
+        # Caller already spelled out the mask it wants.
+        return None
+
+    batch_size, q_len = int(reference.shape[0]), int(reference.shape[1])
+    kv_len = _past_length(kwargs.get("past_key_values")) + q_len
+    if attention_mask is None:
+        attention_mask = torch.ones((batch_size, kv_len), dtype=torch.long, device=reference.device)
+    kwargs["attention_mask"] = build_prefill_bidirectional_mask(
+        attention_mask[:, -kv_len:],
+        q_len,
+        dtype=_mask_dtype(module),
+    )
+    return args, kwargs
+
+
+def apply_prefill_bidirectional_mask(model: nn.Module, *, verbose: bool = True) -> PrefillMaskAblation:
+    """Ablate prefill causality by feeding the model one explicit bidirectional mask per call.
+
+    A forward pre-hook on `model` replaces the 2D padding mask of every prefill call
+    (q_len > 1) with a 4D additive mask that only blocks padding keys, so attention
+    layers run unmodified. Requires a backend that honours 4D masks (sdpa, eager).
+    """
+    if getattr(model, "_prefill_bidirectional_mask", False):
+        raise RuntimeError("Prefill mask ablation is already applied to this model")
+    attn_implementation = getattr(getattr(model, "config", None), "_attn_implementation", None)
+    if attn_implementation is not None and "flash" in str(attn_implementation):
+        raise ValueError(f"Mask-based prefill ablation needs a 4D-mask backend, got {attn_implementation}")
+
+    handle = model.register_forward_pre_hook(_prefill_mask_pre_hook, with_kwargs=True)
+    setattr(model, "_prefill_bidirectional_mask", True)
+    ablation = PrefillMaskAblation(model, handle)
+    if verbose:
+        print("[patch] applied prefill bidirectional mask ablation via explicit 4D attention mask")
+    return ablation
+
+
+def build_prefix_lm_mask(
+    key_padding_mask: torch.Tensor,
+    prefix_lengths: torch.Tensor,
+    q_len: int,
+    *,
+    dtype: torch.dtype,
+) -> torch.Tensor:
+    """Additive `[B, 1, q_len, kv_len]` prefix-LM mask.
+
+    Queries are the last `q_len` positions. A key is visible if it is not padding and
+    either precedes the query (causal) or lies inside the row's first `prefix_lengths`
+    positions, so the prompt block is bidirectional and the rest stays causal.
+    """
+    batch_size, kv_len = key_padding_mask.shape
+    device = key_padding_mask.device
+    keys = torch.arange(kv_len, device=device)
+    queries = torch.arange(kv_len - q_len, kv_len, device=device)
+    prefix = prefix_lengths.to(device).view(batch_size, 1, 1)
+    visible = (keys[None, None, :] <= queries[None, :, None]) | (keys[None, None, :] < prefix)
+    visible = visible & key_padding_mask.bool()[:, None, :]
+    mask = torch.zeros((batch_size, q_len, kv_len), dtype=dtype, device=device)
+    mask.masked_fill_(~visible, torch.finfo(dtype).min)
+    return mask.unsqueeze(1)
+
+
+ROW_ATTENTION_MODES = ("causal", "prefill_bidirectional", "prefill_bidirectional_mask", "prefix_lm")
+
+
+def build_row_mode_mask(
+    key_padding_mask: torch.Tensor,
+    modes: list[str],
+    q_len: int,
+    *,
+    prompt_lengths: list[int] | None = None,
+    dtype: torch.dtype,
+) -> torch.Tensor:
+    """Additive `[B, 1, q_len, kv_len]` mask with an attention mode per row.
+
+    Each mode in `ROW_ATTENTION_MODES` is a prefix-LM mask with a different prefix:
+    none for causal, the whole row for prefill bidirectional, the prompt for
+    prefix_lm. Nothing on the model is mutated, so causal and ablated rows can share
+    a batch and concurrent forwards do not interfere.
+    """
+    kv_len = int(key_padding_mask.shape[1])
+    prefix_lengths = []
+    for row, mode in enumerate(modes):
+        if mode == "causal":
+            prefix_lengths.append(0)
+        elif mode in ("prefill_bidirectional", "prefill_bidirectional_mask"):
+            prefix_lengths.append(kv_len if q_len > 1 else 0)
+        elif mode == "prefix_lm":
+            if prompt_lengths is None:
+                raise ValueError("prefix_lm rows need prompt_lengths")
+            prefix_lengths.append(prompt_lengths[row])
+        else:
+            raise ValueError(f"Attention mode {mode} cannot be set per row. Available: {list(ROW_ATTENTION_MODES)}")
+    return build_prefix_lm_mask(
+        key_padding_mask,
+        torch.tensor(prefix_lengths, dtype=torch.long),
+        q_len,
+        dtype=dtype,
+    )
+
+
+class PrefixLMMask:
+    """Handle for the prefix-LM mask hook; interchangeable with `PrefillBidirectionalPatch`."""
+
+    def __init__(self, model: nn.Module, handle):
+        self._model = model
+        self._handle = handle
+
+    @property
+    def patched_module_count(self) -> int:
+        return 1
+
+    def remove(self) -> None:
+        """Detach the mask hook."""
+        self._handle.remove()
+        if hasattr(self._model, "_prefix_lm_mask"):
+            delattr(self._model, "_prefix_lm_mask")
+
+
+def _prefix_lm_pre_hook(module: nn.Module, args, kwargs):
+    prefix_lengths = kwargs.pop("prefix_lengths", None)
+    input_ids = kwargs.get("input_ids", args[0] if args else None)
+    reference = input_ids if input_ids is not None else kwargs.get("inputs_embeds")
+    if prefix_lengths is None or reference is None or reference.ndim < 2 or int(reference.shape[1]) <= 1:
+        return args, kwargs
+
+    attention_mask = kwargs.get("attention_mask")
+    if attention_mask is not None and attention_mask.ndim == 4:
+        return args, kwargs
+
+    batch_size, q_len = int(reference.shape[0]), int(reference.shape[1])
+    kv_len = _past_length(kwargs.get("past_key_values")) + q_len
+    if attention_mask is None:
+        attention_mask = torch.ones((batch_size, kv_len), dtype=torch.long, device=reference.device)
+    if not torch.is_tensor(prefix_lengths):
+        prefix_lengths = torch.tensor(prefix_lengths, dtype=torch.long)
+    kwargs["attention_mask"] = build_prefix_lm_mask(
+        attention_mask[:, -kv_len:],
+        prefix_lengths,
+        q_len,
+        dtype=_mask_dtype(module),
+    )
+    return args, kwargs
+
+
+def apply_prefix_lm_mask(model: nn.Module, *, verbose: bool = True) -> PrefixLMMask:
+    """Let callers pass `prefix_lengths=` to `model(...)` for a per-row prefix-LM mask.
+
+    Calls without `prefix_lengths` (and decode steps) are left causal. Scorers that
+    build their own 4D masks check `is_prefix_lm_active` instead.
+    """
+    if getattr(model, "_prefix_lm_mask", False):
+        raise RuntimeError("Prefix-LM mask is already applied to this model")
+    handle = model.register_forward_pre_hook(_prefix_lm_pre_hook, with_kwargs=True)
+    setattr(model, "_prefix_lm_mask", True)
+    if verbose:
+        print("[patch] enabled prefix-LM masking (bidirectional prompt, causal continuation)")
+    return PrefixLMMask(model, handle)
+
+
+def is_prefix_lm_active(model: nn.Module) -> bool:
+    return bool(getattr(model, "_prefix_lm_mask", False))
+
+
+BLOCK_ABLATION_MODES = ("block_bidirectional", "window_bidirectional")
+
+
+@dataclass(frozen=True)
+class BlockAblation:
+    """Partial prefill ablation on top of the causal mask.
+
+    - `block_bidirectional`: bidirectional within consecutive `block_size`-token blocks
+      (counted from the first non-padding token), causal across blocks.
+    - `window_bidirectional`: bidirectional over the trailing `block_size` tokens of
+      each row, causal before them.
+    """
+
+    kind: str
+    block_size: int
+
+
+class BlockMaskAblation:
+    """Handle for a block ablation hook; interchangeable with `PrefillBidirectionalPatch`."""
+
+    def __init__(self, model: nn.Module, handle):
+        self._model = model
+        self._handle = handle
+
+    @property
+    def patched_module_count(self) -> int:
+        return 1
+
+    def remove(self) -> None:
+        """Detach the mask hook."""
+        self._handle.remove()
+        if hasattr(self._model, "_block_ablation"):
+            delattr(self._model, "_block_ablation")
+
+
+def _block_visible(spec: BlockAblation, q_idx, kv_idx, start, end):
+    # Elementwise on broadcastable index tensors, so the same rule serves the dense
+    # mask and the FlexAttention mask_mod.
+    visible = kv_idx <= q_idx
+    if spec.kind == "block_bidirectional":
+        visible = visible | ((q_idx - start) // spec.block_size == (kv_idx - start) // spec.block_size)
+    else:
+        window_start = end - spec.block_size
+        visible = visible | ((q_idx >= window_start) & (kv_idx >= window_start))
+    # Padding queries see every real key, so no row is fully masked.
+    return visible | (q_idx < start) | (q_idx >= end)
+
+
+def _uses_flex_attention(model: nn.Module) -> bool:
+    return getattr(getattr(model, "config", None), "_attn_implementation", None) == "flex_attention"
+
+
+def build_block_ablation_mask(
+    spec: BlockAblation,
+    key_padding_mask: torch.Tensor,
+    q_len: int,
+    *,
+    dtype: torch.dtype,
+    block_sparse: bool = False,
+):
+    """Mask for the last `q_len` positions of each row under a block ablation.
+
+    Returns a FlexAttention `BlockMask` when `block_sparse` (fully masked tiles are
+    skipped, so compute follows the visible blocks), otherwise an additive
+    `[B, 1, q_len, kv_len]` tensor for sdpa/eager.
+    """
+    batch_size, kv_len = key_padding_mask.shape
+    device = key_padding_mask.device
+    valid = key_padding_mask.bool()
+    positions = torch.arange(kv_len, device=device)
+    start = torch.where(valid, positions, kv_len).amin(dim=-1)
+    end = torch.where(valid, positions + 1, 0).amax(dim=-1)
+    past = kv_len - q_len
+
+    if block_sparse:
+        from torch.nn.attention.flex_attention import create_block_mask
+
+        def mask_mod(b, h, q_idx, kv_idx):
+            return valid[b, kv_idx] & _block_visible(spec, q_idx + past, kv_idx, start[b], end[b])
+
+        return create_block_mask(mask_mod, batch_size, None, q_len, kv_len, device=device)
+
+    visible = _block_visible(
+        spec,
+        (positions[past:])[None, :, None],
+        positions[None, None, :],
+        start.view(-1, 1, 1),
+        end.view(-1, 1, 1),
+    )
+    visible = visible & valid[:, None, :]
+    mask = torch.zeros((batch_size, q_len, kv_len), dtype=dtype, device=device)
+    mask.masked_fill_(~visible, torch.finfo(dtype).min)
+    return mask.unsqueeze(1)
+
+
+def block_ablation_spec(model: nn.Module) -> BlockAblation | None:
+    return getattr(model, "_block_ablation", None)
+
+
+def block_ablation_mask(model: nn.Module, key_padding_mask: torch.Tensor, q_len: int):
+    """Mask for `model`'s active block ablation, in the form its attention backend takes."""
+    spec = block_ablation_spec(model)
+    if spec is None:
+        raise RuntimeError("No block ablation is applied to this model")
+    return build_block_ablation_mask(
+        spec,
+        key_padding_mask,
+        q_len,
+        dtype=_mask_dtype(model),
+        block_sparse=_uses_flex_attention(model),
+    )
+
+
+def _block_mask_pre_hook(module: nn.Module, args, kwargs):
+    input_ids = kwargs.get("input_ids", args[0] if args else None)
+    reference = input_ids if input_ids is not None else kwargs.get("inputs_embeds")
+    if reference is None or reference.ndim < 2 or int(reference.shape[1]) <= 1:
+        return None
+
+    attention_mask = kwargs.get("attention_mask")
+    if attention_mask is not None and len(attention_mask.shape) == 4:
+        return None
+
+    batch_size, q_len = int(reference.shape[0]), int(reference.shape[1])
+    kv_len = _past_length(kwargs.get("past_key_values")) + q_len
+    if attention_mask is None:
+        attention_mask = torch.ones((batch_size, kv_len), dtype=torch.long, device=reference.device)
+    kwargs["attention_mask"] = block_ablation_mask(module, attention_mask[:, -kv_len:], q_len)
+    return args, kwargs
+
+
+def apply_block_ablation(
+    model: nn.Module,
+    kind: str,
+    block_size: int,
+    *,
+    verbose: bool = True,
+) -> BlockMaskAblation:
+    """Apply a block-structured prefill ablation (see `BlockAblation`) via a mask hook.
+
+    Under `attn_implementation="flex_attention"` the mask is block-sparse; sdpa and
+    eager get the equivalent dense 4D mask.
+    """
+    if kind not in BLOCK_ABLATION_MODES:
+        raise ValueError(f"Unknown block ablation: {kind}. Available: {list(BLOCK_ABLATION_MODES)}")
+    if block_size < 1:
+        raise ValueError(f"block_size must be positive, got {block_size}")
+    if block_ablation_spec(model) is not None:
+        raise RuntimeError("A block ablation is already applied to this model")
+    attn_implementation = getattr(getattr(model, "config", None), "_attn_implementation", None)
+    if attn_implementation is not None and "flash" in str(attn_implementation):
+        raise ValueError(f"Block ablation needs a 4D-mask or flex backend, got {attn_implementation}")
+
+    handle = model.register_forward_pre_hook(_block_mask_pre_hook, with_kwargs=True)
+    setattr(model, "_block_ablation", BlockAblation(kind=kind, block_size=block_size))
+    if verbose:
+        backend = "block-sparse flex" if _uses_flex_attention(model) else "dense 4D"
+        print(f"[patch] applied {kind} ablation (block_size={block_size}, {backend} mask)")
+    return BlockMaskAblation(model, handle)
+
+
+def _attention_modules(model: nn.Module) -> list[nn.Module]:
+    """Self-attention modules of the text decoder, in layer order.
+
+    Multimodal checkpoints (e.g. Ministral-3 loaded as image-text-to-text) also carry
+    vision-tower attention, so the decoder layers are enumerated explicitly.
+    """
+    get_decoder = getattr(model, "get_decoder", None)
+    decoder = get_decoder() if get_decoder is not None else None
+    layers = getattr(decoder, "layers", None)
+    if layers is None:
+        raise ValueError(f"Cannot find text decoder layers on {type(model).__name__}")
+    modules = [getattr(layer, "self_attn", None) for layer in layers]
+    if any(module is None for module in modules):
+        raise ValueError("Every decoder layer needs a `self_attn` module")
+    config = getattr(model, "config", None)
+    if config is not None and hasattr(config, "get_text_config"):
+        config = config.get_text_config()
+    expected = getattr(config, "num_hidden_layers", None)
+    if expected is not None and len(modules) != expected:
+        raise ValueError(f"Found {len(modules)} decoder attention layers, config says num_hidden_layers={expected}")
+    return modules
+
+
+def _attention_mask_position(module: nn.Module) -> int | None:
+    params = [
+        p
+        for p in inspect.signature(module.forward).parameters.values()
+        if p.kind in (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+    ]
+    names = [p.name for p in params]
+    return names.index("attention_mask") if "attention_mask" in names else None
+
+
+def _bidirectional_layer_mask(attention_mask, hidden_states: torch.Tensor) -> torch.Tensor:
+    # Recover key padding from the mask the model built: the last query row sees every
+    # real key under a causal mask, so only padding stays blocked there.
+    batch_size, q_len = int(hidden_states.shape[0]), int(hidden_states.shape[-2])
+    dtype = hidden_states.dtype if hidden_states.dtype.is_floating_point else torch.float32
+    if attention_mask is None:
+        return torch.zeros((batch_size, 1, q_len, q_len), dtype=dtype, device=hidden_states.device)
+    last_row = attention_mask[:, :, -1:, :]
+    visible = last_row if last_row.dtype == torch.bool else last_row == 0
+    mask = torch.zeros(visible.shape, dtype=dtype, device=visible.device).masked_fill(~visible, torch.finfo(dtype).min)
+    return mask.expand(-1, -1, q_len, -1)
+
+
+class LayerAblationSwitch:
+    """Per-layer prefill ablation; hooks stay attached and `set_layers` flips them.
+
+    Enabled layers see a bidirectional mask over non-padding keys on prefill calls
+    (q_len > 1); all other layers keep the model's causal mask.
+    """
+
+    def __init__(self, model: nn.Module, modules: list[nn.Module]):
+        self._model = model
+        self._modules = modules
+        self._enabled = [False] * len(modules)
+        self._handles = [
+            module.register_forward_pre_hook(self._make_hook(index, module), with_kwargs=True)
+            for index, module in enumerate(modules)
+        ]
+
+    @property
+    def patched_module_count(self) -> int:
+        return len(self._modules)
+
+    @property
+    def num_layers(self) -> int:
+        return len(self._modules)
+
+    @property
+    def active_layers(self) -> list[int]:
+        return [index for index, enabled in enumerate(self._enabled) if enabled]
+
+    def set_layers(self, layers: Iterable[int]) -> None:
+        """Ablate exactly `layers` (indices into the model's attention layers)."""
+        enabled = [False] * len(self._modules)
+        for index in layers:
+            if not -len(enabled) <= index < len(enabled):
+                raise ValueError(f"Layer {index} out of range for {len(enabled)} attention layers")
+            enabled[index] = True
+        self._enabled = enabled
+
+    def _make_hook(self, index: int, module: nn.Module):
+        mask_position = _attention_mask_position(module)
+
+        def hook(_module, args, kwargs):
+            if not self._enabled[index]:
+                return None
+            hidden_states = kwargs.get("hidden_states", args[0] if args else None)
+            if not _is_prefill_call(hidden_states):
+                return None
+            if "attention_mask" in kwargs or mask_position is None or len(args) <= mask_position:
+                kwargs["attention_mask"] = _bidirectional_layer_mask(kwargs.get("attention_mask"), hidden_states)
+            else:
+                args = list(args)
+                args[mask_position] = _bidirectional_layer_mask(args[mask_position], hidden_states)
+                args = tuple(args)
+            return args, kwargs
+
+        return hook
+
+    def remove(self) -> None:
+        """Detach all layer hooks."""
+        for handle in self._handles:
+            handle.remove()
+        if hasattr(self._model, "_layer_ablation"):
+            delattr(self._model, "_layer_ablation")
+
+
+def apply_layer_ablation(
+    model: nn.Module,
+    layers: Iterable[int] = (),
+    *,
+    verbose: bool = True,
+) -> LayerAblationSwitch:
+    """Hook every attention layer once; which layers are ablated is set via `set_layers`.
+
+    Works with backends that take 4D masks (sdpa, eager).
+    """
+    if getattr(model, "_layer_ablation", None) is not None:
+        raise RuntimeError("Layer ablation is already applied to this model")
+    attn_implementation = getattr(getattr(model, "config", None), "_attn_implementation", None)
+    if attn_implementation is not None and ("flash" in str(attn_implementation) or "flex" in str(attn_implementation)):
+        raise ValueError(f"Layer ablation needs a 4D-mask backend, got {attn_implementation}")
+    modules = _attention_modules(model)
+    if not modules:
+        raise ValueError("No decoder attention modules found")
+    switch = LayerAblationSwitch(model, modules)
+    switch.set_layers(layers)
+    setattr(model, "_layer_ablation", switch)
+    if verbose:
+        print(f"[patch] attached layer ablation hooks to {switch.num_layers} attention layers")
+    return switch
+
+
+def is_layer_ablation_active(model: nn.Module) -> bool:
+    """True if a layer ablation switch is attached with at least one layer enabled."""
+    switch = getattr(model, "_layer_ablation", None)
+    return switch is not None and bool(switch.active_layers)
+
+
+def parse_layer_subset(spec: str, num_layers: int) -> list[int]:
+    """Parse `all`, `none`, `first:N`, `last:N`, or comma-separated indices and `a-b` ranges."""
+    spec = spec.strip()
+    if spec == "all":
+        return list(range(num_layers))
+    if spec == "none":
+        return []
+    if spec.startswith(("first:", "last:")):
+        which, _, count = spec.partition(":")
+        count = int(count)
+        if not 0 <= count <= num_layers:
+            raise ValueError(f"{spec}: count must be in [0, {num_layers}]")
+        return list(range(count)) if which == "first" else list(range(num_layers - count, num_layers))
+    layers: set[int] = set()
+    for part in spec.split(","):
+        part = part.strip()
+        start, sep, end = part.partition("-")
+        bounds = (int(start), int(end)) if sep else (int(part), int(part))
+        if not 0 <= bounds[0] <= bounds[1] < num_layers:
+            raise ValueError(f"Layer range {part} out of range for {num_layers} attention layers")
+        layers.update(range(bounds[0], bounds[1] + 1))
+    return sorted(layers)
+
+
+def uses_explicit_attention_mask(model: nn.Module) -> bool:
+    """True if a hook on `model` rewrites the attention mask for the active mode.
+
+    Callers that bypass `model.forward` (e.g. by calling the decoder directly) have to
+    build that mask themselves.
+    """
+    return bool(
+        getattr(model, "_prefill_bidirectional_mask", False)
+        or is_prefix_lm_active(model)
+        or block_ablation_spec(model) is not None
+    )
+
+
+def build_document_mask(
+    document_ids: torch.Tensor,
+    prefix_ends: torch.Tensor,
+    *,
+    dtype: torch.dtype,
+) -> torch.Tensor:
+    """Additive `[B, 1, L, L]` mask for rows packed with several documents.
+
+    `document_ids` is `[B, L]` with -1 on padding; keys are only visible inside the
+    query's own document. Within it a key is visible if it precedes the query or lies
+    before the query's `prefix_ends` position, which covers causal (prefix end = doc
+    start), bidirectional (doc end) and prefix-LM (doc start + prompt length) rows.
+    """
+    seq_len = int(document_ids.shape[1])
+    positions = torch.arange(seq_len, device=document_ids.device)
+    keys = positions[None, None, :]
+    queries = positions[None, :, None]
+    same_doc = (document_ids[:, :, None] == document_ids[:, None, :]) & (document_ids[:, None, :] >= 0)
+    visible = same_doc & ((keys <= queries) | (keys < prefix_ends.to(document_ids.device)[:, :, None]))
+    # Padding queries attend to themselves so no row is fully masked.
+    visible = visible | ((document_ids[:, :, None] < 0) & (keys == queries))
+    mask = torch.zeros(visible.shape, dtype=dtype, device=document_ids.device)
+    mask.masked_fill_(~visible, torch.finfo(dtype).min)
+    return mask.unsqueeze(1)
+
+
+class DocumentMask:
+    """Handle for the packed-document mask hook; interchangeable with `PrefillBidirectionalPatch`."""
+
+    def __init__(self, model: nn.Module, handle):
+        self._model = model
+        self._handle = handle
+
+    @property
+    def patched_module_count(self) -> int:
+        return 1
+
+    def remove(self) -> None:
+        """Detach the mask hook."""
+        self._handle.remove()
+        if hasattr(self._model, "_document_mask"):
+            delattr(self._model, "_document_mask")
+
+
+def _document_mask_pre_hook(module: nn.Module, args, kwargs):
+    document_ids = kwargs.pop("document_ids", None)
+    prefix_ends = kwargs.pop("prefix_ends", None)
+    if document_ids is None or prefix_ends is None:
+        return args, kwargs
+    kwargs["attention_mask"] = build_document_mask(document_ids, prefix_ends, dtype=_mask_dtype(module))
+    return args, kwargs
+
+
+def apply_document_mask(model: nn.Module, *, verbose: bool = True) -> DocumentMask:
+    """Let callers pass `document_ids=` and `prefix_ends=` to `model(...)` for packed rows.
+
+    The hook swaps in the block-diagonal mask from `build_document_mask`; calls
+    without those kwargs are left alone.
+    """
+    if getattr(model, "_document_mask", False):
+        raise RuntimeError("Document mask is already applied to this model")
+    handle = model.register_forward_pre_hook(_document_mask_pre_hook, with_kwargs=True)
+    setattr(model, "_document_mask", True)
+    if verbose:
+        print("[patch] enabled per-document attention masks for packed sequences")
+    return DocumentMask(model, handle)
+
+
+def prefill_patch_supported(model: nn.Module, *, padded: bool) -> bool:
+    """Whether the forward patch really ablates causality on this backend.
+
+    Eager attention always applies the model's causal mask, and sdpa does too once a
+    padding mask is passed; only flash-style kernels follow `is_causal` in both cases.
+    """
+    attn_implementation = str(getattr(getattr(model, "config", None), "_attn_implementation", None) or "sdpa")
+    if "flash" in attn_implementation:
+        return True
+    return attn_implementation != "eager" and not padded
+
+
+def compare_prefill_ablations(
+    model: nn.Module,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor | None = None,
+) -> dict[str, float]:
+    """Max absolute logit difference of each prefill ablation vs. the same rows run one by one.
+
+    The reference runs every row alone, unpadded, under the mask ablation. `patch`
+    and `mask` then run the whole right-padded batch and are compared on real tokens
+    only, so a padded batch shows where the patch leaves attention causal.
+    """
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    lengths = attention_mask.sum(dim=1).tolist()
+    for row, length in enumerate(lengths):
+        if not bool(attention_mask[row, :length].all()):
+            raise ValueError("compare_prefill_ablations expects right-padded rows")
+
+    logits: dict[str, torch.Tensor] = {}
+    reference: list[torch.Tensor] = []
+    for name, apply in (("patch", apply_prefill_bidirectional_patch), ("mask", apply_prefill_bidirectional_mask)):
+        ablation = apply(model, verbose=False)
+        try:
+            with torch.no_grad():
+                logits[name] = model(input_ids=input_ids, attention_mask=attention_mask, use_cache=False).logits.float()
+                if name == "mask":
+                    reference = [
+                        model(input_ids=input_ids[row : row + 1, :length], use_cache=False).logits.float()[0]
+                        for row, length in enumerate(lengths)
+                    ]
+        finally:
+            ablation.remove()
+    return {
+        name: max(float((batch[row, :length] - reference[row]).abs().max()) for row, length in enumerate(lengths))
+        for name, batch in logits.items()
+    }
+
+
+ATTENTION_MODES = ("causal", "prefill_bidirectional", "prefill_bidirectional_mask", "prefix_lm")
+
+
+def parse_attention_mode(mode: str) -> tuple[str, int | None]:
+    """Split a mode name into `(name, block_size)`; block modes are written `name:<size>`."""
+    name, _, size = mode.partition(":")
+    if name in BLOCK_ABLATION_MODES:
+        if not size.isdigit() or int(size) < 1:
+            raise ValueError(f"Attention mode {name} needs a positive block size, e.g. {name}:64")
+        return name, int(size)
+    if name not in ATTENTION_MODES or size:
+        available = list(ATTENTION_MODES) + [f"{m}:<size>" for m in BLOCK_ABLATION_MODES]
+        raise ValueError(f"Unknown attention mode: {mode}. Available: {available}")
+    return name, None
+
+
+def apply_attention_mode(
+    model: nn.Module,
+    mode: str,
+    *,
+    verbose: bool = True,
+) -> PrefillBidirectionalPatch | PrefillMaskAblation | PrefixLMMask | BlockMaskAblation | None:
+    """Put `model` into a named attention mode; returns the patch to remove afterwards, if any."""
+    name, block_size = parse_attention_mode(mode)
+    if block_size is not None:
+        return apply_block_ablation(model, name, block_size, verbose=verbose)
+    if name == "prefill_bidirectional":
+        return apply_prefill_bidirectional_patch(model, verbose=verbose)
+    if name == "prefill_bidirectional_mask":
+        return apply_prefill_bidirectional_mask(model, verbose=verbose)
+    if name == "prefix_lm":
+        return apply_prefix_lm_mask(model, verbose=verbose)
+    return None
@@ -0,0 +1,437 @@
+"""CPU microbenchmark of the attention ablations on a tiny random Mistral model.
+
+Times a training step (forward + backward with labels) for each attention mode,
+backend, sequence length and batch size, then splits the cost:
+
+  forward_ms / backward_ms   the step without instrumentation (medians)
+  mask_hook_ms               model-level forward pre-hooks (Python mask construction)
+  attention_module_ms        inside the attention modules, summed over layers
+                             (projections, rope, forward-patch wrapper, kernel)
+  kernel_fwd_ms / _bwd_ms    the attention kernel alone on the same shapes and the
+                             mask the model actually passed, summed over layers
+
+and, against the causal row of the same backend/shape, `delta_vs_causal` splits
+the extra forward time into kernel, mask hook and the remainder (wrapper, mask
+plumbing and dispatch overhead):
+
+  uv run prefill-attention-bench \
+    --seq-lens 128,512,1024 --batch-sizes 1,4 \
+    --output-json artifacts/bench/attention_bench.json
+
+Rows are sorted and rounded so two runs can be diffed; `--baseline-json` prints
+forward/backward ratios against an earlier run. `--check-chunked-loss N` also
+checks the N-token chunked loss (`--loss-chunk-tokens`) against the model's own
+loss and gradients on each backend, and exits non-zero when they disagree.
+`--check-prefill-ablations` does the same for the forward patch and the mask
+ablation on an unpadded and a right-padded batch; the patch is only held to the
+reference where `prefill_patch_supported` says fine-tuning may use it.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import platform
+import statistics
+import time
+from pathlib import Path
+
+import torch
+import torch.nn.functional as F
+import transformers
+from torch import nn
+from transformers import MistralConfig, MistralForCausalLM
+
+from prefill_ablation.attention_ablation import (
+    _attention_modules,
+    compare_prefill_ablations,
+    apply_attention_mode,
+    parse_attention_mode,
+    prefill_patch_supported,
+)
+from prefill_ablation.chunked_loss import chunked_loss_parity
+from prefill_ablation.utils import set_seed
+
+
+DEFAULT_MODES = "causal,prefill_bidirectional,prefill_bidirectional_mask,prefix_lm,block_bidirectional:64"
+PARITY_TOLERANCE = 1e-4
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Microbenchmark attention ablations on a tiny random Mistral model")
+    parser.add_argument("--modes", default=DEFAULT_MODES, help="Comma-separated attention modes (see --attention-mode)")
+    parser.add_argument("--backends", default="sdpa,eager", help="Comma-separated attn_implementation values")
+    parser.add_argument("--seq-lens", default="128,512,1024")
+    parser.add_argument("--batch-sizes", default="1,4")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--num-layers", type=int, default=2)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--num-kv-heads", type=int, default=2)
+    parser.add_argument("--vocab-size", type=int, default=4096)
+    parser.add_argument("--threads", type=int, default=4, help="torch.set_num_threads; fixed for comparable runs")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output-json", default="artifacts/bench/attention_bench.json")
+    parser.add_argument("--baseline-json", default=None, help="Earlier output to compare against")
+    parser.add_argument(
+        "--check-chunked-loss",
+        type=int,
+        default=0,
+        help="Check the chunked loss with this many tokens per chunk against the model's loss (0 = off)",
+    )
+    parser.add_argument(
+        "--check-prefill-ablations",
+        action="store_true",
+        help="Check the prefill patch and mask ablations against per-row logits, unpadded and padded",
+    )
+    return parser.parse_args()
+
+
+def _csv_ints(value: str) -> list[int]:
+    return [int(x) for x in value.split(",") if x.strip()]
+
+
+def build_tiny_model(args: argparse.Namespace, attn_implementation: str, max_seq_len: int) -> MistralForCausalLM:
+    config = MistralConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 2,
+        num_hidden_layers=args.num_layers,
+        num_attention_heads=args.num_heads,
+        num_key_value_heads=args.num_kv_heads,
+        max_position_embeddings=max_seq_len,
+        sliding_window=None,
+        tie_word_embeddings=False,
+    )
+    config._attn_implementation = attn_implementation
+    set_seed(args.seed)
+    model = MistralForCausalLM(config)
+    model.train()
+    return model
+
+
+def _median_ms(samples: list[float]) -> float:
+    return round(statistics.median(samples) * 1e3, 4)
+
+
+def _batch(mode: str, vocab_size: int, batch_size: int, seq_len: int, seed: int) -> dict:
+    generator = torch.Generator().manual_seed(seed)
+    input_ids = torch.randint(0, vocab_size, (batch_size, seq_len), generator=generator)
+    batch = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids), "labels": input_ids.clone()}
+    if parse_attention_mode(mode)[0] == "prefix_lm":
+        batch["prefix_lengths"] = torch.full((batch_size,), seq_len // 2, dtype=torch.long)
+    return batch
+
+
+def check_chunked_loss(model: nn.Module, backend: str, args: argparse.Namespace, seq_len: int) -> list[dict]:
+    """Chunked vs. model loss with prompt positions masked, per-batch mean and token-normalized."""
+    batch = _batch("causal", args.vocab_size, 2, seq_len, args.seed)
+    batch["labels"][:, : seq_len // 3] = -100
+    targets = int((batch["labels"][:, 1:] != -100).sum())
+    results = []
+    # 2x the batch's targets stands in for gradient accumulation over two micro-batches.
+    for num_items_in_batch in (None, 2 * targets):
+        report = chunked_loss_parity(model, batch, args.check_chunked_loss, num_items_in_batch=num_items_in_batch)
+        errors = " ".join(f"{k}={v:.2e}" for k, v in report.items())
+        print(f"[parity] {backend} num_items_in_batch={num_items_in_batch} {errors}")
+        results.append(
+            {"backend": backend, "num_items_in_batch": num_items_in_batch, "max_rel_error": max(report.values()), **report}
+        )
+    return results
+
+
+def check_prefill_ablations(
+    model: nn.Module, backend: str, args: argparse.Namespace, seq_len: int
+) -> list[dict]:
+    """Patch and mask ablation logits vs. per-row references, on an unpadded and a right-padded batch."""
+    input_ids = _batch("causal", args.vocab_size, 3, seq_len, args.seed)["input_ids"]
+    padding = torch.ones_like(input_ids)
+    for row, length in enumerate((seq_len, 2 * seq_len // 3, seq_len // 3 + 1)):
+        padding[row, length:] = 0
+    results = []
+    for padded, attention_mask in ((False, None), (True, padding)):
+        report = compare_prefill_ablations(model, input_ids, attention_mask)
+        # The patch is only required to match where fine-tuning would use it.
+        checked = ["mask"] + (["patch"] if prefill_patch_supported(model, padded=padded) else [])
+        errors = " ".join(f"{k}={v:.2e}" for k, v in report.items())
+        print(f"[parity] {backend} prefill padded={padded} {errors} checked={','.join(checked)}")
+        results.append(
+            {
+                "backend": backend,
+                "padded": padded,
+                "checked": checked,
+                "max_abs_error": max(report[name] for name in checked),
+                **report,
+            }
+        )
+    return results
+
+
+def _step(model: nn.Module, batch: dict) -> tuple[float, float]:
+    start = time.perf_counter()
+    loss = model(**batch, use_cache=False).loss
+    forward_end = time.perf_counter()
+    loss.backward()
+    end = time.perf_counter()
+    model.zero_grad(set_to_none=True)
+    return forward_end - start, end - forward_end
+
+
+class _Breakdown:
+    """Hooks that time the model-level pre-hooks and the attention modules, and capture the kernel inputs."""
+
+    def __init__(self, model: nn.Module):
+        self.mask_hook_s = 0.0
+        self.attention_s = 0.0
+        self.captured: dict | None = None
+        self._starts: dict[int, float] = {}
+        self._hook_start = 0.0
+        # Prepended/appended around whatever mask hooks the mode installed.
+        self._handles = [
+            model.register_forward_pre_hook(self._before_hooks, prepend=True),
+            model.register_forward_pre_hook(self._after_hooks),
+        ]
+        for module in _attention_modules(model):
+            self._handles.append(module.register_forward_pre_hook(self._attention_start, with_kwargs=True))
+            self._handles.append(module.register_forward_hook(self._attention_end))
+
+    def _before_hooks(self, module, args):
+        self._hook_start = time.perf_counter()
+
+    def _after_hooks(self, module, args):
+        self.mask_hook_s += time.perf_counter() - self._hook_start
+
+    def _attention_start(self, module, args, kwargs):
+        if self.captured is None:
+            hidden_states = kwargs.get("hidden_states", args[0] if args else None)
+            self.captured = {
+                "q_len": int(hidden_states.shape[-2]),
+                "attention_mask": kwargs.get("attention_mask"),
+                # The forward patch clears is_causal inside the call, after this hook.
+                "is_causal": module.is_causal and not getattr(module, "_prefill_bidirectional_patch", False),
+            }
+        self._starts[id(module)] = time.perf_counter()
+
+    def _attention_end(self, module, args, output):
+        self.attention_s += time.perf_counter() - self._starts.pop(id(module))
+
+    def remove(self) -> None:
+        for handle in self._handles:
+            handle.remove()
+
+
+def _kernel(backend: str, query, key, value, mask, is_causal: bool):
+    if backend == "eager":
+        scores = query @ key.transpose(-1, -2) / math.sqrt(query.shape[-1])
+        if mask is not None:
+            scores = scores.masked_fill(~mask, torch.finfo(scores.dtype).min) if mask.dtype == torch.bool else scores + mask
+        elif is_causal:
+            q_len = query.shape[-2]
+            scores = scores.masked_fill(torch.ones(q_len, q_len, dtype=torch.bool).triu(1), torch.finfo(scores.dtype).min)
+        return torch.softmax(scores, dim=-1) @ value
+    return F.scaled_dot_product_attention(query, key, value, attn_mask=mask, is_causal=mask is None and is_causal)
+
+
+def time_kernel(backend: str, config, batch_size: int, captured: dict, *, repeats: int, warmup: int) -> tuple[float, float]:
+    """Median forward/backward seconds of one attention call, with the mask the model passed."""
+    q_len = captured["q_len"]
+    head_dim = config.hidden_size // config.num_attention_heads
+    shape = (batch_size, config.num_attention_heads, q_len, head_dim)
+    query, key, value = (torch.randn(shape, requires_grad=True) for _ in range(3))
+    grad = torch.randn(shape)
+    mask = captured["attention_mask"]
+    if mask is not None and not torch.is_tensor(mask):
+        # Non-dense masks (e.g. flex BlockMask) have no standalone kernel equivalent here.
+        return math.nan, math.nan
+    if mask is not None:
+        mask = mask[..., :q_len]
+    forward, backward = [], []
+    for i in range(warmup + repeats):
+        start = time.perf_counter()
+        out = _kernel(backend, query, key, value, mask, captured["is_causal"])
+        forward_end = time.perf_counter()
+        out.backward(grad)
+        end = time.perf_counter()
+        query.grad = key.grad = value.grad = None
+        if i >= warmup:
+            forward.append(forward_end - start)
+            backward.append(end - forward_end)
+    return statistics.median(forward), statistics.median(backward)
+
+
+def bench_case(model: nn.Module, backend: str, mode: str, batch_size: int, seq_len: int, args) -> dict:
+    batch = _batch(mode, model.config.vocab_size, batch_size, seq_len, args.seed)
+    forward, backward = [], []
+    for i in range(args.warmup + args.repeats):
+        f, b = _step(model, batch)
+        if i >= args.warmup:
+            forward.append(f)
+            backward.append(b)
+
+    breakdown = _Breakdown(model)
+    try:
+        mask_hook, attention = [], []
+        for _ in range(args.repeats):
+            breakdown.mask_hook_s = breakdown.attention_s = 0.0
+            _step(model, batch)
+            mask_hook.append(breakdown.mask_hook_s)
+            attention.append(breakdown.attention_s)
+    finally:
+        breakdown.remove()
+
+    num_layers = model.config.num_hidden_layers
+    kernel_forward, kernel_backward = time_kernel(
+        backend, model.config, batch_size, breakdown.captured, repeats=args.repeats, warmup=args.warmup
+    )
+    mask = breakdown.captured["attention_mask"]
+    return {
+        "backend": backend,
+        "mode": mode,
+        "seq_len": seq_len,
+        "batch_size": batch_size,
+        "forward_ms": _median_ms(forward),
+        "backward_ms": _median_ms(backward),
+        "mask_hook_ms": _median_ms(mask_hook),
+        "attention_module_ms": _median_ms(attention),
+        "kernel_fwd_ms": round(kernel_forward * num_layers * 1e3, 4),
+        "kernel_bwd_ms": round(kernel_backward * num_layers * 1e3, 4),
+        "kernel_mask": "none" if mask is None else type(mask).__name__ if not torch.is_tensor(mask) else str(mask.dtype),
+        "kernel_is_causal": bool(breakdown.captured["is_causal"]),
+        "tokens_per_s": round(batch_size * seq_len / (statistics.median(forward) + statistics.median(backward)), 1),
+    }
+
+
+def add_causal_deltas(rows: list[dict]) -> None:
+    """Split each mode's extra forward time over the causal row into kernel, mask hook and overhead."""
+    causal = {(r["backend"], r["seq_len"], r["batch_size"]): r for r in rows if r["mode"] == "causal"}
+    for row in rows:
+        base = causal.get((row["backend"], row["seq_len"], row["batch_size"]))
+        if base is None or row is base:
+            continue
+        forward = row["forward_ms"] - base["forward_ms"]
+        kernel = row["kernel_fwd_ms"] - base["kernel_fwd_ms"]
+        mask_hook = row["mask_hook_ms"] - base["mask_hook_ms"]
+        row["delta_vs_causal"] = {
+            "forward_ms": round(forward, 4),
+            "backward_ms": round(row["backward_ms"] - base["backward_ms"], 4),
+            "kernel_fwd_ms": round(kernel, 4),
+            "mask_hook_ms": round(mask_hook, 4),
+            "overhead_ms": round(forward - kernel - mask_hook, 4) if not math.isnan(kernel) else None,
+        }
+
+
+def _row_key(row: dict) -> tuple:
+    return row["backend"], row["mode"], row["seq_len"], row["batch_size"]
+
+
+def print_table(rows: list[dict], baseline: list[dict] | None) -> None:
+    previous = {_row_key(r): r for r in baseline or []}
+    header = ["backend", "mode", "L", "B", "fwd_ms", "bwd_ms", "mask_ms", "attn_ms", "kernel_ms", "overhead_ms"]
+    if previous:
+        header += ["fwd_vs_base", "bwd_vs_base"]
+    print("\t".join(header))
+    for row in rows:
+        delta = row.get("delta_vs_causal") or {}
+        cells = [
+            row["backend"],
+            row["mode"],
+            str(row["seq_len"]),
+            str(row["batch_size"]),
+            f"{row['forward_ms']:.2f}",
+            f"{row['backward_ms']:.2f}",
+            f"{row['mask_hook_ms']:.2f}",
+            f"{row['attention_module_ms']:.2f}",
+            f"{row['kernel_fwd_ms']:.2f}",
+            f"{delta['overhead_ms']:.2f}" if delta.get("overhead_ms") is not None else "-",
+        ]
+        if previous:
+            old = previous.get(_row_key(row))
+            cells += [
+                f"{row['forward_ms'] / old['forward_ms']:.3f}" if old else "-",
+                f"{row['backward_ms'] / old['backward_ms']:.3f}" if old else "-",
+            ]
+        print("\t".join(cells))
+
+
+def main() -> None:
+    args = parse_args()
+    torch.set_num_threads(args.threads)
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    for mode in modes:
+        parse_attention_mode(mode)
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    seq_lens = _csv_ints(args.seq_lens)
+    batch_sizes = _csv_ints(args.batch_sizes)
+
+    rows: list[dict] = []
+    errors: list[dict] = []
+    parity: list[dict] = []
+    prefill_parity: list[dict] = []
+    for backend in backends:
+        model = build_tiny_model(args, backend, max(seq_lens))
+        if args.check_chunked_loss > 0:
+            parity.extend(check_chunked_loss(model, backend, args, min(seq_lens)))
+        if args.check_prefill_ablations:
+            prefill_parity.extend(check_prefill_ablations(model, backend, args, min(seq_lens)))
+        for mode in modes:
+            try:
+                ablation = apply_attention_mode(model, mode, verbose=False)
+            except (ValueError, RuntimeError) as exc:
+                errors.append({"backend": backend, "mode": mode, "error": str(exc)})
+                continue
+            try:
+                for seq_len in seq_lens:
+                    for batch_size in batch_sizes:
+                        row = bench_case(model, backend, mode, batch_size, seq_len, args)
+                        print(f"[bench] {backend} {mode} L={seq_len} B={batch_size} fwd={row['forward_ms']:.2f}ms")
+                        rows.append(row)
+            finally:
+                if ablation is not None:
+                    ablation.remove()
+
+    rows.sort(key=lambda r: (r["backend"], r["seq_len"], r["batch_size"], modes.index(r["mode"])))
+    add_causal_deltas(rows)
+    summary = {
+        "environment": {
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "threads": args.threads,
+        },
+        "model": {
+            "hidden_size": args.hidden_size,
+            "num_layers": args.num_layers,
+            "num_heads": args.num_heads,
+            "num_kv_heads": args.num_kv_heads,
+            "vocab_size": args.vocab_size,
+            "head_dim": args.hidden_size // args.num_heads,
+        },
+        "repeats": args.repeats,
+        "warmup": args.warmup,
+        "rows": rows,
+        "errors": errors,
+    }
+    if parity:
+        summary["chunked_loss_parity"] = parity
+    if prefill_parity:
+        summary["prefill_ablation_parity"] = prefill_parity
+
+    baseline = json.loads(Path(args.baseline_json).read_text())["rows"] if args.baseline_json else None
+    print_table(rows, baseline)
+
+    out_path = Path(args.output_json)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    out_path.write_text(json.dumps(summary, indent=2, sort_keys=True) + "\n")
+    print(f"[done] wrote {len(rows)} rows to {out_path}")
+    failed = [r for r in parity if r["max_rel_error"] > PARITY_TOLERANCE]
+    if failed:
+        raise SystemExit(f"Chunked loss disagrees with the model loss beyond {PARITY_TOLERANCE:g}: {failed}")
+    failed = [r for r in prefill_parity if r["max_abs_error"] > PARITY_TOLERANCE]
+    if failed:
+        raise SystemExit(f"Prefill ablations disagree with per-row logits beyond {PARITY_TOLERANCE:g}: {failed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""Raw checkpoints and asynchronous mid-run checkpointing for SFT.
+
+A raw checkpoint directory holds the weights as `save_sharded_state_dict` shards,
+the model config, tokenizer and `checkpoint_meta.json` (format `raw_state_dict`),
+so `load_model_and_tokenizer` can rehydrate it on top of the base model. Mid-run
+checkpoints (`<output_dir>/checkpoint-<step>/`) add the files the Trainer reads on
+resume: optimizer.pt, scheduler.pt, rng_state.pth (`rng_state_<rank>.pth` per
+process when distributed) and trainer_state.json. All but the trainer state
+(`RESUME_ONLY_FILES`) are useless outside the run that wrote them.
+
+`AsyncCheckpointWriter` copies weights and optimizer state into reusable CPU
+buffers on the training thread, then writes them from a background thread. Each
+checkpoint is written to `checkpoint-<step>.tmp` and renamed when complete, so a
+preempted write never shadows the previous checkpoint.
+"""
+from __future__ import annotations
+
+import copy
+import json
+import random
+import shutil
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import torch
+
+from prefill_ablation.utils import save_sharded_state_dict
+
+RESUME_ONLY_FILES = ("optimizer.pt", "scheduler.pt", "rng_state*.pth")
+
+
+def write_raw_checkpoint(directory: Path, state_dict: dict, *, model, tokenizer, meta: dict) -> None:
+    directory.mkdir(parents=True, exist_ok=True)
+    if getattr(model, "config", None) is not None:
+        model.config.save_pretrained(str(directory))
+    if getattr(model, "generation_config", None) is not None:
+        model.generation_config.save_pretrained(str(directory))
+    save_sharded_state_dict(state_dict, directory)
+    if tokenizer is not None:
+        tokenizer.save_pretrained(str(directory))
+    (directory / "checkpoint_meta.json").write_text(json.dumps({"format": "raw_state_dict", **meta}, indent=2))
+
+
+def _to_cpu(value, buffers: dict, path: tuple, shared: dict | None = None):
+    """Copy every tensor in a nested state dict to CPU, reusing buffers from earlier snapshots.
+
+    Tensors that share storage (tied embeddings) are copied once and come back as
+    the same CPU tensor, so `save_sharded_state_dict` still writes them as aliases.
+    """
+    if shared is None:
+        shared = {}
+    if torch.is_tensor(value):
+        storage = value.untyped_storage().data_ptr()
+        key = (value.device, storage, value.storage_offset(), tuple(value.shape), value.dtype)
+        if value.numel() and key in shared:
+            return shared[key]
+        buffer = buffers.get(path)
+        if buffer is None or buffer.shape != value.shape or buffer.dtype != value.dtype:
+            buffer = torch.empty(value.shape, dtype=value.dtype, pin_memory=value.is_cuda)
+            buffers[path] = buffer
+        buffer.copy_(value.detach(), non_blocking=value.is_cuda)
+        shared[key] = buffer
+        return buffer
+    if isinstance(value, dict):
+        return {k: _to_cpu(v, buffers, path + (k,), shared) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_cpu(v, buffers, path + (i,), shared) for i, v in enumerate(value))
+    return copy.deepcopy(value)
+
+
+def _rng_state(distributed: bool) -> dict:
+    # Same layout as Trainer._save_rng_state, so Trainer._load_rng_state restores it.
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "cpu": torch.random.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.random.get_rng_state_all() if distributed else torch.cuda.random.get_rng_state()
+    return state
+
+
+def gather_rng_states(args) -> list[dict]:
+    """Every process's RNG state, in process order; a collective when `world_size > 1`."""
+    if args.world_size <= 1:
+        return [_rng_state(False)]
+    states: list = [None] * args.world_size
+    torch.distributed.all_gather_object(states, _rng_state(True))
+    return states
+
+
+def checkpoint_step(path: Path) -> int:
+    return int(path.name.split("-", 1)[1])
+
+
+def list_checkpoints(output_dir: str | Path) -> list[Path]:
+    """Completed `checkpoint-<step>` directories under `output_dir`, oldest first."""
+    paths = [
+        p
+        for p in Path(output_dir).glob("checkpoint-*")
+        if p.is_dir() and p.name.split("-", 1)[1].isdigit() and (p / "trainer_state.json").exists()
+    ]
+    return sorted(paths, key=checkpoint_step)
+
+
+class AsyncCheckpointWriter:
+    """Snapshot Trainer state on the training thread and write it in the background.
+
+    At most one write is in flight: `save` waits for the previous one before reusing
+    the CPU buffers. A failed write is reported and leaves earlier checkpoints intact.
+    `on_saved` is called from the writer thread with each completed directory.
+    """
+
+    def __init__(
+        self,
+        output_dir: str | Path,
+        *,
+        base_model_id: str,
+        tokenizer=None,
+        keep: int = 2,
+        on_saved: Callable[[Path], None] | None = None,
+    ):
+        self.output_dir = Path(output_dir)
+        self.base_model_id = base_model_id
+        self.tokenizer = tokenizer
+        self.keep = keep
+        self.on_saved = on_saved
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ckpt")
+        self._pending: Future | None = None
+        self._buffers: dict = {}
+        self.saved: list[int] = []
+
+    def save(self, trainer, model, *, rng_states: list[dict] | None = None) -> None:
+        """Snapshot `trainer` and `model`; `rng_states` holds every process's state (`gather_rng_states`)."""
+        self.wait()
+        start = time.perf_counter()
+        step = int(trainer.state.global_step)
+        snapshot = {
+            "model": _to_cpu(model.state_dict(), self._buffers, ("model",)),
+            "optimizer": _to_cpu(trainer.optimizer.state_dict(), self._buffers, ("optimizer",)),
+            "scheduler": copy.deepcopy(trainer.lr_scheduler.state_dict()),
+            "rng": rng_states or [_rng_state(False)],
+            "trainer_state": copy.deepcopy(trainer.state),
+        }
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        print(f"[ckpt] step={step} snapshot in {time.perf_counter() - start:.2f}s")
+        self._pending = self._executor.submit(self._write, step, model, snapshot)
+
+    def _write(self, step: int, model, snapshot: dict) -> None:
+        start = time.perf_counter()
+        final_path = self.output_dir / f"checkpoint-{step}"
+        tmp_path = final_path.with_name(final_path.name + ".tmp")
+        try:
+            if tmp_path.exists():
+                shutil.rmtree(tmp_path)
+            write_raw_checkpoint(
+                tmp_path,
+                snapshot["model"],
+                model=model,
+                tokenizer=self.tokenizer,
+                meta={"base_model_id": self.base_model_id, "global_step": step},
+            )
+            torch.save(snapshot["optimizer"], tmp_path / "optimizer.pt")
+            torch.save(snapshot["scheduler"], tmp_path / "scheduler.pt")
+            # Trainer._load_rng_state reads rng_state_<process_index>.pth when distributed.
+            if len(snapshot["rng"]) == 1:
+                torch.save(snapshot["rng"][0], tmp_path / "rng_state.pth")
+            else:
+                for process_index, state in enumerate(snapshot["rng"]):
+                    torch.save(state, tmp_path / f"rng_state_{process_index}.pth")
+            snapshot["trainer_state"].save_to_json(str(tmp_path / "trainer_state.json"))
+            if final_path.exists():
+                shutil.rmtree(final_path)
+            tmp_path.rename(final_path)
+        except Exception as exc:
+            print(f"[warn] checkpoint step={step} failed: {type(exc).__name__}: {exc}")
+            return
+        self.saved.append(step)
+        for old in list_checkpoints(self.output_dir)[: -self.keep] if self.keep > 0 else []:
+            shutil.rmtree(old, ignore_errors=True)
+        print(f"[ckpt] step={step} wrote {final_path} in {time.perf_counter() - start:.1f}s")
+        if self.on_saved is not None:
+            self.on_saved(final_path)
+
+    def wait(self) -> None:
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    def close(self) -> None:
+        self.wait()
+        self._executor.shutdown()
+        self._buffers.clear()
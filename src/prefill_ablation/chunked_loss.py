@@ -0,0 +1,150 @@
+"""Chunked LM-head + cross-entropy loss that never materializes full logits.
+
+`ChunkedCausalLMLoss` is passed to the Trainer as `compute_loss_func`. While it is
+attached, a forward pre-hook asks the model for the last position's logits only
+(`logits_to_keep=1`) on calls without `labels`, and a forward hook on the decoder
+keeps its final hidden states. The loss then gathers the target positions, runs
+the LM head and an fp32 cross-entropy over `chunk_tokens` of them at a time, and
+recomputes each chunk's logits in backward, so at most one
+`[chunk_tokens, vocab]` block is alive instead of `[batch, seq, vocab]` plus its
+fp32 copy. Reduction matches the model's own loss: summed over target tokens
+and divided by `num_items_in_batch` when the Trainer passes it, else the mean.
+`chunked_loss_parity` checks exactly that against `model(labels=...)`.
+"""
+from __future__ import annotations
+
+import inspect
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+from prefill_ablation.utils import split_lm_head
+
+
+IGNORE_INDEX = -100
+
+
+def _logits_to_keep_kwarg(model: nn.Module) -> str | None:
+    parameters = inspect.signature(model.forward).parameters
+    # transformers renamed num_logits_to_keep -> logits_to_keep.
+    for name in ("logits_to_keep", "num_logits_to_keep"):
+        if name in parameters:
+            return name
+    return None
+
+
+class ChunkedCausalLMLoss:
+    """Trainer `compute_loss_func` computing the LM head and cross-entropy in chunks."""
+
+    def __init__(self, model: nn.Module, chunk_tokens: int):
+        if chunk_tokens < 1:
+            raise ValueError(f"chunk_tokens must be positive, got {chunk_tokens}")
+        split = split_lm_head(model)
+        if split is None:
+            raise ValueError("Chunked loss needs a model whose logits are a plain projection of the decoder output")
+        keep_kwarg = _logits_to_keep_kwarg(model)
+        if keep_kwarg is None:
+            raise ValueError("Chunked loss needs a model forward that accepts logits_to_keep")
+        self.decoder, self.lm_head = split
+        self.chunk_tokens = chunk_tokens
+        self._keep_kwarg = keep_kwarg
+        self._hidden: torch.Tensor | None = None
+        self._handles = [
+            model.register_forward_pre_hook(self._pre_hook, with_kwargs=True),
+            self.decoder.register_forward_hook(self._capture),
+        ]
+
+    def _pre_hook(self, module, args, kwargs):
+        # Calls with labels (or outside the Trainer loss) still get full logits.
+        if kwargs.get("labels") is None and self._keep_kwarg not in kwargs:
+            kwargs[self._keep_kwarg] = 1
+        return args, kwargs
+
+    def _capture(self, module, args, output):
+        self._hidden = output.last_hidden_state if hasattr(output, "last_hidden_state") else output[0]
+
+    def _chunk_loss(self, hidden: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
+        logits = self.lm_head(hidden).float()
+        return F.cross_entropy(logits, targets, ignore_index=IGNORE_INDEX, reduction="sum")
+
+    def __call__(self, outputs, labels: torch.Tensor, num_items_in_batch=None) -> torch.Tensor:
+        hidden, self._hidden = self._hidden, None
+        if hidden is None:
+            raise RuntimeError("Decoder hidden states were not captured; was the loss called after a model forward?")
+        labels = labels.to(hidden.device)
+        # Position t predicts token t + 1, as in the model's shifted loss.
+        shift_hidden = hidden[:, :-1, :].reshape(-1, hidden.shape[-1])
+        shift_labels = labels[:, 1:].reshape(-1)
+        positions = (shift_labels != IGNORE_INDEX).nonzero().squeeze(1)
+        shift_hidden = shift_hidden.index_select(0, positions)
+        shift_labels = shift_labels.index_select(0, positions)
+
+        total = hidden.new_zeros((), dtype=torch.float32)
+        for start in range(0, shift_labels.numel(), self.chunk_tokens):
+            chunk = slice(start, start + self.chunk_tokens)
+            if torch.is_grad_enabled() and shift_hidden.requires_grad:
+                total = total + checkpoint(self._chunk_loss, shift_hidden[chunk], shift_labels[chunk], use_reentrant=False)
+            else:
+                total = total + self._chunk_loss(shift_hidden[chunk], shift_labels[chunk])
+
+        if num_items_in_batch is None:
+            return total / max(shift_labels.numel(), 1)
+        if torch.is_tensor(num_items_in_batch):
+            num_items_in_batch = num_items_in_batch.to(total.device)
+        return total / num_items_in_batch
+
+    def remove(self) -> None:
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self._hidden = None
+
+
+def _grad_snapshot(model: nn.Module) -> dict[str, torch.Tensor]:
+    grads = {}
+    for name, module in (("lm_head", model.get_output_embeddings()), ("embed_tokens", model.get_input_embeddings())):
+        grad = module.weight.grad
+        grads[name] = grad.detach().float().clone() if grad is not None else torch.zeros(())
+    return grads
+
+
+def chunked_loss_parity(
+    model: nn.Module,
+    batch: dict,
+    chunk_tokens: int,
+    *,
+    num_items_in_batch: int | None = None,
+) -> dict[str, float]:
+    """Relative error of the chunked loss and the lm_head/embedding grads vs. `model(labels=...)`.
+
+    `batch` holds `input_ids`, `labels` and optionally `attention_mask`. Gradients
+    on the model are overwritten.
+    """
+    inputs = {k: v for k, v in batch.items() if k != "labels"}
+    extra = {} if num_items_in_batch is None else {"num_items_in_batch": num_items_in_batch}
+
+    model.zero_grad(set_to_none=True)
+    reference = model(**inputs, labels=batch["labels"], use_cache=False, **extra).loss
+    reference.backward()
+    reference_grads = _grad_snapshot(model)
+
+    loss_fn = ChunkedCausalLMLoss(model, chunk_tokens)
+    try:
+        model.zero_grad(set_to_none=True)
+        outputs = model(**inputs, use_cache=False)
+        chunked = loss_fn(outputs, batch["labels"], num_items_in_batch)
+        chunked.backward()
+        chunked_grads = _grad_snapshot(model)
+    finally:
+        loss_fn.remove()
+        model.zero_grad(set_to_none=True)
+
+    def relative(a: torch.Tensor, b: torch.Tensor) -> float:
+        return float((a.float() - b.float()).abs().max() / b.float().abs().max().clamp_min(1e-12))
+
+    report = {"loss": relative(chunked.detach(), reference.detach())}
+    for name, grad in reference_grads.items():
+        report[f"{name}_grad"] = relative(chunked_grads[name], grad)
+    return report
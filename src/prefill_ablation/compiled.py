@@ -0,0 +1,155 @@
+"""torch.compile wrappers for the scoring and training forwards.
+
+The compiled path never relies on the forward patch: every attention mode reaches
+the model as an explicit 4D mask built outside the compiled region, so causal and
+ablated runs trace the same graph and only new shapes compile. Callers pad to shape
+buckets (`bucket_length`, `bucket_rows`) to keep the number of shapes small.
+
+`CompiledForward` counts graphs handed to the backend:
+  compiles      graphs compiled on the first call of a shape bucket (for dynamo every
+                bucket after the first is a guard-failure recompile; these are expected)
+  recompiles    graphs compiled for a bucket that had already run (unexpected guard failures)
+and reads dynamo's own counters for what the backend never sees:
+  graph_breaks  graph breaks (`counters["graph_break"]`)
+  frames        frames dynamo tried to convert; `eager_frames` of them failed and ran
+                eagerly, e.g. after hitting the recompile limit
+  eager_buckets new shape buckets that ran without dynamo converting a frame or
+                compiling a graph (a code object dynamo has stopped compiling)
+
+Every bucket is its own static graph, so the recompile limits are raised to
+`max_buckets` (default 512) when the wrapper is created.
+"""
+from __future__ import annotations
+
+from dataclasses import asdict, dataclass, field
+
+import torch
+from torch import nn
+
+
+def bucket_length(length: int, multiple: int) -> int:
+    if multiple <= 1:
+        return length
+    return -(-length // multiple) * multiple
+
+
+def bucket_rows(rows: int) -> int:
+    return 1 << max(rows - 1, 0).bit_length()
+
+
+@dataclass
+class CompileStats:
+    calls: int = 0
+    compiles: int = 0
+    recompiles: int = 0
+    graph_breaks: int = 0
+    frames: int = 0
+    eager_frames: int = 0
+    eager_buckets: int = 0
+    buckets: dict[str, int] = field(default_factory=dict)
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+def _raise_recompile_limits(max_buckets: int) -> None:
+    config = torch._dynamo.config
+    # torch renamed cache_size_limit -> recompile_limit; the old names are aliases.
+    for name in ("recompile_limit", "cache_size_limit"):
+        if hasattr(config, name):
+            setattr(config, name, max(getattr(config, name), max_buckets))
+            break
+    for name in ("accumulated_recompile_limit", "accumulated_cache_size_limit"):
+        if hasattr(config, name):
+            setattr(config, name, max(getattr(config, name), max_buckets))
+            break
+
+
+def _dynamo_counts() -> tuple[int, int, int]:
+    counters = torch._dynamo.utils.counters
+    return counters["frames"]["total"], counters["frames"]["ok"], sum(counters["graph_break"].values())
+
+
+def _shape_key(args, kwargs) -> str:
+    parts = []
+    for name, value in [(str(i), v) for i, v in enumerate(args)] + sorted(kwargs.items()):
+        if torch.is_tensor(value):
+            parts.append(f"{name}={tuple(value.shape)}:{value.dtype}")
+        elif value is None or isinstance(value, (bool, int, float, str)):
+            parts.append(f"{name}={value!r}")
+        else:
+            parts.append(f"{name}:{type(value).__name__}")
+    return ",".join(parts)
+
+
+class CompiledForward:
+    """Call `fn` (a module or bound forward) through torch.compile and count compilations."""
+
+    def __init__(self, fn, *, backend: str = "inductor", max_buckets: int = 512):
+        _raise_recompile_limits(max_buckets)
+        self.stats = CompileStats()
+        self._backend = torch._dynamo.lookup_backend(backend)
+        self._compiled = torch.compile(fn, backend=self._count_and_compile, dynamic=False)
+        self._seen: set[str] = set()
+        self._first_call = False
+        self._graphs_this_call = 0
+
+    def _count_and_compile(self, gm: torch.fx.GraphModule, example_inputs):
+        self._graphs_this_call += 1
+        if self._first_call:
+            self.stats.compiles += 1
+        else:
+            self.stats.recompiles += 1
+        return self._backend(gm, example_inputs)
+
+    def __call__(self, *args, **kwargs):
+        key = _shape_key(args, kwargs)
+        self.stats.calls += 1
+        self.stats.buckets[key] = self.stats.buckets.get(key, 0) + 1
+        self._first_call = key not in self._seen
+        self._graphs_this_call = 0
+        frames, frames_ok, graph_breaks = _dynamo_counts()
+        try:
+            return self._compiled(*args, **kwargs)
+        finally:
+            self._seen.add(key)
+            after = _dynamo_counts()
+            self.stats.frames += after[0] - frames
+            self.stats.eager_frames += (after[0] - frames) - (after[1] - frames_ok)
+            self.stats.graph_breaks += after[2] - graph_breaks
+            if self._first_call and self._graphs_this_call == 0 and after[0] == frames:
+                self.stats.eager_buckets += 1
+
+
+class CompiledScoring:
+    """Compiled full-model and decoder-only forwards used by the batched MCQ scorer."""
+
+    def __init__(self, model: nn.Module, *, bucket: int = 64, backend: str = "inductor"):
+        self.bucket = bucket
+        self._backend = backend
+        self.model = CompiledForward(model, backend=backend)
+        self._decoder: CompiledForward | None = None
+        self._decoder_module: nn.Module | None = None
+
+    def decoder(self, module: nn.Module) -> CompiledForward:
+        if self._decoder is None or self._decoder_module is not module:
+            self._decoder = CompiledForward(module, backend=self._backend)
+            self._decoder_module = module
+        return self._decoder
+
+    def stats(self) -> dict:
+        stats = {"model": self.model.stats.as_dict()}
+        if self._decoder is not None:
+            stats["decoder"] = self._decoder.stats.as_dict()
+        return stats
+
+
+def enable_compiled_scoring(model: nn.Module, *, bucket: int = 64, backend: str = "inductor") -> CompiledScoring:
+    """Route batched MCQ scoring of `model` through torch.compile with padded shape buckets."""
+    scoring = CompiledScoring(model, bucket=bucket, backend=backend)
+    setattr(model, "_compiled_scoring", scoring)
+    return scoring
+
+
+def compiled_scoring(model: nn.Module) -> CompiledScoring | None:
+    return getattr(model, "_compiled_scoring", None)
@@ -2,16 +2,53 @@ from __future__ import annotations
 
 import argparse
 import json
-from dataclasses import dataclass
+import math
+import multiprocessing
+import os
+import random
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
 from pathlib import Path
+from statistics import NormalDist
 from typing import Callable, Iterable
 
 import torch
 from datasets import load_dataset
 from tqdm import tqdm
+from transformers import DynamicCache
 
-from prefill_ablation.attention_ablation import apply_prefill_bidirectional_patch
-from prefill_ablation.utils import load_model_and_tokenizer, set_seed
+from prefill_ablation.attention_ablation import (
+    ATTENTION_MODES,
+    BLOCK_ABLATION_MODES,
+    ROW_ATTENTION_MODES,
+    apply_attention_mode,
+    block_ablation_mask,
+    block_ablation_spec,
+    build_prefix_lm_mask,
+    build_row_mode_mask,
+    is_layer_ablation_active,
+    is_prefill_bidirectional_active,
+    is_prefix_lm_active,
+    parse_attention_mode,
+    uses_explicit_attention_mask,
+)
+from prefill_ablation.compiled import (
+    CompiledScoring,
+    bucket_length,
+    bucket_rows,
+    compiled_scoring,
+    enable_compiled_scoring,
+)
+from prefill_ablation.eval_packs import (
+    EvalPack,
+    open_eval_pack,
+    pack_path,
+    tokenizer_fingerprint,
+    write_eval_pack,
+)
+from prefill_ablation.score_cache import ScoreCache, score_cache_key, weights_fingerprint
+from prefill_ablation.utils import load_model_and_tokenizer, load_tokenizer, set_seed, split_lm_head
 
 
 @dataclass
@@ -98,35 +135,782 @@ TASKS: dict[str, TaskSpec] = {
 }
 
 
-def sequence_logprob(model, tokenizer, prompt: str, continuation: str, length_normalize: bool) -> float:
-    prompt_ids = tokenizer(prompt, add_special_tokens=False).input_ids
-    full_ids = tokenizer(prompt + continuation, add_special_tokens=False).input_ids
-
-    if len(full_ids) <= len(prompt_ids):
-        return float("-inf")
-
+def _model_device(model) -> torch.device:
     model_device = getattr(model, "device", None)
     if model_device is None:
         model_device = next(model.parameters()).device
+    return model_device
 
-    input_ids = torch.tensor([full_ids], dtype=torch.long, device=model_device)
 
+def _mask_dtype(model) -> torch.dtype:
+    dtype = next(model.parameters()).dtype
+    return dtype if dtype.is_floating_point else torch.float32
+
+
+def _encode_choice(tokenizer, prompt: str, continuation: str) -> tuple[list[int], int]:
+    prompt_ids = tokenizer(prompt, add_special_tokens=False).input_ids
+    full_ids = tokenizer(prompt + continuation, add_special_tokens=False).input_ids
+    return full_ids, len(prompt_ids)
+
+
+def _selected_logits(
+    model,
+    rows,
+    positions,
+    *,
+    continuation_logits: bool,
+    compiled: CompiledScoring | None = None,
+    **model_kwargs,
+):
+    """Run a forward pass and return logits only at `(rows, positions)`, plus the KV cache.
+
+    With `continuation_logits` the LM head runs on the selected hidden states only, so
+    the full `[batch, seq, vocab]` logits tensor is never materialized. With `compiled`
+    the forward goes through its torch.compile wrappers.
+    """
+    split = split_lm_head(model) if continuation_logits else None
     with torch.no_grad():
-        logits = model(input_ids=input_ids, use_cache=False).logits
+        if split is None:
+            out = (compiled.model if compiled is not None else model)(**model_kwargs)
+            return out.logits[rows, positions], getattr(out, "past_key_values", None)
+        decoder, lm_head = split
+        out = (compiled.decoder(decoder) if compiled is not None else decoder)(**model_kwargs)
+        return lm_head(out.last_hidden_state[rows, positions]), getattr(out, "past_key_values", None)
 
-    logits = logits[:, :-1, :]
-    targets = input_ids[:, 1:]
-    log_probs = torch.log_softmax(logits, dim=-1)
 
-    start = max(len(prompt_ids) - 1, 0)
-    token_log_probs = log_probs[:, start:, :].gather(-1, targets[:, start:].unsqueeze(-1)).squeeze(-1)
+def _gathered_logprobs(logits: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
+    return torch.log_softmax(logits, dim=-1).gather(-1, targets.unsqueeze(-1)).squeeze(-1)
 
+
+def _reduce_logprobs(token_log_probs: torch.Tensor, length_normalize: bool) -> float:
     total = float(token_log_probs.sum().item())
     if length_normalize:
         total /= max(int(token_log_probs.numel()), 1)
     return total
 
 
+def sequence_logprob(
+    model,
+    tokenizer,
+    prompt: str,
+    continuation: str,
+    length_normalize: bool,
+    *,
+    continuation_logits: bool = False,
+) -> float:
+    full_ids, prompt_len = _encode_choice(tokenizer, prompt, continuation)
+    return token_logprob(
+        model, full_ids, prompt_len, length_normalize=length_normalize, continuation_logits=continuation_logits
+    )
+
+
+def token_logprob(
+    model,
+    full_ids: list[int],
+    prompt_len: int,
+    *,
+    length_normalize: bool,
+    continuation_logits: bool = False,
+) -> float:
+    """`sequence_logprob` on already tokenized input: one unpadded forward for one choice."""
+    if len(full_ids) <= prompt_len:
+        return float("-inf")
+
+    input_ids = torch.tensor([full_ids], dtype=torch.long, device=_model_device(model))
+
+    model_kwargs = {}
+    if uses_explicit_attention_mask(model):
+        # Passed explicitly because the continuation-logits path calls the decoder directly.
+        model_kwargs["attention_mask"] = _scoring_attention_mask(
+            model, [len(full_ids)], [prompt_len], dtype=_mask_dtype(model), device=input_ids.device
+        )
+
+    start = max(prompt_len - 1, 0)
+    positions = torch.arange(start, len(full_ids) - 1, device=input_ids.device)
+    logits, _ = _selected_logits(
+        model,
+        0,
+        positions,
+        continuation_logits=continuation_logits,
+        input_ids=input_ids,
+        use_cache=False,
+        **model_kwargs,
+    )
+    return _reduce_logprobs(_gathered_logprobs(logits, input_ids[0, positions + 1]), length_normalize)
+
+
+@dataclass
+class ScoreRequest:
+    example_index: int
+    choice_index: int
+    input_ids: list[int]
+    prompt_len: int
+    # Per-row attention mode (see `ROW_ATTENTION_MODES`); None follows the model's mode.
+    attention_mode: str | None = None
+
+
+def build_score_requests(tokenizer, examples: list[Example]) -> list[ScoreRequest]:
+    requests = []
+    for example_index, ex in enumerate(examples):
+        for choice_index, choice in enumerate(ex.choices):
+            full_ids, prompt_len = _encode_choice(tokenizer, ex.prompt, choice)
+            requests.append(
+                ScoreRequest(
+                    example_index=example_index,
+                    choice_index=choice_index,
+                    input_ids=full_ids,
+                    prompt_len=prompt_len,
+                )
+            )
+    return requests
+
+
+def length_bucketed_batches(requests: list[ScoreRequest], max_batch_tokens: int) -> list[list[ScoreRequest]]:
+    """Group requests into padded batches of similar length.
+
+    Requests are sorted longest-first so each batch pads to its first element, and a
+    batch is closed once `rows * padded_len` would exceed `max_batch_tokens`. A single
+    request longer than the budget still gets its own batch.
+    """
+    ordered = sorted(requests, key=lambda r: len(r.input_ids), reverse=True)
+    batches: list[list[ScoreRequest]] = []
+    current: list[ScoreRequest] = []
+    padded_len = 0
+    for request in ordered:
+        if current and (len(current) + 1) * padded_len > max_batch_tokens:
+            batches.append(current)
+            current = []
+        if not current:
+            padded_len = len(request.input_ids)
+        current.append(request)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _shard_batches(batches: list, shard: tuple[int, int] | None) -> list:
+    # Batches are formed over the full request list before sharding, so every batch
+    # is identical to the single-process run and scores merge bit-for-bit.
+    if shard is None:
+        return batches
+    index, count = shard
+    return batches[index::count]
+
+
+def _initial_scores(requests: list[ScoreRequest]) -> list[float | None]:
+    return [float("-inf") if len(r.input_ids) <= r.prompt_len else None for r in requests]
+
+
+def _batch_attention_mask(
+    lengths: list[int],
+    max_len: int,
+    *,
+    bidirectional: bool,
+    dtype: torch.dtype,
+    device: torch.device,
+    prefix_lengths: list[int] | None = None,
+) -> torch.Tensor:
+    # Explicit 4D additive mask for right-padded rows. The prefill patch only flips
+    # `is_causal`, which attention backends ignore once a mask is passed, so the
+    # bidirectional case has to be spelled out here to match the unpadded path.
+    positions = torch.arange(max_len, device=device)
+    lengths_t = torch.tensor(lengths, device=device)
+    if prefix_lengths is not None:
+        return build_prefix_lm_mask(
+            positions[None, :] < lengths_t[:, None],
+            torch.tensor(prefix_lengths, device=device),
+            max_len,
+            dtype=dtype,
+        )
+    allowed = positions[None, None, :] < lengths_t[:, None, None]
+    if bidirectional:
+        allowed = allowed.expand(-1, max_len, -1)
+    else:
+        allowed = allowed & (positions[None, None, :] <= positions[None, :, None])
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=device)
+    mask.masked_fill_(~allowed, torch.finfo(dtype).min)
+    return mask.unsqueeze(1)
+
+
+def _scoring_attention_mask(
+    model,
+    lengths: list[int],
+    prompt_lengths: list[int],
+    *,
+    dtype: torch.dtype,
+    device: torch.device,
+    row_modes: list[str | None] | None = None,
+    max_len: int | None = None,
+):
+    """Attention mask for right-padded scoring rows under the model's current attention mode."""
+    max_len = max_len or max(lengths)
+    if row_modes is not None and any(mode is not None for mode in row_modes):
+        positions = torch.arange(max_len, device=device)
+        return build_row_mode_mask(
+            positions[None, :] < torch.tensor(lengths, device=device)[:, None],
+            [mode or "causal" for mode in row_modes],
+            max_len,
+            prompt_lengths=prompt_lengths,
+            dtype=dtype,
+        )
+    if block_ablation_spec(model) is not None:
+        positions = torch.arange(max_len, device=device)
+        key_padding_mask = positions[None, :] < torch.tensor(lengths, device=device)[:, None]
+        return block_ablation_mask(model, key_padding_mask, max_len)
+    # Single-token rows are decode-shaped for the prefill patch, hence causal.
+    return _batch_attention_mask(
+        lengths,
+        max_len,
+        bidirectional=is_prefill_bidirectional_active(model) and max_len > 1,
+        dtype=dtype,
+        device=device,
+        prefix_lengths=prompt_lengths if is_prefix_lm_active(model) else None,
+    )
+
+
+def score_requests_batched(
+    model,
+    tokenizer,
+    requests: list[ScoreRequest],
+    *,
+    length_normalize: bool,
+    max_batch_tokens: int,
+    continuation_logits: bool = False,
+    shard: tuple[int, int] | None = None,
+    on_batch: Callable[[list[ScoreRequest], list[float]], None] | None = None,
+    desc: str | None = None,
+) -> list[float | None]:
+    """Score requests in padded, length-bucketed batches; returns scores in input order.
+
+    With `shard=(index, count)` only every count-th batch starting at `index` is
+    scored and the remaining scorable requests come back as None.
+    """
+    device = _model_device(model)
+    dtype = _mask_dtype(model)
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    compiled = compiled_scoring(model)
+
+    positions = {id(request): idx for idx, request in enumerate(requests)}
+    scores = _initial_scores(requests)
+
+    scorable = [r for r in requests if len(r.input_ids) > r.prompt_len]
+    batches = _shard_batches(length_bucketed_batches(scorable, max_batch_tokens), shard)
+    for batch in tqdm(batches, desc=desc, disable=desc is None):
+        lengths = [len(r.input_ids) for r in batch]
+        max_len = max(lengths)
+        filler = 0
+        if compiled is not None:
+            # Pad to a shape bucket so compiled graphs are reused. Filler rows hold one
+            # pad token, which keeps every mask row non-empty.
+            max_len = bucket_length(max_len, compiled.bucket)
+            filler = bucket_rows(len(batch)) - len(batch)
+        input_ids = torch.full((len(batch) + filler, max_len), pad_id, dtype=torch.long)
+        for row, request in enumerate(batch):
+            input_ids[row, : lengths[row]] = torch.tensor(request.input_ids, dtype=torch.long)
+        input_ids = input_ids.to(device)
+
+        attention_mask = _scoring_attention_mask(
+            model,
+            lengths + [1] * filler,
+            [r.prompt_len for r in batch] + [0] * filler,
+            dtype=dtype,
+            device=device,
+            row_modes=[r.attention_mode for r in batch] + [None] * filler,
+            max_len=max_len,
+        )
+
+        rows: list[int] = []
+        token_positions: list[int] = []
+        counts: list[int] = []
+        for row, request in enumerate(batch):
+            span = range(max(request.prompt_len - 1, 0), lengths[row] - 1)
+            rows.extend([row] * len(span))
+            token_positions.extend(span)
+            counts.append(len(span))
+        rows_t = torch.tensor(rows, device=device)
+        positions_t = torch.tensor(token_positions, device=device)
+
+        logits, _ = _selected_logits(
+            model,
+            rows_t,
+            positions_t,
+            continuation_logits=continuation_logits,
+            compiled=compiled,
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            use_cache=False,
+        )
+        token_log_probs = _gathered_logprobs(logits, input_ids[rows_t, positions_t + 1])
+        for request, chunk in zip(batch, token_log_probs.split(counts)):
+            scores[positions[id(request)]] = _reduce_logprobs(chunk, length_normalize)
+        if on_batch is not None:
+            on_batch(batch, [scores[positions[id(request)]] for request in batch])
+
+    return scores
+
+
+def score_requests_mixed(
+    model,
+    tokenizer,
+    requests: list[ScoreRequest],
+    *,
+    modes: list[str],
+    length_normalize: bool,
+    max_batch_tokens: int,
+    continuation_logits: bool = False,
+    desc: str | None = None,
+) -> dict[str, list[float | None]]:
+    """Score every request under every mode in shared batches, each row with its own mask.
+
+    All modes' copies go through one length-bucketed pass instead of one pass per
+    mode; copies of a request sort next to each other but a batch boundary can still
+    split them. The model itself must be in causal mode.
+    """
+    if uses_explicit_attention_mask(model) or is_prefill_bidirectional_active(model) or is_layer_ablation_active(model):
+        raise RuntimeError("Mixed-mode scoring sets the attention mode per row; remove the model-wide ablation first")
+    for mode in modes:
+        if mode not in ROW_ATTENTION_MODES:
+            raise ValueError(f"Attention mode {mode} cannot be set per row. Available: {list(ROW_ATTENTION_MODES)}")
+    tagged = [replace(request, attention_mode=mode) for request in requests for mode in modes]
+    scores = score_requests_batched(
+        model,
+        tokenizer,
+        tagged,
+        length_normalize=length_normalize,
+        max_batch_tokens=max_batch_tokens,
+        continuation_logits=continuation_logits,
+        desc=desc,
+    )
+    return {mode: scores[index :: len(modes)] for index, mode in enumerate(modes)}
+
+
+def _shared_prefix_len(requests: list[ScoreRequest]) -> int:
+    # Longest prefix every choice can take from the prompt cache: bounded by the prompt
+    # (tokenization may merge across the prompt/continuation boundary), by the common
+    # token prefix, and by leaving at least one continuation token to feed per choice.
+    shared = min(min(r.prompt_len, len(r.input_ids) - 1) for r in requests)
+    first = requests[0].input_ids
+    for request in requests[1:]:
+        limit = min(shared, len(request.input_ids))
+        idx = 0
+        while idx < limit and request.input_ids[idx] == first[idx]:
+            idx += 1
+        shared = idx
+    return max(shared, 0)
+
+
+def _prompt_cache_batches(
+    groups: list[tuple[int, list[ScoreRequest]]],
+    max_batch_tokens: int,
+) -> list[list[tuple[int, list[ScoreRequest]]]]:
+    # Budget both forwards: prompts padded to the longest prefix, and one row per
+    # choice padded to the longest continuation.
+    ordered = sorted(groups, key=lambda g: g[0], reverse=True)
+    batches: list[list[tuple[int, list[ScoreRequest]]]] = []
+    current: list[tuple[int, list[ScoreRequest]]] = []
+    prefix_len = rows = suffix_len = 0
+    for shared, requests in ordered:
+        group_suffix = max(len(r.input_ids) - shared for r in requests)
+        if current:
+            next_rows = rows + len(requests)
+            next_suffix = max(suffix_len, group_suffix)
+            if (len(current) + 1) * prefix_len > max_batch_tokens or next_rows * next_suffix > max_batch_tokens:
+                batches.append(current)
+                current = []
+        if not current:
+            prefix_len, rows, suffix_len = shared, 0, 0
+        current.append((shared, requests))
+        rows += len(requests)
+        suffix_len = max(suffix_len, group_suffix)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _cached_suffix_attention_mask(
+    prefix_lengths: list[int],
+    suffix_lengths: list[int],
+    prefix_width: int,
+    suffix_width: int,
+    *,
+    dtype: torch.dtype,
+    device: torch.device,
+) -> torch.Tensor:
+    # Keys are [padded prefix cache | padded suffix]; each suffix row sees its own
+    # prompt prefix and, causally, its own continuation tokens.
+    keys = torch.arange(prefix_width + suffix_width, device=device)
+    queries = torch.arange(suffix_width, device=device)
+    prefix_t = torch.tensor(prefix_lengths, device=device)[:, None, None]
+    suffix_t = torch.tensor(suffix_lengths, device=device)[:, None, None]
+    in_prefix = keys[None, None, :] < prefix_t
+    suffix_pos = keys[None, None, :] - prefix_width
+    in_suffix = (suffix_pos >= 0) & (suffix_pos < suffix_t) & (suffix_pos <= queries[None, :, None])
+    allowed = in_prefix | in_suffix
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=device)
+    mask.masked_fill_(~allowed, torch.finfo(dtype).min)
+    return mask.unsqueeze(1)
+
+
+def score_requests_prompt_cached(
+    model,
+    tokenizer,
+    requests: list[ScoreRequest],
+    *,
+    length_normalize: bool,
+    max_batch_tokens: int,
+    continuation_logits: bool = False,
+    shard: tuple[int, int] | None = None,
+    on_batch: Callable[[list[ScoreRequest], list[float]], None] | None = None,
+    desc: str | None = None,
+) -> list[float | None]:
+    """Score requests by prefilling each shared prompt once and reusing its KV cache.
+
+    Falls back to `score_requests_batched` when the prefill patch, a block ablation, a
+    layer ablation or per-row modes are in play, since ablated prompt states depend on
+    the continuation that follows them, and under compiled scoring. Under the
+    prefix-LM mode the prompt is prefilled bidirectionally and the cache is reused,
+    for examples whose whole prompt is a shared token prefix of every choice.
+    """
+    if (
+        is_prefill_bidirectional_active(model)
+        or block_ablation_spec(model) is not None
+        or is_layer_ablation_active(model)
+        or any(request.attention_mode is not None for request in requests)
+        or compiled_scoring(model) is not None
+    ):
+        return score_requests_batched(
+            model,
+            tokenizer,
+            requests,
+            length_normalize=length_normalize,
+            max_batch_tokens=max_batch_tokens,
+            continuation_logits=continuation_logits,
+            shard=shard,
+            on_batch=on_batch,
+            desc=desc,
+        )
+
+    device = _model_device(model)
+    dtype = _mask_dtype(model)
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+
+    positions = {id(request): idx for idx, request in enumerate(requests)}
+    scores = _initial_scores(requests)
+
+    by_example: dict[int, list[ScoreRequest]] = {}
+    for request in requests:
+        if len(request.input_ids) > request.prompt_len:
+            by_example.setdefault(request.example_index, []).append(request)
+
+    groups: list[tuple[int, list[ScoreRequest]]] = []
+    uncached: list[ScoreRequest] = []
+    prefix_lm = is_prefix_lm_active(model)
+    for group in by_example.values():
+        shared = _shared_prefix_len(group)
+        if prefix_lm and any(shared != r.prompt_len for r in group):
+            # The bidirectional block must be exactly the cached prompt.
+            uncached.extend(group)
+        elif shared > 0:
+            groups.append((shared, group))
+        else:
+            uncached.extend(group)
+
+    if uncached:
+        for request, score in zip(
+            uncached,
+            score_requests_batched(
+                model,
+                tokenizer,
+                uncached,
+                length_normalize=length_normalize,
+                max_batch_tokens=max_batch_tokens,
+                continuation_logits=continuation_logits,
+                shard=shard,
+                on_batch=on_batch,
+            ),
+        ):
+            scores[positions[id(request)]] = score
+
+    batches = _shard_batches(_prompt_cache_batches(groups, max_batch_tokens), shard)
+    for batch in tqdm(batches, desc=desc, disable=desc is None):
+        prefix_lengths = [shared for shared, _ in batch]
+        prefix_width = max(prefix_lengths)
+        prefix_ids = torch.full((len(batch), prefix_width), pad_id, dtype=torch.long)
+        for row, (shared, group) in enumerate(batch):
+            prefix_ids[row, :shared] = torch.tensor(group[0].input_ids[:shared], dtype=torch.long)
+        prefix_ids = prefix_ids.to(device)
+
+        batch_rows = torch.arange(len(batch), device=device)
+        last_logits, cache = _selected_logits(
+            model,
+            batch_rows,
+            torch.tensor(prefix_lengths, device=device) - 1,
+            continuation_logits=continuation_logits,
+            input_ids=prefix_ids,
+            attention_mask=_batch_attention_mask(
+                prefix_lengths, prefix_width, bidirectional=prefix_lm, dtype=dtype, device=device
+            ),
+            past_key_values=DynamicCache(),
+            use_cache=True,
+        )
+
+        rows = [(group_row, shared, request) for group_row, (shared, group) in enumerate(batch) for request in group]
+        suffix_lengths = [len(request.input_ids) - shared for _, shared, request in rows]
+        suffix_width = max(suffix_lengths)
+        suffix_ids = torch.full((len(rows), suffix_width), pad_id, dtype=torch.long)
+        for row, (_, shared, request) in enumerate(rows):
+            suffix_ids[row, : suffix_lengths[row]] = torch.tensor(request.input_ids[shared:], dtype=torch.long)
+        suffix_ids = suffix_ids.to(device)
+        row_prefix = [shared for _, shared, _ in rows]
+        position_ids = torch.tensor(row_prefix, device=device)[:, None] + torch.arange(suffix_width, device=device)
+
+        # Suffix position j predicts input_ids[shared + j + 1]; scoring starts at
+        # input_ids[prompt_len], which the prompt cache's last logits predict when
+        # the whole prompt is shared.
+        select_rows: list[int] = []
+        select_positions: list[int] = []
+        counts: list[int] = []
+        for row, (_, shared, request) in enumerate(rows):
+            span = range(max(request.prompt_len - shared - 1, 0), suffix_lengths[row] - 1)
+            select_rows.extend([row] * len(span))
+            select_positions.extend(span)
+            counts.append(len(span))
+
+        cache.batch_select_indices(torch.tensor([group_row for group_row, _, _ in rows], device=device))
+        suffix_logits, _ = _selected_logits(
+            model,
+            torch.tensor(select_rows, device=device, dtype=torch.long),
+            torch.tensor(select_positions, device=device, dtype=torch.long),
+            continuation_logits=continuation_logits,
+            input_ids=suffix_ids,
+            attention_mask=_cached_suffix_attention_mask(
+                row_prefix, suffix_lengths, prefix_width, suffix_width, dtype=dtype, device=device
+            ),
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True,
+        )
+
+        for row, ((group_row, shared, request), chunk) in enumerate(zip(rows, suffix_logits.split(counts))):
+            start = request.prompt_len - shared
+            logits = chunk
+            if start == 0:
+                logits = torch.cat([last_logits[group_row : group_row + 1], chunk], dim=0)
+            targets = suffix_ids[row, start : suffix_lengths[row]]
+            scores[positions[id(request)]] = _reduce_logprobs(
+                _gathered_logprobs(logits, targets), length_normalize
+            )
+
+        if on_batch is not None:
+            on_batch([request for _, _, request in rows], [scores[positions[id(request)]] for _, _, request in rows])
+
+        del cache, last_logits, suffix_logits
+
+    return scores
+
+
+def _max_score_diff(scores: list[float | None], reference: list[float]) -> float:
+    diffs = [
+        abs(score - ref) if math.isfinite(ref) else float(score != ref)
+        for score, ref in zip(scores, reference)
+    ]
+    return max(diffs, default=0.0)
+
+
+def check_scoring_parity(
+    model,
+    tokenizer,
+    requests: list[ScoreRequest],
+    *,
+    modes: list[str],
+    length_normalize: bool,
+    max_batch_tokens: int,
+) -> dict[str, dict[str, float]]:
+    """Max absolute score difference of each fast scorer vs. one unpadded forward per choice.
+
+    Per mode, the reference is `token_logprob` with full logits; the batched and
+    prompt-cached scorers run with and without continuation logits, and the modes
+    that can be set per row are also scored together by `score_requests_mixed`.
+    """
+    kwargs = {"length_normalize": length_normalize, "max_batch_tokens": max_batch_tokens}
+    report: dict[str, dict[str, float]] = {}
+    references: dict[str, list[float]] = {}
+    for mode in modes:
+        patch = apply_attention_mode(model, _scoring_mode(model, mode), verbose=False)
+        try:
+            reference = [
+                token_logprob(model, r.input_ids, r.prompt_len, length_normalize=length_normalize) for r in requests
+            ]
+            references[mode] = reference
+            report[mode] = {}
+            for continuation_logits in (False, True):
+                suffix = "_continuation_logits" if continuation_logits else ""
+                scorers = (("batched", score_requests_batched), ("prompt_cached", score_requests_prompt_cached))
+                for name, score_fn in scorers:
+                    scores = score_fn(model, tokenizer, requests, continuation_logits=continuation_logits, **kwargs)
+                    report[mode][name + suffix] = _max_score_diff(scores, reference)
+        finally:
+            if patch is not None:
+                patch.remove()
+
+    row_modes = [mode for mode in modes if mode in ROW_ATTENTION_MODES]
+    if len(row_modes) > 1:
+        mixed = score_requests_mixed(model, tokenizer, requests, modes=row_modes, continuation_logits=True, **kwargs)
+        for mode in row_modes:
+            report[mode]["mixed"] = _max_score_diff(mixed[mode], references[mode])
+    return report
+
+
+def _scoring_mode(model, mode: str) -> str:
+    # The forward patch flips module flags inside the graph, which breaks compiled
+    # graphs. Batches carry explicit masks, so its mask-native twin scores the same.
+    if mode == "prefill_bidirectional" and compiled_scoring(model) is not None:
+        return "prefill_bidirectional_mask"
+    return mode
+
+
+def _score_missing(
+    score_fn,
+    model,
+    tokenizer,
+    requests: list[ScoreRequest],
+    *,
+    score_cache: ScoreCache | None,
+    **kwargs,
+) -> list[float | None]:
+    """Run `score_fn` only on requests absent from `score_cache`, streaming new scores into it."""
+    if score_cache is None:
+        return score_fn(model, tokenizer, requests, **kwargs)
+    scores = score_cache.lookup(requests)
+    missing = [idx for idx, score in enumerate(scores) if score is None]
+    print(f"[cache] {len(requests) - len(missing)}/{len(requests)} scores cached at {score_cache.path}")
+    if missing:
+        computed = score_fn(
+            model,
+            tokenizer,
+            [requests[idx] for idx in missing],
+            on_batch=score_cache.record,
+            **kwargs,
+        )
+        for idx, score in zip(missing, computed):
+            scores[idx] = score
+    return scores
+
+
+def open_score_caches(
+    root: str,
+    model,
+    tokenizer,
+    *,
+    modes: list[str],
+    length_normalize: bool,
+    session_id: str,
+    rank: int = 0,
+    meta: dict | None = None,
+) -> dict[str, ScoreCache]:
+    # Fingerprint before any attention patch is applied; the patch changes behaviour,
+    # which the mode name in the key already covers.
+    weights = weights_fingerprint(model)
+    tokenizer_fp = tokenizer_fingerprint(tokenizer)
+    caches = {}
+    for mode in modes:
+        key = score_cache_key(
+            weights=weights,
+            tokenizer=tokenizer_fp,
+            attention_mode=mode,
+            length_normalize=length_normalize,
+        )
+        caches[mode] = ScoreCache(
+            root,
+            key,
+            session_id=session_id,
+            rank=rank,
+            meta={
+                **(meta or {}),
+                "weights_fingerprint": weights,
+                "tokenizer_fingerprint": tokenizer_fp,
+                "attention_mode": mode,
+                "length_normalize": length_normalize,
+            },
+        )
+    return caches
+
+
+def build_eval_pack(tokenizer, task: TaskSpec, *, split: str, pack_root: str) -> EvalPack:
+    examples = list(task.loader(split))
+    requests = build_score_requests(tokenizer, examples)
+    fingerprint = tokenizer_fingerprint(tokenizer)
+    return write_eval_pack(
+        pack_path(pack_root, task.name, split, fingerprint),
+        ((r.example_index, r.choice_index, r.input_ids, r.prompt_len) for r in requests),
+        [ex.label for ex in examples],
+        meta={
+            "task": task.name,
+            "split": split,
+            "tokenizer_fingerprint": fingerprint,
+            "tokenizer_name": getattr(tokenizer, "name_or_path", None),
+        },
+    )
+
+
+def load_pack_requests(
+    tokenizer,
+    task: TaskSpec,
+    *,
+    split: str,
+    limit: int,
+    pack_root: str,
+) -> tuple[list[ScoreRequest], list[int]]:
+    path = pack_path(pack_root, task.name, split, tokenizer_fingerprint(tokenizer))
+    if not (path / "meta.json").exists():
+        raise RuntimeError(
+            f"No eval pack for task={task.name} split={split} at {path}; "
+            "build it with `prefill-eval --build-packs --pack-dir ...` using the same tokenizer"
+        )
+    pack = open_eval_pack(path)
+    rows = pack.request_rows(limit)
+    requests = [
+        ScoreRequest(
+            example_index=int(example_index),
+            choice_index=int(choice_index),
+            input_ids=pack.token_ids(int(offset), int(length)),
+            prompt_len=int(prompt_len),
+        )
+        for example_index, choice_index, offset, length, prompt_len in rows
+    ]
+    num_examples = pack.num_examples if limit <= 0 else min(limit, pack.num_examples)
+    return requests, [int(x) for x in pack.labels[:num_examples]]
+
+
+@dataclass
+class TaskData:
+    labels: list[int]
+    examples: list[Example] | None = None
+    requests: list[ScoreRequest] | None = None
+
+
+def prepare_task(
+    tokenizer,
+    task: TaskSpec,
+    *,
+    split: str,
+    limit: int,
+    max_batch_tokens: int = 0,
+    pack_root: str | None = None,
+    build_requests: bool = False,
+) -> TaskData:
+    """Load (and tokenize, unless read from a pack) a task once for any number of scoring passes."""
+    if pack_root:
+        requests, labels = load_pack_requests(tokenizer, task, split=split, limit=limit, pack_root=pack_root)
+        return TaskData(labels=labels, requests=requests)
+
+    examples = list(task.loader(split))
+    if limit > 0:
+        examples = examples[:limit]
+    requests = build_score_requests(tokenizer, examples) if build_requests or max_batch_tokens > 0 else None
+    return TaskData(labels=[ex.label for ex in examples], examples=examples, requests=requests)
+
+
 def evaluate_task(
     model,
     tokenizer,
@@ -136,39 +920,393 @@ def evaluate_task(
     limit: int,
     length_normalize: bool,
     log_every: int,
+    max_batch_tokens: int = 0,
+    prompt_cache: bool = False,
+    continuation_logits: bool = False,
+    pack_root: str | None = None,
+    data: TaskData | None = None,
+    keep_per_example: bool = False,
+    request_scores: list[float] | None = None,
+    score_cache: ScoreCache | None = None,
 ):
-    examples = list(task.loader(split))
-    if limit > 0:
-        examples = examples[:limit]
+    if data is None:
+        data = prepare_task(
+            tokenizer,
+            task,
+            split=split,
+            limit=limit,
+            max_batch_tokens=max_batch_tokens,
+            pack_root=pack_root,
+        )
+    examples, labels, requests = data.examples, data.labels, data.requests
+
+    batched_scores: list[list[float]] | None = None
+    if requests is not None:
+        # A non-positive budget still works here: every request gets its own batch.
+        score_fn = score_requests_prompt_cached if prompt_cache else score_requests_batched
+        flat_scores = request_scores if request_scores is not None else _score_missing(
+            score_fn,
+            model,
+            tokenizer,
+            requests,
+            score_cache=score_cache,
+            length_normalize=length_normalize,
+            max_batch_tokens=max_batch_tokens,
+            continuation_logits=continuation_logits,
+            desc=task.name,
+        )
+        batched_scores = [[] for _ in labels]
+        for request, score in zip(requests, flat_scores):
+            batched_scores[request.example_index].append(score)
 
     correct = 0
     total = 0
     mean_choice_count = 0.0
+    per_example_correct: list[int] = []
 
-    for idx, ex in enumerate(tqdm(examples, desc=task.name), start=1):
-        scores = [
-            sequence_logprob(model, tokenizer, ex.prompt, choice, length_normalize=length_normalize)
-            for choice in ex.choices
-        ]
+    for idx, label in enumerate(tqdm(labels, desc=task.name, disable=batched_scores is not None), start=1):
+        if batched_scores is not None:
+            scores = batched_scores[idx - 1]
+        else:
+            ex = examples[idx - 1]
+            scores = [
+                sequence_logprob(
+                    model,
+                    tokenizer,
+                    ex.prompt,
+                    choice,
+                    length_normalize=length_normalize,
+                    continuation_logits=continuation_logits,
+                )
+                for choice in ex.choices
+            ]
         pred = int(torch.tensor(scores).argmax().item())
-        correct += int(pred == ex.label)
+        correct += int(pred == label)
+        per_example_correct.append(int(pred == label))
         total += 1
-        mean_choice_count += len(ex.choices)
+        mean_choice_count += len(scores)
 
         if log_every > 0 and idx % log_every == 0:
             print(
-                f"[eval] task={task.name} step={idx}/{len(examples)} "
+                f"[eval] task={task.name} step={idx}/{len(labels)} "
                 f"acc_so_far={correct / max(total, 1):.4f}"
             )
 
     accuracy = correct / max(total, 1)
     chance = 1.0 / max(mean_choice_count / max(total, 1), 1.0)
-    return {
+    metrics = {
         "task": task.name,
         "total": total,
         "accuracy": accuracy,
         "chance": chance,
     }
+    if keep_per_example:
+        metrics["per_example_correct"] = per_example_correct
+    return metrics
+
+
+@dataclass
+class ShardJob:
+    rank: int
+    num_shards: int
+    device: str
+    cpu_ids: list[int] | None
+    model_id: str
+    dtype: str
+    attn_implementation: str
+    trust_remote_code: bool
+    seed: int
+    modes: list[str]
+    tasks: list[tuple[str, list[ScoreRequest]]]
+    length_normalize: bool
+    max_batch_tokens: int
+    prompt_cache: bool
+    continuation_logits: bool
+    score_cache_dir: str | None = None
+    session_id: str = ""
+    compile_bucket: int = 0
+
+
+def _shard_placements(num_workers: int) -> list[tuple[str, list[int] | None]]:
+    # One worker per GPU (round-robin if there are more workers than GPUs); on CPU,
+    # split the allowed cores into contiguous groups so workers keep their own caches.
+    if torch.cuda.is_available() and torch.cuda.device_count() > 0:
+        count = torch.cuda.device_count()
+        return [(f"cuda:{rank % count}", None) for rank in range(num_workers)]
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    per_worker = max(len(cpus) // num_workers, 1)
+    return [
+        ("cpu", cpus[rank * per_worker : (rank + 1) * per_worker] or cpus[-per_worker:])
+        for rank in range(num_workers)
+    ]
+
+
+def _score_shard(job: ShardJob) -> dict[tuple[str, str], list[float | None]]:
+    if job.cpu_ids:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, job.cpu_ids)
+        torch.set_num_threads(len(job.cpu_ids))
+    set_seed(job.seed)
+
+    model, tokenizer = load_model_and_tokenizer(
+        job.model_id,
+        dtype=job.dtype,
+        attn_implementation=job.attn_implementation,
+        trust_remote_code=job.trust_remote_code,
+        device_map=job.device,
+    )
+    model.eval()
+    if job.compile_bucket > 0:
+        enable_compiled_scoring(model, bucket=job.compile_bucket)
+
+    caches: dict[str, ScoreCache] = {}
+    if job.score_cache_dir:
+        caches = open_score_caches(
+            job.score_cache_dir,
+            model,
+            tokenizer,
+            modes=job.modes,
+            length_normalize=job.length_normalize,
+            session_id=job.session_id,
+            rank=job.rank,
+            meta={"model_id": job.model_id},
+        )
+
+    score_fn = score_requests_prompt_cached if job.prompt_cache else score_requests_batched
+    out: dict[tuple[str, str], list[float | None]] = {}
+    for task_name, requests in job.tasks:
+        for mode in job.modes:
+            patch = apply_attention_mode(model, _scoring_mode(model, mode), verbose=False)
+            try:
+                out[(task_name, mode)] = _score_missing(
+                    score_fn,
+                    model,
+                    tokenizer,
+                    requests,
+                    score_cache=caches.get(mode),
+                    length_normalize=job.length_normalize,
+                    max_batch_tokens=job.max_batch_tokens,
+                    continuation_logits=job.continuation_logits,
+                    shard=(job.rank, job.num_shards),
+                    desc=f"{task_name}/{mode}[{job.rank}]",
+                )
+            finally:
+                if patch is not None:
+                    patch.remove()
+    if compiled_scoring(model) is not None:
+        print(f"[compile] rank={job.rank} {json.dumps(compiled_scoring(model).stats())}")
+    return out
+
+
+def score_tasks_sharded(jobs: list[ShardJob]) -> dict[tuple[str, str], list[float]]:
+    """Run `jobs` in spawned worker processes and merge their shards by request index."""
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=len(jobs), mp_context=ctx) as pool:
+        shard_results = list(pool.map(_score_shard, jobs))
+
+    merged: dict[tuple[str, str], list[float]] = {}
+    for key in shard_results[0]:
+        columns = zip(*(result[key] for result in shard_results))
+        merged_scores = []
+        for idx, candidates in enumerate(columns):
+            owned = [score for score in candidates if score is not None]
+            if not owned:
+                raise RuntimeError(f"Request {idx} of {key} was not scored by any shard")
+            merged_scores.append(owned[0])
+        merged[key] = merged_scores
+    return merged
+
+
+def _z_value(confidence: float) -> float:
+    return NormalDist().inv_cdf(0.5 + confidence / 2.0)
+
+
+def wilson_interval(correct: int, total: int, *, confidence: float = 0.95) -> tuple[float, float]:
+    if total <= 0:
+        return 0.0, 1.0
+    z = _z_value(confidence)
+    p = correct / total
+    denom = 1.0 + z * z / total
+    center = (p + z * z / (2 * total)) / denom
+    half = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total)) / denom
+    return max(center - half, 0.0), min(center + half, 1.0)
+
+
+def paired_difference_interval(
+    reference_correct: list[int],
+    correct: list[int],
+    *,
+    confidence: float = 0.95,
+) -> tuple[float, float]:
+    """Interval on accuracy(correct) - accuracy(reference_correct) over paired examples.
+
+    Uses the Agresti-Min adjusted Wald interval (half a count added to each cell of
+    the 2x2 agreement table), which stays non-degenerate when no pair disagrees.
+    """
+    pairs = list(zip(reference_correct, correct))
+    if not pairs:
+        return -1.0, 1.0
+    reference_only = sum(1 for a, b in pairs if a and not b) + 0.5
+    mode_only = sum(1 for a, b in pairs if b and not a) + 0.5
+    n = len(pairs) + 2.0
+    diff = (mode_only - reference_only) / n
+    var = ((reference_only + mode_only) - (mode_only - reference_only) ** 2 / n) / (n * n)
+    half = _z_value(confidence) * math.sqrt(max(var, 0.0))
+    return max(diff - half, -1.0), min(diff + half, 1.0)
+
+
+def evaluate_task_adaptive(
+    model,
+    tokenizer,
+    task: TaskSpec,
+    *,
+    data: TaskData,
+    modes: list[str],
+    length_normalize: bool,
+    target_width: float,
+    confidence: float = 0.95,
+    chunk_examples: int = 50,
+    min_examples: int = 100,
+    seed: int = 42,
+    max_batch_tokens: int = 0,
+    prompt_cache: bool = False,
+    continuation_logits: bool = False,
+    score_caches: dict[str, ScoreCache] | None = None,
+) -> dict[str, dict]:
+    """Score examples in a seeded random order until the intervals are narrow enough.
+
+    With one mode the stopping rule uses the Wilson interval on accuracy; with several
+    it uses the paired-difference interval of every mode against the first, so all
+    modes are scored on the same examples, chunk by chunk.
+    """
+    if data.requests is None:
+        raise ValueError("Adaptive evaluation needs tokenized score requests")
+    by_example: dict[int, list[ScoreRequest]] = {}
+    for request in data.requests:
+        by_example.setdefault(request.example_index, []).append(request)
+
+    order = list(range(len(data.labels)))
+    random.Random(seed).shuffle(order)
+    score_fn = score_requests_prompt_cached if prompt_cache else score_requests_batched
+    score_caches = score_caches or {}
+
+    correct: dict[str, list[int]] = {mode: [] for mode in modes}
+    choice_counts: list[int] = []
+    widths: dict[str, float] = {}
+    stopped_early = False
+    for start in range(0, len(order), max(chunk_examples, 1)):
+        chunk = order[start : start + max(chunk_examples, 1)]
+        chunk_requests = [request for idx in chunk for request in by_example[idx]]
+        for mode in modes:
+            patch = apply_attention_mode(model, _scoring_mode(model, mode), verbose=False)
+            try:
+                flat_scores = _score_missing(
+                    score_fn,
+                    model,
+                    tokenizer,
+                    chunk_requests,
+                    score_cache=score_caches.get(mode),
+                    length_normalize=length_normalize,
+                    max_batch_tokens=max_batch_tokens,
+                    continuation_logits=continuation_logits,
+                )
+            finally:
+                if patch is not None:
+                    patch.remove()
+            chunk_scores: dict[int, list[float]] = {idx: [] for idx in chunk}
+            for request, score in zip(chunk_requests, flat_scores):
+                chunk_scores[request.example_index].append(score)
+            for idx in chunk:
+                pred = int(torch.tensor(chunk_scores[idx]).argmax().item())
+                correct[mode].append(int(pred == data.labels[idx]))
+        choice_counts.extend(len(by_example[idx]) for idx in chunk)
+
+        used = len(choice_counts)
+        if len(modes) == 1:
+            lo, hi = wilson_interval(sum(correct[modes[0]]), used, confidence=confidence)
+            widths = {modes[0]: hi - lo}
+        else:
+            widths = {}
+            for mode in modes[1:]:
+                lo, hi = paired_difference_interval(correct[modes[0]], correct[mode], confidence=confidence)
+                widths[mode] = hi - lo
+        print(
+            f"[adaptive] task={task.name} examples={used}/{len(order)} "
+            + " ".join(f"width[{mode}]={width:.4f}" for mode, width in widths.items())
+        )
+        if used >= min_examples and used < len(order) and all(w <= target_width for w in widths.values()):
+            stopped_early = True
+            break
+
+    used = len(choice_counts)
+    chance = 1.0 / max(sum(choice_counts) / max(used, 1), 1.0)
+    results = {}
+    for mode in modes:
+        lo, hi = wilson_interval(sum(correct[mode]), used, confidence=confidence)
+        results[mode] = {
+            "task": task.name,
+            "total": used,
+            "accuracy": sum(correct[mode]) / max(used, 1),
+            "chance": chance,
+            "accuracy_interval": [lo, hi],
+            "adaptive": {
+                "examples_available": len(order),
+                "stopped_early": stopped_early,
+                "target_width": target_width,
+                "confidence": confidence,
+            },
+            "per_example_correct": correct[mode],
+        }
+    return results
+
+
+def _mode_summary(mode: str, results: list[dict]) -> dict:
+    results = [{k: v for k, v in item.items() if k != "per_example_correct"} for item in results]
+    macro = sum(item["accuracy"] for item in results) / max(len(results), 1)
+    return {
+        "attention_mode": mode,
+        "prefill_bidirectional": mode.startswith("prefill_bidirectional"),
+        "tasks": results,
+        "macro_accuracy": macro,
+    }
+
+
+def paired_mode_summary(
+    results_by_mode: dict[str, list[dict]],
+    reference_mode: str,
+    *,
+    confidence: float = 0.95,
+) -> list[dict]:
+    """Compare each mode's per-example correctness against `reference_mode`, task by task."""
+    paired = []
+    for mode, results in results_by_mode.items():
+        if mode == reference_mode:
+            continue
+        for ref, other in zip(results_by_mode[reference_mode], results):
+            ref_correct = ref["per_example_correct"]
+            other_correct = other["per_example_correct"]
+            pairs = list(zip(ref_correct, other_correct))
+            paired.append(
+                {
+                    "task": ref["task"],
+                    "reference_mode": reference_mode,
+                    "mode": mode,
+                    "reference_accuracy": ref["accuracy"],
+                    "accuracy": other["accuracy"],
+                    "delta": other["accuracy"] - ref["accuracy"],
+                    "delta_interval": list(
+                        paired_difference_interval(ref_correct, other_correct, confidence=confidence)
+                    ),
+                    "both_correct": sum(1 for a, b in pairs if a and b),
+                    "reference_only_correct": sum(1 for a, b in pairs if a and not b),
+                    "mode_only_correct": sum(1 for a, b in pairs if b and not a),
+                    "neither_correct": sum(1 for a, b in pairs if not a and not b),
+                }
+            )
+    return paired
 
 
 def parse_args() -> argparse.Namespace:
@@ -186,8 +1324,102 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--attn-implementation", default="sdpa")
     parser.add_argument("--trust-remote-code", action="store_true")
     parser.add_argument("--prefill-bidirectional", action="store_true")
+    parser.add_argument(
+        "--attention-modes",
+        default=None,
+        help=(
+            f"Comma-separated attention modes to evaluate from one model load ({', '.join(ATTENTION_MODES)}, "
+            f"or {', '.join(m + ':<block size>' for m in BLOCK_ABLATION_MODES)}). "
+            "Defaults to prefill_bidirectional if --prefill-bidirectional is set, else causal"
+        ),
+    )
     parser.add_argument("--length-normalize", action="store_true")
     parser.add_argument("--log-every", type=int, default=50)
+    parser.add_argument(
+        "--max-batch-tokens",
+        type=int,
+        default=8192,
+        help="Padded-token budget per scoring batch. <=0 scores one choice per forward pass",
+    )
+    parser.add_argument(
+        "--prompt-cache",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Prefill each prompt once and score choices against its KV cache (causal mode only)",
+    )
+    parser.add_argument(
+        "--continuation-logits",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Apply the LM head only at scored continuation positions instead of the full sequence",
+    )
+    parser.add_argument(
+        "--pack-dir",
+        default=None,
+        help="Root of pre-tokenized eval packs. When set, tasks are read from packs instead of HF datasets",
+    )
+    parser.add_argument(
+        "--build-packs",
+        action="store_true",
+        help="Tokenize the full split of each task into --pack-dir and exit without loading the model",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Run batched scoring through torch.compile, padding batches to shape buckets",
+    )
+    parser.add_argument(
+        "--compile-bucket",
+        type=int,
+        default=64,
+        help="With --compile, pad sequence lengths to a multiple of this (rows pad to a power of two)",
+    )
+    parser.add_argument(
+        "--mixed-mode-batches",
+        action="store_true",
+        help=(
+            "With several per-row capable attention modes "
+            f"({', '.join(ROW_ATTENTION_MODES)}), score all of them in shared batches with a mask per row"
+        ),
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=1,
+        help="Shard scoring across this many processes (one per GPU, or per CPU core group without CUDA)",
+    )
+    parser.add_argument(
+        "--score-cache-dir",
+        default=None,
+        help="Stream per-choice scores into a content-addressed cache here and reuse them on reruns",
+    )
+    parser.add_argument(
+        "--adaptive-ci-width",
+        type=float,
+        default=0.0,
+        help=(
+            "Stop a task early once the accuracy interval (or, with several attention modes, the paired "
+            "difference interval against the first mode) is at most this wide. 0 disables"
+        ),
+    )
+    parser.add_argument("--adaptive-confidence", type=float, default=0.95)
+    parser.add_argument("--adaptive-chunk", type=int, default=50, help="Examples scored between stopping checks")
+    parser.add_argument("--adaptive-min-examples", type=int, default=100)
+    parser.add_argument(
+        "--check-parity",
+        type=int,
+        default=0,
+        help=(
+            "Score the first N examples of each task with the batched, prompt-cached and mixed scorers and "
+            "with one forward per choice, print the largest score differences and exit. 0 disables"
+        ),
+    )
+    parser.add_argument(
+        "--parity-tolerance",
+        type=float,
+        default=1e-3,
+        help="Largest allowed score difference for --check-parity (tight checks want --dtype float32)",
+    )
     parser.add_argument("--output-json", default="artifacts/eval/latest.json")
     return parser.parse_args()
 
@@ -196,45 +1428,238 @@ def main() -> None:
     args = parse_args()
     set_seed(args.seed)
 
-    model, tokenizer = load_model_and_tokenizer(
-        args.model_id,
-        dtype=args.dtype,
-        attn_implementation=args.attn_implementation,
-        trust_remote_code=args.trust_remote_code,
-        device_map="auto",
-    )
-    model.eval()
-
-    patch = None
-    if args.prefill_bidirectional:
-        patch = apply_prefill_bidirectional_patch(model)
-
     selected_tasks = []
     for name in [x.strip() for x in args.tasks.split(",") if x.strip()]:
         if name not in TASKS:
             raise ValueError(f"Unknown task: {name}. Available: {sorted(TASKS)}")
         selected_tasks.append(TASKS[name])
 
-    results = []
+    if args.build_packs:
+        if not args.pack_dir:
+            raise ValueError("--build-packs requires --pack-dir")
+        tokenizer = load_tokenizer(args.model_id, trust_remote_code=args.trust_remote_code)
+        for task in selected_tasks:
+            pack = build_eval_pack(tokenizer, task, split=args.split, pack_root=args.pack_dir)
+            print(
+                f"[pack] task={task.name} split={args.split} examples={pack.num_examples} "
+                f"tokens={pack.meta['num_tokens']} -> {pack.path}"
+            )
+        return
+
+    if args.attention_modes:
+        modes = [x.strip() for x in args.attention_modes.split(",") if x.strip()]
+    else:
+        modes = ["prefill_bidirectional" if args.prefill_bidirectional else "causal"]
+    for mode in modes:
+        parse_attention_mode(mode)
+    duplicates = sorted({mode for mode in modes if modes.count(mode) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate attention modes: {duplicates}")
+    paired = len(modes) > 1
+    adaptive = args.adaptive_ci_width > 0
+    if adaptive and args.num_workers > 1:
+        raise ValueError("--adaptive-ci-width needs a single process; drop --num-workers")
+    if args.compile and args.max_batch_tokens <= 0:
+        raise ValueError("--compile needs batched scoring; set --max-batch-tokens > 0")
+    if args.check_parity > 0 and args.num_workers > 1:
+        raise ValueError("--check-parity needs a single process; drop --num-workers")
+
+    mixed = (
+        args.mixed_mode_batches
+        and paired
+        and not adaptive
+        and args.num_workers <= 1
+        and not args.score_cache_dir
+        and all(mode in ROW_ATTENTION_MODES for mode in modes)
+    )
+    if args.mixed_mode_batches and not mixed:
+        print("[eval] --mixed-mode-batches needs several row modes, one process, no score cache or adaptive stop; ignoring")
+
+    model = None
+    session_id = uuid.uuid4().hex[:12]
+    score_caches: dict[str, ScoreCache] = {}
+    task_data: dict[str, TaskData] = {}
+    sharded_scores: dict[tuple[str, str], list[float]] | None = None
+    if args.num_workers > 1:
+        # The parent only tokenizes; each worker loads its own model copy and scores
+        # an interleaved slice of the batches for every task and mode.
+        tokenizer = load_tokenizer(args.model_id, trust_remote_code=args.trust_remote_code)
+        for task in selected_tasks:
+            task_data[task.name] = prepare_task(
+                tokenizer,
+                task,
+                split=args.split,
+                limit=args.limit,
+                max_batch_tokens=args.max_batch_tokens,
+                pack_root=args.pack_dir,
+                build_requests=True,
+            )
+        placements = _shard_placements(args.num_workers)
+        print(f"[eval] sharding across {args.num_workers} workers: {[device for device, _ in placements]}")
+        jobs = [
+            ShardJob(
+                rank=rank,
+                num_shards=args.num_workers,
+                device=device,
+                cpu_ids=cpu_ids,
+                model_id=args.model_id,
+                dtype=args.dtype,
+                attn_implementation=args.attn_implementation,
+                trust_remote_code=args.trust_remote_code,
+                seed=args.seed,
+                modes=modes,
+                tasks=[(task.name, task_data[task.name].requests) for task in selected_tasks],
+                length_normalize=args.length_normalize,
+                max_batch_tokens=args.max_batch_tokens,
+                prompt_cache=args.prompt_cache,
+                continuation_logits=args.continuation_logits,
+                score_cache_dir=args.score_cache_dir,
+                session_id=session_id,
+                compile_bucket=args.compile_bucket if args.compile else 0,
+            )
+            for rank, (device, cpu_ids) in enumerate(placements)
+        ]
+        sharded_scores = score_tasks_sharded(jobs)
+    else:
+        model, tokenizer = load_model_and_tokenizer(
+            args.model_id,
+            dtype=args.dtype,
+            attn_implementation=args.attn_implementation,
+            trust_remote_code=args.trust_remote_code,
+            device_map="auto",
+        )
+        model.eval()
+        if args.compile:
+            enable_compiled_scoring(model, bucket=args.compile_bucket)
+        if args.score_cache_dir:
+            score_caches = open_score_caches(
+                args.score_cache_dir,
+                model,
+                tokenizer,
+                modes=modes,
+                length_normalize=args.length_normalize,
+                session_id=session_id,
+                meta={"model_id": args.model_id},
+            )
+
+    if args.check_parity > 0:
+        failed = []
+        for task in selected_tasks:
+            data = prepare_task(
+                tokenizer,
+                task,
+                split=args.split,
+                limit=args.check_parity,
+                pack_root=args.pack_dir,
+                build_requests=True,
+            )
+            report = check_scoring_parity(
+                model,
+                tokenizer,
+                data.requests,
+                modes=modes,
+                length_normalize=args.length_normalize,
+                max_batch_tokens=max(args.max_batch_tokens, 1),
+            )
+            for mode, diffs in report.items():
+                print(f"[parity] task={task.name} mode={mode} " + " ".join(f"{k}={v:.2e}" for k, v in diffs.items()))
+                failed.extend((task.name, mode, k) for k, v in diffs.items() if v > args.parity_tolerance)
+        if failed:
+            raise SystemExit(f"Scorers disagree with per-choice scoring beyond {args.parity_tolerance:g}: {failed}")
+        print("[parity] all scorers match per-choice scoring")
+        return
+
+    results_by_mode: dict[str, list[dict]] = {mode: [] for mode in modes}
     for task in selected_tasks:
-        metrics = evaluate_task(
-            model,
+        data = task_data.get(task.name) or prepare_task(
             tokenizer,
             task,
             split=args.split,
             limit=args.limit,
-            length_normalize=args.length_normalize,
-            log_every=args.log_every,
+            max_batch_tokens=args.max_batch_tokens,
+            pack_root=args.pack_dir,
+            build_requests=bool(score_caches) or adaptive or mixed,
         )
-        results.append(metrics)
+        mixed_scores = None
+        if mixed:
+            print(f"[eval] task={task.name} attention_modes={','.join(modes)} (mixed batches)")
+            mixed_scores = score_requests_mixed(
+                model,
+                tokenizer,
+                data.requests,
+                modes=modes,
+                length_normalize=args.length_normalize,
+                max_batch_tokens=args.max_batch_tokens,
+                continuation_logits=args.continuation_logits,
+                desc=task.name,
+            )
+        if adaptive:
+            adaptive_results = evaluate_task_adaptive(
+                model,
+                tokenizer,
+                task,
+                data=data,
+                modes=modes,
+                length_normalize=args.length_normalize,
+                target_width=args.adaptive_ci_width,
+                confidence=args.adaptive_confidence,
+                chunk_examples=args.adaptive_chunk,
+                min_examples=args.adaptive_min_examples,
+                seed=args.seed,
+                max_batch_tokens=args.max_batch_tokens,
+                prompt_cache=args.prompt_cache,
+                continuation_logits=args.continuation_logits,
+                score_caches=score_caches,
+            )
+            for mode in modes:
+                results_by_mode[mode].append(adaptive_results[mode])
+            continue
+        for mode in modes:
+            if mixed_scores is not None:
+                request_scores = mixed_scores[mode]
+            elif sharded_scores is not None:
+                request_scores = sharded_scores[(task.name, mode)]
+            else:
+                request_scores = None
+            print(f"[eval] task={task.name} attention_mode={mode}")
+            patch = (
+                apply_attention_mode(model, _scoring_mode(model, mode))
+                if model is not None and mixed_scores is None
+                else None
+            )
+            try:
+                metrics = evaluate_task(
+                    model,
+                    tokenizer,
+                    task,
+                    split=args.split,
+                    limit=args.limit,
+                    length_normalize=args.length_normalize,
+                    log_every=args.log_every,
+                    max_batch_tokens=args.max_batch_tokens,
+                    prompt_cache=args.prompt_cache,
+                    continuation_logits=args.continuation_logits,
+                    data=data,
+                    keep_per_example=paired,
+                    request_scores=request_scores,
+                    score_cache=score_caches.get(mode),
+                )
+            finally:
+                if patch is not None:
+                    patch.remove()
+            results_by_mode[mode].append(metrics)
 
-    macro = sum(item["accuracy"] for item in results) / max(len(results), 1)
-    summary = {
-        "model_id": args.model_id,
-        "prefill_bidirectional": args.prefill_bidirectional,
-        "tasks": results,
-        "macro_accuracy": macro,
-    }
+    if paired:
+        summary = {
+            "model_id": args.model_id,
+            "attention_modes": modes,
+            "modes": {mode: _mode_summary(mode, results_by_mode[mode]) for mode in modes},
+            "paired": paired_mode_summary(results_by_mode, modes[0], confidence=args.adaptive_confidence),
+        }
+    else:
+        summary = {"model_id": args.model_id, **_mode_summary(modes[0], results_by_mode[modes[0]])}
+    if model is not None and compiled_scoring(model) is not None:
+        summary["compile"] = compiled_scoring(model).stats()
 
     out_path = Path(args.output_json)
     out_path.parent.mkdir(parents=True, exist_ok=True)
@@ -242,9 +1667,6 @@ def main() -> None:
     print(f"[done] wrote metrics to {out_path}")
     print(json.dumps(summary, indent=2))
 
-    if patch is not None:
-        patch.remove()
-
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,133 @@
+"""Pre-tokenized MCQ eval packs.
+
+A pack stores one task split encoded with one tokenizer, so evaluation can run
+without dataset downloads or per-example tokenization:
+
+  tokens.npy    int32 token ids of every prompt+choice sequence, concatenated
+  requests.npy  int32 [n_requests, 5]: example, choice, offset, length, prompt_len
+  labels.npy    int32 gold choice index per example
+  meta.json     task, split, tokenizer fingerprint and counts
+
+Packs live at `<root>/<task>/<split>/<tokenizer_fingerprint>/` and are opened
+memory-mapped.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+
+PACK_FORMAT_VERSION = 1
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    digest = hashlib.sha256()
+    digest.update(type(tokenizer).__name__.encode())
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        digest.update(backend.to_str().encode())
+    else:
+        digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    digest.update(json.dumps(list(getattr(tokenizer, "all_special_tokens", []))).encode())
+    return digest.hexdigest()[:16]
+
+
+def pack_path(root: str | Path, task: str, split: str, fingerprint: str) -> Path:
+    return Path(root) / task / split / fingerprint
+
+
+@dataclass
+class EvalPack:
+    path: Path
+    tokens: np.ndarray
+    requests: np.ndarray
+    labels: np.ndarray
+    meta: dict
+
+    @property
+    def num_examples(self) -> int:
+        return int(self.labels.shape[0])
+
+    def request_rows(self, limit: int) -> np.ndarray:
+        """Request rows for the first `limit` examples (all examples if limit <= 0)."""
+        if limit <= 0 or limit >= self.num_examples:
+            return self.requests
+        end = int(np.searchsorted(self.requests[:, 0], limit, side="left"))
+        return self.requests[:end]
+
+    def token_ids(self, offset: int, length: int) -> list[int]:
+        return self.tokens[offset : offset + length].tolist()
+
+
+def write_eval_pack(
+    path: str | Path,
+    requests: Iterable[tuple[int, int, list[int], int]],
+    labels: list[int],
+    *,
+    meta: dict,
+) -> EvalPack:
+    """Write a pack from `(example_index, choice_index, input_ids, prompt_len)` tuples.
+
+    Requests must be ordered by example index. The pack is written to a sibling
+    temporary directory and renamed into place, so readers never see a partial pack.
+    """
+    path = Path(path)
+    token_chunks: list[np.ndarray] = []
+    rows: list[tuple[int, int, int, int, int]] = []
+    offset = 0
+    for example_index, choice_index, input_ids, prompt_len in requests:
+        token_chunks.append(np.asarray(input_ids, dtype=np.int32))
+        rows.append((example_index, choice_index, offset, len(input_ids), prompt_len))
+        offset += len(input_ids)
+
+    tokens = np.concatenate(token_chunks) if token_chunks else np.zeros((0,), dtype=np.int32)
+    request_array = np.asarray(rows, dtype=np.int32).reshape(-1, 5)
+    if request_array.shape[0] and np.any(np.diff(request_array[:, 0]) < 0):
+        raise ValueError("Eval pack requests must be ordered by example index")
+
+    tmp_path = path.with_name(path.name + ".tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+    np.save(tmp_path / "tokens.npy", tokens)
+    np.save(tmp_path / "requests.npy", request_array)
+    np.save(tmp_path / "labels.npy", np.asarray(labels, dtype=np.int32))
+    full_meta = {
+        "format_version": PACK_FORMAT_VERSION,
+        **meta,
+        "num_examples": len(labels),
+        "num_requests": int(request_array.shape[0]),
+        "num_tokens": int(tokens.shape[0]),
+    }
+    (tmp_path / "meta.json").write_text(json.dumps(full_meta, indent=2))
+
+    if path.exists():
+        shutil.rmtree(path)
+    tmp_path.rename(path)
+    return open_eval_pack(path)
+
+
+def open_eval_pack(path: str | Path) -> EvalPack:
+    path = Path(path)
+    meta_path = path / "meta.json"
+    if not meta_path.exists():
+        raise FileNotFoundError(f"No eval pack at {path}")
+    meta = json.loads(meta_path.read_text())
+    if meta.get("format_version") != PACK_FORMAT_VERSION:
+        raise RuntimeError(
+            f"Eval pack at {path} has format_version={meta.get('format_version')}, "
+            f"expected {PACK_FORMAT_VERSION}; rebuild it"
+        )
+    return EvalPack(
+        path=path,
+        tokens=np.load(path / "tokens.npy", mmap_mode="r"),
+        requests=np.load(path / "requests.npy", mmap_mode="r"),
+        labels=np.load(path / "labels.npy", mmap_mode="r"),
+        meta=meta,
+    )
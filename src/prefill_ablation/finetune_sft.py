@@ -1,14 +1,19 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
 import inspect
 import json
+import os
+import random
+import shutil
 import traceback
 from dataclasses import dataclass
 from pathlib import Path
 
 import torch
-from datasets import Dataset, DatasetDict, load_dataset
+from datasets import Dataset, DatasetDict, load_dataset, load_from_disk
+from torch.utils.data import DataLoader, Sampler
 from transformers import (
     AutoModelForCausalLM,
     AutoModelForImageTextToText,
@@ -18,8 +23,26 @@ from transformers import (
     TrainingArguments,
 )
 
-from prefill_ablation.attention_ablation import apply_prefill_bidirectional_patch
-from prefill_ablation.utils import parse_dtype, set_seed
+from prefill_ablation.attention_ablation import (
+    apply_document_mask,
+    apply_prefill_bidirectional_mask,
+    apply_prefill_bidirectional_patch,
+    apply_prefix_lm_mask,
+    prefill_patch_supported,
+)
+from prefill_ablation.artifacts import ArtifactSink, artifact_backend
+from prefill_ablation.checkpointing import (
+    RESUME_ONLY_FILES,
+    AsyncCheckpointWriter,
+    gather_rng_states,
+    list_checkpoints,
+    write_raw_checkpoint,
+)
+from prefill_ablation.chunked_loss import ChunkedCausalLMLoss
+from prefill_ablation.compiled import CompiledForward
+from prefill_ablation.step_profiler import StepProfilerCallback
+from prefill_ablation.eval_packs import tokenizer_fingerprint
+from prefill_ablation.utils import RAW_INDEX_NAME, load_sharded_state_dict_into, parse_dtype, set_seed
 
 
 def parse_args() -> argparse.Namespace:
@@ -27,9 +50,26 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--model-id", required=True, help="Base model id/path")
     parser.add_argument("--dataset-id", default="yahma/alpaca-cleaned")
     parser.add_argument("--dataset-config", default=None)
+    parser.add_argument("--dataset-revision", default=None, help="Dataset git revision (branch, tag or commit)")
     parser.add_argument("--output-dir", required=True)
 
     parser.add_argument("--max-seq-len", type=int, default=1024)
+    parser.add_argument(
+        "--pack-sequences",
+        action="store_true",
+        help="Pack several records into each max-seq-len row with per-document attention and positions",
+    )
+    parser.add_argument(
+        "--token-cache-dir",
+        default="artifacts/cache/sft_tokens",
+        help="Reuse tokenized splits keyed by dataset, tokenizer, template and max-seq-len. Empty disables",
+    )
+    parser.add_argument(
+        "--tokenize-num-proc",
+        type=int,
+        default=min(8, os.cpu_count() or 1),
+        help="Worker processes for tokenizing the SFT splits",
+    )
     parser.add_argument("--train-samples", type=int, default=50000)
     parser.add_argument("--eval-samples", type=int, default=1000)
 
@@ -37,6 +77,21 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--per-device-train-batch-size", type=int, default=1)
     parser.add_argument("--per-device-eval-batch-size", type=int, default=1)
     parser.add_argument("--gradient-accumulation-steps", type=int, default=16)
+    parser.add_argument(
+        "--max-tokens-per-batch",
+        type=int,
+        default=0,
+        help=(
+            "Fill each train micro-batch with length-grouped records up to this many padded tokens instead of "
+            "a fixed batch size. Loss is normalized by real target tokens across accumulation steps. 0 disables"
+        ),
+    )
+    parser.add_argument(
+        "--eval-max-tokens-per-batch",
+        type=int,
+        default=None,
+        help="Padded-token budget per eval batch. Defaults to --max-tokens-per-batch",
+    )
 
     parser.add_argument("--learning-rate", type=float, default=2e-5)
     parser.add_argument("--weight-decay", type=float, default=0.1)
@@ -48,6 +103,12 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--attn-implementation", default="sdpa")
     parser.add_argument("--trust-remote-code", action="store_true")
     parser.add_argument("--prefill-bidirectional-train", action="store_true")
+    parser.add_argument(
+        "--prefill-ablation-impl",
+        choices=["patch", "mask"],
+        default="patch",
+        help="How --prefill-bidirectional-train is applied: per-layer forward patch or one explicit 4D mask",
+    )
     parser.add_argument(
         "--prompt-bidir-response-causal-train",
         action="store_true",
@@ -57,9 +118,41 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--seed", type=int, default=42)
     parser.add_argument("--logging-steps", type=int, default=10)
     parser.add_argument("--eval-steps", type=int, default=100)
-    parser.add_argument("--save-steps", type=int, default=200)
+    parser.add_argument(
+        "--save-steps",
+        type=int,
+        default=200,
+        help="Write a resumable checkpoint-<step> in the background every N steps (last 2 kept). 0 disables",
+    )
+    parser.add_argument(
+        "--resume",
+        nargs="?",
+        const="latest",
+        default=None,
+        help="Resume from the latest checkpoint-<step> in --output-dir, or from the given checkpoint directory",
+    )
 
     parser.add_argument("--gradient-checkpointing", action="store_true")
+    parser.add_argument(
+        "--loss-chunk-tokens",
+        type=int,
+        default=0,
+        help=(
+            "Compute the LM head and cross-entropy over this many target tokens at a time instead of "
+            "materializing full [batch, seq, vocab] logits. 0 uses the model's own loss"
+        ),
+    )
+    parser.add_argument(
+        "--torch-compile",
+        action="store_true",
+        help="Compile the model forward; batches are padded to --compile-bucket multiples",
+    )
+    parser.add_argument("--compile-bucket", type=int, default=64)
+    parser.add_argument(
+        "--profile-jsonl",
+        default=None,
+        help="Append per-step timing, token and memory records to this JSONL file (synchronizes CUDA per phase)",
+    )
 
     parser.add_argument("--kill-after-steps", type=int, default=150)
     parser.add_argument("--min-loss-improvement", type=float, default=0.08)
@@ -82,10 +175,18 @@ def parse_args() -> argparse.Namespace:
         help="Do not apply eval-loss auto-stop before this global step.",
     )
 
+    parser.add_argument(
+        "--artifact-sink",
+        default=None,
+        help=(
+            "Upload checkpoints and the final model in the background while training runs: "
+            "local:<dir> or hub:<repo_id>. Skipped if not set."
+        ),
+    )
     parser.add_argument(
         "--hf-repo-id",
         default=None,
-        help="HuggingFace Hub repo to upload checkpoint to (e.g. user/repo). Skipped if not set.",
+        help="HuggingFace Hub repo to upload checkpoints to (e.g. user/repo). Same as --artifact-sink hub:<repo>",
     )
 
     return parser.parse_args()
@@ -117,12 +218,7 @@ def _format_alpaca_record(row: dict) -> tuple[str, str]:
     return prompt, output
 
 
-def _encode_record(row: dict, tokenizer, max_seq_len: int):
-    prompt, response = _format_alpaca_record(row)
-
-    prompt_ids = tokenizer(prompt, add_special_tokens=False).input_ids
-    response_ids = tokenizer(response + tokenizer.eos_token, add_special_tokens=False).input_ids
-
+def _assemble_record(prompt_ids: list[int], response_ids: list[int], max_seq_len: int) -> dict:
     input_ids = (prompt_ids + response_ids)[:max_seq_len]
     labels = ([-100] * len(prompt_ids) + response_ids)[:max_seq_len]
     prompt_len = min(len(prompt_ids), len(input_ids))
@@ -138,8 +234,161 @@ def _encode_record(row: dict, tokenizer, max_seq_len: int):
     }
 
 
-def _load_splits(dataset_id: str, dataset_config: str | None, seed: int) -> tuple[Dataset, Dataset]:
-    ds = load_dataset(dataset_id, dataset_config)
+def _encode_batch(batch: dict, tokenizer, max_seq_len: int) -> dict:
+    # One tokenizer call per field for the whole map batch; records whose response is
+    # truncated away are dropped here instead of in a separate filter pass.
+    rows = [dict(zip(batch, values)) for values in zip(*batch.values())]
+    pairs = [_format_alpaca_record(row) for row in rows]
+    prompt_ids = tokenizer([p for p, _ in pairs], add_special_tokens=False).input_ids
+    response_ids = tokenizer([r + tokenizer.eos_token for _, r in pairs], add_special_tokens=False).input_ids
+
+    encoded = {"input_ids": [], "labels": [], "attention_mask": [], "prompt_len": []}
+    for prompt, response in zip(prompt_ids, response_ids):
+        record = _assemble_record(prompt, response, max_seq_len)
+        if not record["input_ids"]:
+            continue
+        for key in encoded:
+            encoded[key].append(record[key])
+    return encoded
+
+
+# Bump when `_encode_batch` output changes so cached splits are rebuilt.
+TOKEN_CACHE_VERSION = 1
+_TEMPLATE_PROBES = (
+    {"instruction": "<instruction>", "input": "", "output": "<output>"},
+    {"instruction": "<instruction>", "input": "<input>", "output": "<output>"},
+)
+
+
+def token_cache_key(ds: Dataset, tokenizer, *, dataset_id: str, dataset_config, revision, max_seq_len: int) -> str:
+    """Key for a tokenized split.
+
+    `ds._fingerprint` covers the loaded data files and the shuffle/select applied to
+    them; the template is hashed through its rendering of fixed probe records, so an
+    edit to `_format_alpaca_record` changes the key.
+    """
+    payload = json.dumps(
+        {
+            "version": TOKEN_CACHE_VERSION,
+            "dataset": [dataset_id, dataset_config, revision, ds._fingerprint],
+            "tokenizer": tokenizer_fingerprint(tokenizer),
+            "eos_token": tokenizer.eos_token,
+            "template": [_format_alpaca_record(row) for row in _TEMPLATE_PROBES],
+            "max_seq_len": max_seq_len,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def _cached_split(path: Path | None, desc: str) -> Dataset | None:
+    if path is not None and (path / "dataset_info.json").exists():
+        print(f"[tokenize] {desc}: reusing {path}")
+        return load_from_disk(str(path))
+    return None
+
+
+def _save_split(ds: Dataset, path: Path | None, desc: str) -> Dataset:
+    if path is None:
+        return ds
+    # Written next to the final path and renamed, so an interrupted run never
+    # leaves a half-written split that a relaunch would pick up.
+    tmp_path = path.with_name(path.name + ".tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    ds.save_to_disk(str(tmp_path))
+    if path.exists():
+        shutil.rmtree(path)
+    tmp_path.rename(path)
+    print(f"[tokenize] {desc}: cached {len(ds)} records at {path}")
+    return load_from_disk(str(path))
+
+
+def _tokenize_split(
+    ds: Dataset,
+    tokenizer,
+    *,
+    max_seq_len: int,
+    num_proc: int,
+    cache_root: str | None,
+    key: str,
+    desc: str,
+) -> Dataset:
+    path = Path(cache_root) / key if cache_root else None
+    cached = _cached_split(path, desc)
+    if cached is not None:
+        return cached
+
+    encoded = ds.map(
+        _encode_batch,
+        fn_kwargs={"tokenizer": tokenizer, "max_seq_len": max_seq_len},
+        batched=True,
+        batch_size=1000,
+        num_proc=num_proc if num_proc > 1 and len(ds) > 1000 else None,
+        remove_columns=ds.column_names,
+        new_fingerprint=key,
+        desc=desc,
+    )
+    return _save_split(encoded, path, desc)
+
+
+def _pack_batch(batch: dict, max_seq_len: int) -> dict:
+    # First-fit decreasing within one map batch: each record goes into the first
+    # row that still has room, longest records first.
+    order = sorted(range(len(batch["input_ids"])), key=lambda i: len(batch["input_ids"][i]), reverse=True)
+    rows: list[list[int]] = []
+    room: list[int] = []
+    for i in order:
+        length = len(batch["input_ids"][i])
+        for row, free in enumerate(room):
+            if length <= free:
+                rows[row].append(i)
+                room[row] -= length
+                break
+        else:
+            rows.append([i])
+            room.append(max_seq_len - length)
+
+    packed = {"input_ids": [], "labels": [], "attention_mask": [], "doc_lengths": [], "doc_prompt_lens": []}
+    for members in rows:
+        input_ids: list[int] = []
+        labels: list[int] = []
+        for i in members:
+            input_ids.extend(batch["input_ids"][i])
+            # The first token of a document is never predicted from inside it.
+            labels.extend([-100] + batch["labels"][i][1:])
+        packed["input_ids"].append(input_ids)
+        packed["labels"].append(labels)
+        packed["attention_mask"].append([1] * len(input_ids))
+        packed["doc_lengths"].append([len(batch["input_ids"][i]) for i in members])
+        packed["doc_prompt_lens"].append([batch["prompt_len"][i] for i in members])
+    return packed
+
+
+def _pack_records(ds: Dataset, max_seq_len: int, *, cache_root: str | None, key: str, desc: str) -> Dataset:
+    # `key` is the split's token cache key, which already covers max_seq_len.
+    packed_key = f"{key}-packed"
+    path = Path(cache_root) / packed_key if cache_root else None
+    cached = _cached_split(path, desc)
+    if cached is not None:
+        return cached
+
+    packed = ds.map(
+        _pack_batch,
+        fn_kwargs={"max_seq_len": max_seq_len},
+        batched=True,
+        batch_size=1000,
+        remove_columns=ds.column_names,
+        new_fingerprint=packed_key,
+        desc=desc,
+    )
+    return _save_split(packed, path, desc)
+
+
+def _load_splits(
+    dataset_id: str, dataset_config: str | None, seed: int, revision: str | None = None
+) -> tuple[Dataset, Dataset]:
+    ds = load_dataset(dataset_id, dataset_config, revision=revision)
 
     if isinstance(ds, DatasetDict):
         if "train" in ds:
@@ -163,23 +412,59 @@ def _load_splits(dataset_id: str, dataset_config: str | None, seed: int) -> tupl
 
 
 class SupervisedDataCollator:
+    """Pads records into a batch.
+
+    With `use_prefix_lm_mask` the batch carries per-row `prefix_lengths` next to the
+    2D padding mask; the model expands them into the prefix-LM mask on device (see
+    `apply_prefix_lm_mask`), so collation stays O(batch) and no L x L mask is copied.
+
+    With `document_attention` ("causal", "bidirectional" or "prefix_lm") records are
+    packed rows from `_pack_records`; the batch carries per-token `document_ids`,
+    `prefix_ends` and restarting `position_ids` for `apply_document_mask`.
+    """
+
     def __init__(
         self,
         tokenizer,
         *,
         use_prefix_lm_mask: bool = False,
-        mask_dtype: torch.dtype = torch.bfloat16,
+        pad_to_multiple_of: int | None = None,
+        document_attention: str | None = None,
     ):
+        if document_attention not in (None, "causal", "bidirectional", "prefix_lm"):
+            raise ValueError(f"Unknown document attention: {document_attention}")
         self.tokenizer = tokenizer
         self.use_prefix_lm_mask = use_prefix_lm_mask
-        self.mask_dtype = mask_dtype
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.document_attention = document_attention
+
+    def _document_tensors(self, features: list[dict], max_len: int) -> dict:
+        shape = (len(features), max_len)
+        document_ids = torch.full(shape, -1, dtype=torch.long)
+        prefix_ends = torch.zeros(shape, dtype=torch.long)
+        position_ids = torch.zeros(shape, dtype=torch.long)
+        for row, feat in enumerate(features):
+            start = 0
+            for doc, (length, prompt_len) in enumerate(zip(feat["doc_lengths"], feat["doc_prompt_lens"])):
+                end = start + length
+                if self.document_attention == "bidirectional":
+                    prefix_end = end
+                elif self.document_attention == "prefix_lm":
+                    prefix_end = start + min(prompt_len, length)
+                else:
+                    prefix_end = start
+                document_ids[row, start:end] = doc
+                prefix_ends[row, start:end] = prefix_end
+                position_ids[row, start:end] = torch.arange(length)
+                start = end
+        return {"document_ids": document_ids, "prefix_ends": prefix_ends, "position_ids": position_ids}
 
     def __call__(self, features: list[dict]):
         input_features = [
             {"input_ids": x["input_ids"], "attention_mask": x["attention_mask"]}
             for x in features
         ]
-        batch = self.tokenizer.pad(input_features, return_tensors="pt")
+        batch = self.tokenizer.pad(input_features, return_tensors="pt", pad_to_multiple_of=self.pad_to_multiple_of)
 
         max_len = batch["input_ids"].shape[1]
         labels = torch.full((len(features), max_len), fill_value=-100, dtype=torch.long)
@@ -189,32 +474,174 @@ class SupervisedDataCollator:
 
         batch["labels"] = labels
 
-        if self.use_prefix_lm_mask:
-            batch_size, max_len = batch["input_ids"].shape
-            neg_inf = torch.finfo(self.mask_dtype).min
-            custom_mask = torch.full(
-                (batch_size, 1, max_len, max_len),
-                fill_value=neg_inf,
-                dtype=self.mask_dtype,
-            )
+        if self.document_attention is not None:
+            batch.update(self._document_tensors(features, max_len))
+        elif self.use_prefix_lm_mask:
+            seq_lens = batch["attention_mask"].sum(dim=1)
+            prompt_lens = torch.tensor([int(feat.get("prompt_len", 0)) for feat in features], dtype=torch.long)
+            batch["prefix_lengths"] = torch.minimum(prompt_lens.clamp(min=0), seq_lens)
 
-            for i, feat in enumerate(features):
-                seq_len = int(batch["attention_mask"][i].sum().item())
-                if seq_len <= 0:
-                    continue
+        return batch
 
-                prompt_len = int(feat.get("prompt_len", 0))
-                prompt_len = max(0, min(prompt_len, seq_len))
 
-                if prompt_len > 0:
-                    custom_mask[i, 0, :prompt_len, :prompt_len] = 0
+class TokenBudgetBatchSampler(Sampler):
+    """Length-grouped batches of record indices, each at most `max_tokens` padded tokens.
 
-                for q in range(prompt_len, seq_len):
-                    custom_mask[i, 0, q, : q + 1] = 0
+    Records are shuffled (when `shuffle`), grouped `group_size` at a time, sorted by
+    length within a group and cut greedily so `rows * padded_len <= max_tokens`. Batch
+    order is then shuffled with the largest batch kept first, so an OOM shows up on the
+    first step. A record longer than the budget still gets its own batch. Shuffling is
+    seeded by `seed + epoch`; the Trainer advances the epoch through `set_epoch`.
+    """
 
-            batch["attention_mask"] = custom_mask
+    def __init__(
+        self,
+        lengths: list[int],
+        max_tokens: int,
+        *,
+        shuffle: bool,
+        seed: int = 0,
+        group_size: int = 2048,
+        pad_to_multiple_of: int | None = None,
+    ):
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.group_size = group_size
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.epoch = 0
+        self._batches: list[list[int]] | None = None
+
+    def set_epoch(self, epoch: int) -> None:
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._batches = None
+
+    def _padded(self, length: int) -> int:
+        multiple = self.pad_to_multiple_of or 1
+        return -(-length // multiple) * multiple
+
+    def _build(self) -> list[list[int]]:
+        rng = random.Random(self.seed + self.epoch)
+        order = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(order)
+        batches: list[list[int]] = []
+        for start in range(0, len(order), self.group_size):
+            group = sorted(order[start : start + self.group_size], key=lambda i: self.lengths[i], reverse=True)
+            current: list[int] = []
+            padded_len = 0
+            for index in group:
+                if current and (len(current) + 1) * padded_len > self.max_tokens:
+                    batches.append(current)
+                    current = []
+                if not current:
+                    padded_len = self._padded(self.lengths[index])
+                current.append(index)
+            if current:
+                batches.append(current)
+        if self.shuffle and batches:
+            largest = max(range(len(batches)), key=lambda b: len(batches[b]) * self.lengths[batches[b][0]])
+            first = batches.pop(largest)
+            rng.shuffle(batches)
+            batches.insert(0, first)
+        return batches
+
+    def _epoch_batches(self) -> list[list[int]]:
+        if self._batches is None:
+            self._batches = self._build()
+        return self._batches
+
+    def __iter__(self):
+        yield from self._epoch_batches()
+
+    def __len__(self) -> int:
+        return len(self._epoch_batches())
+
+
+class AblationSFTTrainer(Trainer):
+    """Trainer with token-budget loaders and raw, asynchronously written checkpoints.
+
+    Train/eval loaders use `TokenBudgetBatchSampler` when a budget is set. Mid-run
+    saves go through `checkpoint_writer` instead of save_pretrained, and resuming
+    loads the raw shards back into the allocated model.
+    """
 
-        return batch
+    def __init__(
+        self,
+        *args,
+        max_tokens: int = 0,
+        eval_max_tokens: int = 0,
+        pad_to_multiple_of=None,
+        checkpoint_writer: AsyncCheckpointWriter | None = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.max_tokens = max_tokens
+        self.eval_max_tokens = eval_max_tokens
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.checkpoint_writer = checkpoint_writer
+        if max_tokens > 0 and not self.model_accepts_loss_kwargs:
+            print(
+                "[batch] model forward does not take num_items_in_batch; "
+                "loss is averaged per micro-batch, not per target token"
+            )
+
+    def _token_budget_loader(self, dataset: Dataset, max_tokens: int, *, shuffle: bool) -> DataLoader:
+        sampler = TokenBudgetBatchSampler(
+            [len(ids) for ids in dataset["input_ids"]],
+            max_tokens,
+            shuffle=shuffle,
+            seed=self.args.seed,
+            pad_to_multiple_of=self.pad_to_multiple_of,
+        )
+        loader = DataLoader(
+            dataset,
+            batch_sampler=sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        return self.accelerator.prepare(loader)
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.max_tokens <= 0 or not isinstance(self.train_dataset, Dataset):
+            return super().get_train_dataloader()
+        return self._token_budget_loader(self.train_dataset, self.max_tokens, shuffle=True)
+
+    def get_eval_dataloader(self, eval_dataset=None) -> DataLoader:
+        dataset = self.eval_dataset if eval_dataset is None else eval_dataset
+        if self.eval_max_tokens <= 0 or not isinstance(dataset, Dataset):
+            return super().get_eval_dataloader(eval_dataset)
+        return self._token_budget_loader(dataset, self.eval_max_tokens, shuffle=False)
+
+    def _save_checkpoint(self, model, trial, *args, **kwargs):
+        if self.checkpoint_writer is None:
+            return super()._save_checkpoint(model, trial, *args, **kwargs)
+        # Every process contributes its RNG state; only the main one writes.
+        rng_states = gather_rng_states(self.args)
+        if self.args.should_save:
+            self.checkpoint_writer.save(self, self.model, rng_states=rng_states)
+
+    def _load_from_checkpoint(self, resume_from_checkpoint, model=None):
+        if not (Path(resume_from_checkpoint) / RAW_INDEX_NAME).exists():
+            return super()._load_from_checkpoint(resume_from_checkpoint, model)
+        model = model or self.model
+        missing, unexpected = load_sharded_state_dict_into(model, resume_from_checkpoint)
+        # A missing name is fine only when it shares storage with a loaded one (tied embeddings).
+        tensors = model.state_dict(keep_vars=True)
+        missing_set = set(missing)
+        loaded_ptrs = {t.data_ptr() for name, t in tensors.items() if name not in missing_set}
+        untied = [name for name in missing if tensors[name].data_ptr() not in loaded_ptrs]
+        if untied:
+            raise RuntimeError(
+                f"Checkpoint {resume_from_checkpoint} is missing {len(untied)} weights, e.g. {untied[:5]}"
+            )
+        print(
+            f"[ckpt] loaded weights from {resume_from_checkpoint} "
+            f"(missing={len(missing)} tied, unexpected={len(unexpected)})"
+        )
 
 
 @dataclass
@@ -228,10 +655,18 @@ class KillIfNoLearningCallback(TrainerCallback):
         self.kill_after_steps = kill_after_steps
         self.min_loss_improvement = min_loss_improvement
         self.state = KillState()
+        self.enabled = True
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        # The reference loss is not checkpointed, so a run resumed past the window
+        # would compare against its first post-resume loss and stop almost at once.
+        if state.global_step >= self.kill_after_steps > 0:
+            self.enabled = False
+            print(f"[kill] resumed at step={state.global_step} >= {self.kill_after_steps}; skipping the no-learning check")
 
     def on_log(self, args, state, control, logs=None, **kwargs):
         logs = logs or {}
-        if "loss" not in logs:
+        if not self.enabled or "loss" not in logs:
             return
 
         loss = float(logs["loss"])
@@ -253,6 +688,25 @@ class KillIfNoLearningCallback(TrainerCallback):
                 control.should_training_stop = True
 
 
+class CompileStatsCallback(TrainerCallback):
+    def __init__(self, compiled: CompiledForward):
+        self.compiled = compiled
+        self._last: tuple[int, ...] | None = None
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        stats = self.compiled.stats
+        current = (stats.compiles, stats.recompiles, stats.graph_breaks, stats.eager_frames, stats.eager_buckets)
+        if current == self._last:
+            return
+        self._last = current
+        print(
+            "[compile] "
+            f"step={state.global_step} calls={stats.calls} compiles={stats.compiles} "
+            f"recompiles={stats.recompiles} graph_breaks={stats.graph_breaks} "
+            f"eager_frames={stats.eager_frames} eager_buckets={stats.eager_buckets} buckets={len(stats.buckets)}"
+        )
+
+
 @dataclass
 class EvalPlateauState:
     best_loss: float | None = None
@@ -339,12 +793,9 @@ def _save_final_checkpoint(
         save_error = "".join(traceback.format_exception_only(type(exc), exc)).strip()
         print(f"[warn] trainer.save_model failed; falling back to raw state_dict: {save_error}")
 
-        if hasattr(model, "config") and model.config is not None:
-            model.config.save_pretrained(str(final_dir))
-        if hasattr(model, "generation_config") and model.generation_config is not None:
-            model.generation_config.save_pretrained(str(final_dir))
-
-        torch.save(model.state_dict(), final_dir / "pytorch_model.bin")
+        write_raw_checkpoint(
+            final_dir, model.state_dict(), model=model, tokenizer=None, meta={"base_model_id": base_model_id}
+        )
 
     tokenizer.save_pretrained(str(final_dir))
 
@@ -363,37 +814,6 @@ def _save_final_checkpoint(
     }
 
 
-def _upload_to_hub(
-    *,
-    local_dir: Path,
-    repo_id: str,
-    path_in_repo: str,
-    summary_path: Path | None = None,
-) -> None:
-    try:
-        from huggingface_hub import HfApi
-    except ImportError:
-        print("[warn] huggingface_hub not installed; skipping upload")
-        return
-
-    api = HfApi()
-    print(f"[hf] uploading {local_dir} -> {repo_id}/{path_in_repo}")
-    api.upload_folder(
-        repo_id=repo_id,
-        folder_path=str(local_dir),
-        path_in_repo=path_in_repo,
-        commit_message=f"Checkpoint {path_in_repo}",
-    )
-    if summary_path and summary_path.exists():
-        api.upload_file(
-            repo_id=repo_id,
-            path_or_fileobj=str(summary_path),
-            path_in_repo=f"{path_in_repo}/summary.json",
-            commit_message=f"Training summary for {path_in_repo}",
-        )
-    print(f"[hf] upload complete: https://huggingface.co/{repo_id}/tree/main/{path_in_repo}")
-
-
 def _maybe_clear_quantized_flag(model, *, target_dtype: torch.dtype) -> None:
     if not getattr(model, "is_quantized", False):
         return
@@ -438,7 +858,7 @@ def main() -> None:
     set_seed(args.seed)
     model_dtype = parse_dtype(args.dtype)
 
-    train_ds, eval_ds = _load_splits(args.dataset_id, args.dataset_config, args.seed)
+    train_ds, eval_ds = _load_splits(args.dataset_id, args.dataset_config, args.seed, args.dataset_revision)
 
     if args.train_samples > 0:
         train_ds = train_ds.shuffle(seed=args.seed).select(range(min(args.train_samples, len(train_ds))))
@@ -449,19 +869,45 @@ def main() -> None:
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
 
-    train_ds = train_ds.map(
-        lambda row: _encode_record(row, tokenizer, args.max_seq_len),
-        remove_columns=train_ds.column_names,
-        desc="Tokenizing train split",
+    split_keys = {}
+    for name, ds in (("train", train_ds), ("eval", eval_ds)):
+        split_keys[name] = token_cache_key(
+            ds,
+            tokenizer,
+            dataset_id=args.dataset_id,
+            dataset_config=args.dataset_config,
+            revision=args.dataset_revision,
+            max_seq_len=args.max_seq_len,
+        )
+    tokenize_kwargs = {
+        "max_seq_len": args.max_seq_len,
+        "num_proc": args.tokenize_num_proc,
+        "cache_root": args.token_cache_dir or None,
+    }
+    train_ds = _tokenize_split(
+        train_ds, tokenizer, key=split_keys["train"], desc="Tokenizing train split", **tokenize_kwargs
     )
-    eval_ds = eval_ds.map(
-        lambda row: _encode_record(row, tokenizer, args.max_seq_len),
-        remove_columns=eval_ds.column_names,
-        desc="Tokenizing eval split",
+    eval_ds = _tokenize_split(
+        eval_ds, tokenizer, key=split_keys["eval"], desc="Tokenizing eval split", **tokenize_kwargs
     )
+    train_records, eval_records = len(train_ds), len(eval_ds)
 
-    train_ds = train_ds.filter(lambda row: len(row["input_ids"]) > 0)
-    eval_ds = eval_ds.filter(lambda row: len(row["input_ids"]) > 0)
+    document_attention = None
+    if args.pack_sequences:
+        cache_root = args.token_cache_dir or None
+        train_ds = _pack_records(
+            train_ds, args.max_seq_len, cache_root=cache_root, key=split_keys["train"], desc="Packing train split"
+        )
+        eval_ds = _pack_records(
+            eval_ds, args.max_seq_len, cache_root=cache_root, key=split_keys["eval"], desc="Packing eval split"
+        )
+        print(f"[pack] train {train_records} records -> {len(train_ds)} rows, eval {eval_records} -> {len(eval_ds)}")
+        if args.prefill_bidirectional_train:
+            document_attention = "bidirectional"
+        elif args.prompt_bidir_response_causal_train:
+            document_attention = "prefix_lm"
+        else:
+            document_attention = "causal"
 
     model = None
     load_errors: list[Exception] = []
@@ -495,15 +941,55 @@ def main() -> None:
 
     _maybe_clear_quantized_flag(model, target_dtype=model_dtype)
 
+    if args.torch_compile and args.prefill_bidirectional_train and args.prefill_ablation_impl == "patch":
+        # The forward patch flips module flags inside the graph; the mask hook runs
+        # before the compiled forward and trains the same ablation.
+        print("[compile] using --prefill-ablation-impl mask under --torch-compile")
+        args.prefill_ablation_impl = "mask"
+
+    padded = (
+        args.max_tokens_per_batch > 0
+        or (args.eval_max_tokens_per_batch or 0) > 0
+        or args.per_device_train_batch_size > 1
+        or args.per_device_eval_batch_size > 1
+    )
+    if (
+        args.prefill_bidirectional_train
+        and args.prefill_ablation_impl == "patch"
+        and not prefill_patch_supported(model, padded=padded)
+    ):
+        # Multi-row batches are padded, and with a padding mask (or on eager) the
+        # forward patch leaves attention causal; only the mask ablates them.
+        print(f"[patch] using --prefill-ablation-impl mask (forward patch is a no-op here, padded={padded})")
+        args.prefill_ablation_impl = "mask"
+
     patch = None
-    if args.prefill_bidirectional_train:
-        patch = apply_prefill_bidirectional_patch(model)
+    if document_attention is not None:
+        # Packed rows carry their own per-document mask for every training mode.
+        patch = apply_document_mask(model)
+    elif args.prefill_bidirectional_train:
+        if args.prefill_ablation_impl == "mask":
+            patch = apply_prefill_bidirectional_mask(model)
+        else:
+            patch = apply_prefill_bidirectional_patch(model)
+    elif args.prompt_bidir_response_causal_train:
+        patch = apply_prefix_lm_mask(model)
 
     if args.gradient_checkpointing:
         model.gradient_checkpointing_enable()
         if hasattr(model.config, "use_cache"):
             model.config.use_cache = False
 
+    chunked_loss = None
+    if args.loss_chunk_tokens > 0:
+        chunked_loss = ChunkedCausalLMLoss(model, args.loss_chunk_tokens)
+        print(f"[loss] chunked LM head + cross-entropy over {args.loss_chunk_tokens} target tokens per chunk")
+
+    compiled_forward = None
+    if args.torch_compile:
+        compiled_forward = CompiledForward(model.forward)
+        model.forward = compiled_forward
+
     output_dir = Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
@@ -522,16 +1008,17 @@ def main() -> None:
         "fp16": args.dtype.lower() in {"fp16", "float16"},
         "logging_steps": args.logging_steps,
         "eval_steps": args.eval_steps,
-        "save_steps": args.save_steps,
+        "save_steps": max(args.save_steps, 1),
         "save_total_limit": 2,
         "gradient_checkpointing": args.gradient_checkpointing,
         "report_to": [],
         "remove_unused_columns": False,
     }
-    # Avoid Trainer-managed checkpoint saves for this model family; they can fail in
-    # save_pretrained reverse conversion. We handle final save explicitly below.
+    # Trainer-managed saves go through save_pretrained, which can fail in reverse
+    # conversion for this model family. Mid-run checkpoints are raw and written by
+    # AblationSFTTrainer's checkpoint writer; the final save is handled below.
     if "save_strategy" in inspect.signature(TrainingArguments.__init__).parameters:
-        training_args_kwargs["save_strategy"] = "no"
+        training_args_kwargs["save_strategy"] = "steps" if args.save_steps > 0 else "no"
     # transformers API moved evaluation_strategy -> eval_strategy in newer releases.
     if "evaluation_strategy" in inspect.signature(TrainingArguments.__init__).parameters:
         training_args_kwargs["evaluation_strategy"] = "steps"
@@ -549,17 +1036,35 @@ def main() -> None:
                 min_steps=args.auto_stop_min_steps,
             )
         )
+    if compiled_forward is not None:
+        callbacks.append(CompileStatsCallback(compiled_forward))
+
+    data_collator = SupervisedDataCollator(
+        tokenizer,
+        use_prefix_lm_mask=args.prompt_bidir_response_causal_train,
+        pad_to_multiple_of=args.compile_bucket if args.torch_compile else None,
+        document_attention=document_attention,
+    )
+    profiler = None
+    if args.profile_jsonl:
+        if args.prefill_bidirectional_train:
+            attention_mode = f"prefill_bidirectional_{args.prefill_ablation_impl}"
+        elif args.prompt_bidir_response_causal_train:
+            attention_mode = "prefix_lm"
+        else:
+            attention_mode = "causal"
+        if args.pack_sequences:
+            attention_mode += "+packed"
+        profiler = StepProfilerCallback(args.profile_jsonl, attention_mode=attention_mode)
+        data_collator = profiler.wrap_collator(data_collator)
+        callbacks.append(profiler)
 
     trainer_kwargs = {
         "model": model,
         "args": training_args,
         "train_dataset": train_ds,
         "eval_dataset": eval_ds,
-        "data_collator": SupervisedDataCollator(
-            tokenizer,
-            use_prefix_lm_mask=args.prompt_bidir_response_causal_train,
-            mask_dtype=model_dtype,
-        ),
+        "data_collator": data_collator,
         "callbacks": callbacks,
     }
     trainer_sig = inspect.signature(Trainer.__init__).parameters
@@ -568,11 +1073,68 @@ def main() -> None:
         trainer_kwargs["tokenizer"] = tokenizer
     elif "processing_class" in trainer_sig:
         trainer_kwargs["processing_class"] = tokenizer
+    if chunked_loss is not None:
+        if "compute_loss_func" not in trainer_sig:
+            raise RuntimeError("--loss-chunk-tokens needs a transformers Trainer with compute_loss_func")
+        loss_func = profiler.wrap_loss_func(chunked_loss) if profiler is not None else chunked_loss
+        trainer_kwargs["compute_loss_func"] = loss_func
+
+    eval_max_tokens = args.eval_max_tokens_per_batch
+    if eval_max_tokens is None:
+        eval_max_tokens = args.max_tokens_per_batch
+    run_name = output_dir.name
+    if run_name == "final":
+        run_name = output_dir.parent.name
+    sink_spec = args.artifact_sink or (f"hub:{args.hf_repo_id}" if args.hf_repo_id else None)
+    backend = artifact_backend(sink_spec) if sink_spec else None
+    sink = None
+    if backend is not None:
+        sink = ArtifactSink(backend, manifest_path=output_dir / "artifact_manifest.jsonl")
+        print(f"[sink] uploading artifacts to {sink_spec} under {run_name}/")
+
+    def upload_checkpoint(path: Path) -> None:
+        # Optimizer and RNG state only matter for resuming on this box, and remote
+        # copies are never pruned, so mid-run checkpoints go up as weights plus metadata.
+        sink.submit_dir(path, f"{run_name}/{path.name}", exclude=RESUME_ONLY_FILES)
+
+    checkpoint_writer = None
+    if args.save_steps > 0:
+        checkpoint_writer = AsyncCheckpointWriter(
+            output_dir,
+            base_model_id=args.model_id,
+            tokenizer=tokenizer,
+            keep=training_args.save_total_limit,
+            on_saved=upload_checkpoint if sink is not None else None,
+        )
+    trainer = AblationSFTTrainer(
+        **trainer_kwargs,
+        max_tokens=args.max_tokens_per_batch,
+        eval_max_tokens=eval_max_tokens,
+        pad_to_multiple_of=args.compile_bucket if args.torch_compile else None,
+        checkpoint_writer=checkpoint_writer,
+    )
 
-    trainer = Trainer(**trainer_kwargs)
-
-    train_result = trainer.train()
+    resume_from = None
+    if args.resume == "latest":
+        checkpoints = list_checkpoints(output_dir)
+        if checkpoints:
+            resume_from = str(checkpoints[-1])
+        else:
+            print(f"[ckpt] no checkpoint in {output_dir}; starting from scratch")
+    elif args.resume:
+        resume_from = args.resume
+    if resume_from is not None:
+        print(f"[ckpt] resuming from {resume_from}")
+
+    train_result = trainer.train(resume_from_checkpoint=resume_from)
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
     eval_metrics = trainer.evaluate()
+    if chunked_loss is not None:
+        chunked_loss.remove()
+    if compiled_forward is not None:
+        # Drop the instance override so saving sees the plain module.
+        del model.forward
 
     checkpoint_info = _save_final_checkpoint(
         trainer=trainer,
@@ -586,28 +1148,37 @@ def main() -> None:
         "model_id": args.model_id,
         "dataset_id": args.dataset_id,
         "prefill_bidirectional_train": args.prefill_bidirectional_train,
+        "prefill_ablation_impl": args.prefill_ablation_impl,
         "prompt_bidir_response_causal_train": args.prompt_bidir_response_causal_train,
-        "train_samples": len(train_ds),
-        "eval_samples": len(eval_ds),
+        "train_samples": train_records,
+        "eval_samples": eval_records,
+        "token_cache_keys": split_keys,
+        "pack_sequences": args.pack_sequences,
+        "max_tokens_per_batch": args.max_tokens_per_batch,
+        "loss_chunk_tokens": args.loss_chunk_tokens,
+        "train_rows": len(train_ds),
+        "eval_rows": len(eval_ds),
+        "resumed_from": resume_from,
+        "checkpoints_saved": checkpoint_writer.saved if checkpoint_writer is not None else [],
         "train_metrics": train_result.metrics,
         "eval_metrics": eval_metrics,
         "checkpoint": checkpoint_info,
+        "artifact_sink": sink_spec,
     }
+    if compiled_forward is not None:
+        summary["compile"] = compiled_forward.stats.as_dict()
+    if profiler is not None:
+        summary["profile"] = profiler.summary()
 
     summary_path = output_dir / "summary.json"
     summary_path.write_text(json.dumps(summary, indent=2))
     print(f"[done] wrote training summary to {summary_path}")
 
-    if args.hf_repo_id:
-        run_name = output_dir.name
-        if run_name == "final":
-            run_name = output_dir.parent.name
-        _upload_to_hub(
-            local_dir=output_dir / "final",
-            repo_id=args.hf_repo_id,
-            path_in_repo=run_name,
-            summary_path=summary_path,
-        )
+    if sink is not None:
+        # Checkpoints were uploaded during training; only the final delta is left.
+        sink.submit_dir(output_dir / "final", run_name)
+        sink.submit_file(summary_path, f"{run_name}/summary.json")
+        sink.close()
 
     if patch is not None:
         patch.remove()
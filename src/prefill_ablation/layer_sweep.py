@@ -0,0 +1,187 @@
+"""Layer-subset prefill ablation sweep.
+
+Loads the model once, attaches the per-layer ablation hooks once, and evaluates every
+layer subset on the MCQ tasks by flipping the hooks between runs:
+
+  uv run prefill-layer-sweep \
+    --model-id mistralai/Ministral-3-3B-Instruct-2512 \
+    --layer-subsets "none;all;0-7;last:4" \
+    --output-json artifacts/eval/layer_sweep.json
+
+Subsets are separated by ";" (see `parse_layer_subset` for the syntax). The first
+subset is the reference for the paired deltas. Writes the full JSON summary plus a
+TSV table with one row per (subset, task).
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+from pathlib import Path
+
+from prefill_ablation.attention_ablation import apply_layer_ablation, parse_layer_subset
+from prefill_ablation.eval_mcq import (
+    TASKS,
+    evaluate_task,
+    paired_mode_summary,
+    prepare_task,
+)
+from prefill_ablation.utils import load_model_and_tokenizer, set_seed
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Sweep prefill ablations over subsets of attention layers")
+    parser.add_argument("--model-id", required=True, help="HF model ID or local model path")
+    parser.add_argument(
+        "--tasks",
+        default="hellaswag,piqa,arc_easy,arc_challenge,winogrande",
+        help="Comma-separated task list",
+    )
+    parser.add_argument(
+        "--layer-subsets",
+        default="none;all",
+        help='Semicolon-separated layer subsets, e.g. "none;all;0-7;last:4;0,2,4". The first is the reference',
+    )
+    parser.add_argument("--split", default="validation")
+    parser.add_argument("--limit", type=int, default=500, help="Per-task example limit. <=0 means full split")
+    parser.add_argument("--dtype", default="bfloat16")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--attn-implementation", default="sdpa")
+    parser.add_argument("--trust-remote-code", action="store_true")
+    parser.add_argument("--length-normalize", action="store_true")
+    parser.add_argument("--log-every", type=int, default=0)
+    parser.add_argument("--max-batch-tokens", type=int, default=8192)
+    parser.add_argument(
+        "--prompt-cache",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Use the prompt KV cache for subsets with no ablated layers",
+    )
+    parser.add_argument("--continuation-logits", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--pack-dir", default=None)
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--output-json", default="artifacts/eval/layer_sweep.json")
+    parser.add_argument(
+        "--output-table",
+        default=None,
+        help="TSV results table. Defaults to --output-json with a .tsv suffix",
+    )
+    return parser.parse_args()
+
+
+def _subset_summary(layers: list[int], results: list[dict]) -> dict:
+    tasks = [{k: v for k, v in item.items() if k != "per_example_correct"} for item in results]
+    return {
+        "layers": layers,
+        "tasks": tasks,
+        "macro_accuracy": sum(item["accuracy"] for item in tasks) / max(len(tasks), 1),
+    }
+
+
+def write_results_table(path: Path, subsets: dict[str, list[int]], summary: dict) -> None:
+    deltas = {(item["mode"], item["task"]): item for item in summary["paired"]}
+    with path.open("w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(["subset", "layers", "task", "total", "accuracy", "delta", "delta_low", "delta_high"])
+        for label, layers in subsets.items():
+            for item in summary["subsets"][label]["tasks"]:
+                paired = deltas.get((label, item["task"]))
+                writer.writerow(
+                    [
+                        label,
+                        ",".join(str(x) for x in layers),
+                        item["task"],
+                        item["total"],
+                        f"{item['accuracy']:.4f}",
+                        f"{paired['delta']:.4f}" if paired else "",
+                        f"{paired['delta_interval'][0]:.4f}" if paired else "",
+                        f"{paired['delta_interval'][1]:.4f}" if paired else "",
+                    ]
+                )
+
+
+def main() -> None:
+    args = parse_args()
+    set_seed(args.seed)
+
+    selected_tasks = []
+    for name in [x.strip() for x in args.tasks.split(",") if x.strip()]:
+        if name not in TASKS:
+            raise ValueError(f"Unknown task: {name}. Available: {sorted(TASKS)}")
+        selected_tasks.append(TASKS[name])
+
+    specs = [x.strip() for x in args.layer_subsets.split(";") if x.strip()]
+    if not specs:
+        raise ValueError("--layer-subsets is empty")
+    duplicates = sorted({spec for spec in specs if specs.count(spec) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate layer subsets: {duplicates}")
+
+    model, tokenizer = load_model_and_tokenizer(
+        args.model_id,
+        dtype=args.dtype,
+        attn_implementation=args.attn_implementation,
+        trust_remote_code=args.trust_remote_code,
+        device_map="auto",
+    )
+    model.eval()
+    switch = apply_layer_ablation(model)
+
+    subsets = {spec: parse_layer_subset(spec, switch.num_layers) for spec in specs}
+
+    # Tokenize once; every subset reuses the same requests.
+    task_data = {
+        task.name: prepare_task(
+            tokenizer,
+            task,
+            split=args.split,
+            limit=args.limit,
+            max_batch_tokens=args.max_batch_tokens,
+            pack_root=args.pack_dir,
+        )
+        for task in selected_tasks
+    }
+
+    results_by_subset: dict[str, list[dict]] = {label: [] for label in subsets}
+    for label, layers in subsets.items():
+        switch.set_layers(layers)
+        print(f"[sweep] subset={label} layers={layers}")
+        for task in selected_tasks:
+            metrics = evaluate_task(
+                model,
+                tokenizer,
+                task,
+                split=args.split,
+                limit=args.limit,
+                length_normalize=args.length_normalize,
+                log_every=args.log_every,
+                max_batch_tokens=args.max_batch_tokens,
+                prompt_cache=args.prompt_cache,
+                continuation_logits=args.continuation_logits,
+                data=task_data[task.name],
+                keep_per_example=True,
+            )
+            print(f"[sweep] subset={label} task={task.name} accuracy={metrics['accuracy']:.4f}")
+            results_by_subset[label].append(metrics)
+    switch.remove()
+
+    reference = next(iter(subsets))
+    summary = {
+        "model_id": args.model_id,
+        "num_layers": switch.num_layers,
+        "reference_subset": reference,
+        "subsets": {label: _subset_summary(subsets[label], results_by_subset[label]) for label in subsets},
+        "paired": paired_mode_summary(results_by_subset, reference, confidence=args.confidence),
+    }
+
+    out_path = Path(args.output_json)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    out_path.write_text(json.dumps(summary, indent=2))
+    table_path = Path(args.output_table) if args.output_table else out_path.with_suffix(".tsv")
+    table_path.parent.mkdir(parents=True, exist_ok=True)
+    write_results_table(table_path, subsets, summary)
+    print(f"[done] wrote sweep results to {out_path} and {table_path}")
+
+
+if __name__ == "__main__":
+    main()
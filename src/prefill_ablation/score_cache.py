@@ -0,0 +1,110 @@
+"""Content-addressed cache of per-choice MCQ scores.
+
+Scores are stored under `<root>/<run key>/`, where the run key hashes the model
+weights, tokenizer, attention mode and scoring options. Each entry is keyed by a
+hash of the scored token sequence and prompt boundary, so it stays valid when
+`--limit` changes or tasks are re-ordered.
+
+Every evaluation session appends to its own segment files
+(`<session>-<rank>.jsonl`) and reads only segments from earlier sessions. All
+shard workers of a session therefore see the same cached set, and a preempted
+run loses at most the batch in flight.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+from pathlib import Path
+
+import torch
+
+
+def weights_fingerprint(model, *, chunk_numel: int = 1 << 24) -> str:
+    """Checksum of every state_dict tensor, computed on the tensor's own device.
+
+    Each tensor contributes its name, shape, dtype and two integer sums over its raw
+    bytes (plain and position-weighted), which is cheap on GPU and changes whenever
+    any weight does. It is a change detector, not a cryptographic hash.
+    """
+    digest = hashlib.sha256()
+    with torch.no_grad():
+        for name, tensor in model.state_dict().items():
+            digest.update(f"{name}|{tuple(tensor.shape)}|{tensor.dtype}".encode())
+            if tensor.device.type == "meta" or tensor.numel() == 0:
+                continue
+            flat = tensor.detach().contiguous().view(-1).view(torch.uint8)
+            plain = 0
+            weighted = 0
+            for start in range(0, flat.numel(), chunk_numel):
+                chunk = flat[start : start + chunk_numel].to(torch.int64)
+                index = torch.arange(start, start + chunk.numel(), device=chunk.device) % 65521 + 1
+                plain += int(chunk.sum().item())
+                weighted += int((chunk * index).sum().item())
+            digest.update(f"{plain}:{weighted}".encode())
+    return digest.hexdigest()[:16]
+
+
+def score_cache_key(*, weights: str, tokenizer: str, attention_mode: str, length_normalize: bool) -> str:
+    payload = json.dumps(
+        {
+            "weights": weights,
+            "tokenizer": tokenizer,
+            "attention_mode": attention_mode,
+            "length_normalize": length_normalize,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def request_key(input_ids: list[int], prompt_len: int) -> str:
+    digest = hashlib.sha256(f"{prompt_len}|".encode())
+    digest.update(",".join(str(x) for x in input_ids).encode())
+    return digest.hexdigest()[:20]
+
+
+class ScoreCache:
+    def __init__(self, root: str | Path, key: str, *, session_id: str, rank: int = 0, meta: dict | None = None):
+        self.path = Path(root) / key
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.session_id = session_id
+        self.segment_path = self.path / f"{session_id}-{rank}.jsonl"
+        self._scores: dict[str, float] = {}
+        self._load_previous_sessions()
+
+        meta_path = self.path / "meta.json"
+        if meta and not meta_path.exists():
+            meta_path.write_text(json.dumps(meta, indent=2))
+
+    def _load_previous_sessions(self) -> None:
+        for segment in sorted(self.path.glob("*.jsonl")):
+            if segment.name.startswith(f"{self.session_id}-"):
+                continue
+            for line in segment.read_text().splitlines():
+                try:
+                    entry = json.loads(line)
+                    self._scores[entry["k"]] = float(entry["s"])
+                except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                    # A preempted writer can leave a truncated final line.
+                    continue
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def lookup(self, requests) -> list[float | None]:
+        return [self._scores.get(request_key(r.input_ids, r.prompt_len)) for r in requests]
+
+    def record(self, requests, scores: list[float]) -> None:
+        lines = []
+        for request, score in zip(requests, scores):
+            if score is None:
+                continue
+            # Not added to the in-memory view: lookups only ever see earlier sessions,
+            # which keeps the missing set identical across shard workers.
+            key = request_key(request.input_ids, request.prompt_len)
+            lines.append(json.dumps({"k": key, "s": float(score)}))
+        if not lines:
+            return
+        with self.segment_path.open("a") as f:
+            f.write("\n".join(lines) + "\n")
+            f.flush()
@@ -0,0 +1,231 @@
+"""Per-optimizer-step timing and token accounting for SFT runs.
+
+`StepProfilerCallback` appends one JSONL record per optimizer step:
+
+  data_wait_s   batch fetch outside the collator (dataset indexing, host overhead)
+  collate_s     time inside the data collator
+  forward_s     model forward, summed over micro-batches
+  backward_s    forward end to the last gradient accumulated into the input embeddings
+  optimizer_s   last backward to optimizer.step() done (includes grad clipping)
+  other_s       the rest of the step (scheduler, zero_grad, loss bookkeeping)
+
+plus real (attention_mask), padded and target tokens, tokens/sec, peak CUDA
+memory, GPU name and world size (tokens are per device; rank 0 writes the file).
+A step starts when the previous step's logging/eval/save is done, so evaluation
+time is not charged to training. Timestamps synchronize CUDA, which costs a
+little throughput; collate time is only seen with dataloader workers off.
+"""
+from __future__ import annotations
+
+import json
+import statistics
+import time
+from pathlib import Path
+
+import torch
+from transformers import TrainerCallback
+
+
+def _sync() -> float:
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter()
+
+
+class TimedCollator:
+    def __init__(self, collator, profiler: "StepProfilerCallback"):
+        self.collator = collator
+        self.profiler = profiler
+
+    def __call__(self, features):
+        start = time.perf_counter()
+        try:
+            return self.collator(features)
+        finally:
+            self.profiler.collate_s += time.perf_counter() - start
+
+
+class TimedLossFunc:
+    """Counts target tokens for a Trainer `compute_loss_func`, which gets the labels the forward no longer sees."""
+
+    def __init__(self, loss_func, profiler: "StepProfilerCallback"):
+        self.loss_func = loss_func
+        self.profiler = profiler
+
+    def __call__(self, outputs, labels, num_items_in_batch=None):
+        if torch.is_grad_enabled():
+            self.profiler._count_targets(labels)
+        return self.loss_func(outputs, labels, num_items_in_batch)
+
+
+class StepProfilerCallback(TrainerCallback):
+    def __init__(self, path: str | Path, *, attention_mode: str, warmup_steps: int = 2):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.attention_mode = attention_mode
+        self.warmup_steps = warmup_steps
+        self.records: list[dict] = []
+        self.collate_s = 0.0
+        self._handles = []
+        self._reset(time.perf_counter())
+
+    def wrap_collator(self, collator) -> TimedCollator:
+        return TimedCollator(collator, self)
+
+    def wrap_loss_func(self, loss_func) -> TimedLossFunc:
+        return TimedLossFunc(loss_func, self)
+
+    def _count_targets(self, labels) -> None:
+        if torch.is_tensor(labels):
+            self._tokens["target_tokens"] += int((labels != -100).sum().item())
+
+    def _reset(self, now: float) -> None:
+        self._window_start = now
+        self._first_forward: float | None = None
+        self._forward_start: float | None = None
+        self._forward_end: float | None = None
+        self._backward_end: float | None = None
+        self._last_backward_end: float | None = None
+        self._optimizer_end: float | None = None
+        self.collate_s = 0.0
+        self._totals = {"forward_s": 0.0, "backward_s": 0.0, "micro_batches": 0, "rows": 0}
+        self._tokens = {"real_tokens": 0, "padded_tokens": 0, "target_tokens": 0}
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def _close_backward(self, now: float) -> None:
+        # Without an embedding grad hook, a micro-batch's backward ends at the next event.
+        if self._forward_end is not None:
+            end = self._backward_end or now
+            self._totals["backward_s"] += end - self._forward_end
+            self._last_backward_end = end
+            self._forward_end = None
+            self._backward_end = None
+
+    def _forward_pre_hook(self, module, args, kwargs):
+        if not module.training:
+            return None
+        now = _sync()
+        self._close_backward(now)
+        if self._first_forward is None:
+            self._first_forward = now
+        self._forward_start = now
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        attention_mask = kwargs.get("attention_mask")
+        # Under a custom compute_loss_func the Trainer pops labels; TimedLossFunc counts them.
+        self._count_targets(kwargs.get("labels"))
+        if torch.is_tensor(input_ids):
+            self._totals["rows"] += int(input_ids.shape[0])
+            self._tokens["padded_tokens"] += int(input_ids.numel())
+            if torch.is_tensor(attention_mask) and attention_mask.dim() == 2:
+                self._tokens["real_tokens"] += int(attention_mask.sum().item())
+            else:
+                self._tokens["real_tokens"] += int(input_ids.numel())
+        return None
+
+    def _forward_hook(self, module, args, kwargs, output):
+        if not module.training or self._forward_start is None:
+            return None
+        now = _sync()
+        self._totals["forward_s"] += now - self._forward_start
+        self._totals["micro_batches"] += 1
+        self._forward_start = None
+        self._forward_end = now
+        return None
+
+    def _grad_accumulated(self, param) -> None:
+        if self._forward_end is not None:
+            self._backward_end = _sync()
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        if model is None or self._handles:
+            return
+        # Prepended so batch shapes are read before mask hooks rewrite attention_mask.
+        self._handles.append(model.register_forward_pre_hook(self._forward_pre_hook, with_kwargs=True, prepend=True))
+        self._handles.append(model.register_forward_hook(self._forward_hook, with_kwargs=True))
+        embeddings = model.get_input_embeddings() if hasattr(model, "get_input_embeddings") else None
+        weight = getattr(embeddings, "weight", None)
+        if weight is not None and weight.requires_grad:
+            self._handles.append(weight.register_post_accumulate_grad_hook(self._grad_accumulated))
+        self._reset(_sync())
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self._close_backward(_sync())
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        self._optimizer_end = _sync()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        now = _sync()
+        self._close_backward(now)
+        step_s = now - self._window_start
+        fetch_s = (self._first_forward or now) - self._window_start
+        optimizer_end = self._optimizer_end or now
+        optimizer_s = optimizer_end - (self._last_backward_end or optimizer_end)
+        record = {
+            "step": int(state.global_step),
+            "attention_mode": self.attention_mode,
+            "gpu_name": torch.cuda.get_device_name() if torch.cuda.is_available() else "cpu",
+            "world_size": int(args.world_size),
+            "step_s": step_s,
+            "data_wait_s": max(fetch_s - self.collate_s, 0.0),
+            "collate_s": self.collate_s,
+            "forward_s": self._totals["forward_s"],
+            "backward_s": self._totals["backward_s"],
+            "optimizer_s": optimizer_s,
+            "micro_batches": self._totals["micro_batches"],
+            "rows": self._totals["rows"],
+            **self._tokens,
+        }
+        accounted = sum(record[k] for k in ("data_wait_s", "collate_s", "forward_s", "backward_s", "optimizer_s"))
+        record["other_s"] = max(step_s - accounted, 0.0)
+        record["padding_fraction"] = 1.0 - self._tokens["real_tokens"] / max(self._tokens["padded_tokens"], 1)
+        record["tokens_per_s"] = self._tokens["real_tokens"] / max(step_s, 1e-9)
+        record["padded_tokens_per_s"] = self._tokens["padded_tokens"] / max(step_s, 1e-9)
+        record["peak_allocated_gb"] = (
+            torch.cuda.max_memory_allocated() / 1e9 if torch.cuda.is_available() else None
+        )
+        self.records.append(record)
+        if state.is_world_process_zero:
+            with self.path.open("a") as f:
+                f.write(json.dumps(record) + "\n")
+        self._reset(_sync())
+
+    # Logging, evaluation and saving run after on_step_end; the next step's window
+    # starts once they are done.
+    def on_log(self, args, state, control, **kwargs):
+        self._reset(_sync())
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self._reset(_sync())
+
+    def on_save(self, args, state, control, **kwargs):
+        self._reset(_sync())
+
+    def on_train_end(self, args, state, control, **kwargs):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def summary(self) -> dict:
+        """Medians over steps after `warmup_steps` (compile and allocator warm-up)."""
+        steady = self.records[self.warmup_steps :] or self.records
+        if not steady:
+            return {"attention_mode": self.attention_mode, "steps": 0}
+        keys = (
+            "step_s",
+            "data_wait_s",
+            "collate_s",
+            "forward_s",
+            "backward_s",
+            "optimizer_s",
+            "other_s",
+            "tokens_per_s",
+            "padded_tokens_per_s",
+            "padding_fraction",
+        )
+        out = {"attention_mode": self.attention_mode, "steps": len(steady), "jsonl": str(self.path)}
+        out.update({f"median_{k}": statistics.median(r[k] for r in steady) for k in keys})
+        peaks = [r["peak_allocated_gb"] for r in steady if r["peak_allocated_gb"] is not None]
+        out["max_peak_allocated_gb"] = max(peaks) if peaks else None
+        return out
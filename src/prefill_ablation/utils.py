@@ -7,6 +7,8 @@ from typing import Optional
 
 import numpy as np
 import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
 from transformers import AutoModelForCausalLM, AutoModelForImageTextToText, AutoTokenizer
 
 
@@ -35,6 +37,107 @@ def set_seed(seed: int) -> None:
         torch.cuda.manual_seed_all(seed)
 
 
+def split_lm_head(model):
+    # (decoder, lm_head) when logits are a plain projection of the decoder's final
+    # hidden states, so the head can be applied to a subset of positions.
+    if getattr(getattr(model, "config", None), "final_logit_softcapping", None):
+        return None
+    get_decoder = getattr(model, "get_decoder", None)
+    get_output_embeddings = getattr(model, "get_output_embeddings", None)
+    if get_decoder is None or get_output_embeddings is None:
+        return None
+    decoder = get_decoder()
+    lm_head = get_output_embeddings()
+    if decoder is None or decoder is model or lm_head is None:
+        return None
+    return decoder, lm_head
+
+
+RAW_INDEX_NAME = "raw_state_dict.index.json"
+
+
+def save_sharded_state_dict(state_dict: dict, directory: str | Path, *, max_shard_bytes: int = 2 << 30) -> dict:
+    """Write `state_dict` as safetensors shards plus a `RAW_INDEX_NAME` index.
+
+    Tensors are moved to CPU one shard at a time, so host memory peaks near one shard.
+    Tensors sharing storage (tied embeddings) are written once and recorded as
+    aliases of the first name.
+    """
+    directory = Path(directory)
+    shards: list[list[str]] = [[]]
+    shard_bytes = 0
+    aliases: dict[str, str] = {}
+    seen: dict[tuple, str] = {}
+    for name, tensor in state_dict.items():
+        storage_key = (tensor.device, tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape))
+        if tensor.numel() and storage_key in seen:
+            aliases[name] = seen[storage_key]
+            continue
+        seen[storage_key] = name
+        size = tensor.numel() * tensor.element_size()
+        if shards[-1] and shard_bytes + size > max_shard_bytes:
+            shards.append([])
+            shard_bytes = 0
+        shards[-1].append(name)
+        shard_bytes += size
+
+    weight_map: dict[str, str] = {}
+    for index, names in enumerate(shards, start=1):
+        filename = f"raw-{index:05d}-of-{len(shards):05d}.safetensors"
+        shard = {name: state_dict[name].detach().to("cpu").contiguous() for name in names}
+        save_file(shard, str(directory / filename), metadata={"format": "pt"})
+        del shard
+        weight_map.update({name: filename for name in names})
+
+    index = {"weight_map": weight_map, "aliases": aliases}
+    (directory / RAW_INDEX_NAME).write_text(json.dumps(index, indent=2))
+    return index
+
+
+def load_sharded_state_dict_into(model, directory: str | Path) -> tuple[list[str], list[str]]:
+    """Copy a `save_sharded_state_dict` checkpoint into `model`'s existing tensors.
+
+    Shards are memory-mapped and copied tensor by tensor into the allocated
+    parameters and buffers (casting dtype and moving device as needed), so no second
+    full copy of the weights is built. Returns `(missing, unexpected)` names.
+    """
+    directory = Path(directory)
+    index = json.loads((directory / RAW_INDEX_NAME).read_text())
+    targets = model.state_dict(keep_vars=True)
+    names_by_source: dict[str, list[str]] = {}
+    for name in index["weight_map"]:
+        names_by_source[name] = [name]
+    for name, source in index.get("aliases", {}).items():
+        names_by_source.setdefault(source, [source]).append(name)
+
+    unexpected: list[str] = []
+    loaded: set[str] = set()
+    by_file: dict[str, list[str]] = {}
+    for name, filename in index["weight_map"].items():
+        by_file.setdefault(filename, []).append(name)
+    with torch.no_grad():
+        for filename, names in sorted(by_file.items()):
+            with safe_open(str(directory / filename), framework="pt", device="cpu") as f:
+                for source in names:
+                    tensor = f.get_tensor(source)
+                    for name in names_by_source[source]:
+                        target = targets.get(name)
+                        if target is None:
+                            unexpected.append(name)
+                            continue
+                        if target.device.type == "meta":
+                            raise RuntimeError(f"Cannot load {name} into an offloaded (meta) tensor")
+                        if target.shape != tensor.shape:
+                            raise RuntimeError(
+                                f"Shape mismatch for {name}: checkpoint {tuple(tensor.shape)}, "
+                                f"model {tuple(target.shape)}"
+                            )
+                        target.copy_(tensor)
+                        loaded.add(name)
+    missing = [name for name in targets if name not in loaded]
+    return missing, unexpected
+
+
 def _load_model_only(
     model_name_or_path: str,
     *,
@@ -88,6 +191,16 @@ def _load_checkpoint_meta(model_name_or_path: str) -> dict | None:
         raise RuntimeError(f"Failed to parse checkpoint metadata at {meta_path}: {exc}") from exc
 
 
+def load_tokenizer(model_name_or_path: str, *, trust_remote_code: bool = False):
+    tokenizer = AutoTokenizer.from_pretrained(
+        model_name_or_path,
+        trust_remote_code=trust_remote_code,
+    )
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
 def load_model_and_tokenizer(
     model_name_or_path: str,
     *,
@@ -99,12 +212,7 @@ def load_model_and_tokenizer(
     torch_dtype = parse_dtype(dtype)
     checkpoint_meta = _load_checkpoint_meta(model_name_or_path)
 
-    tokenizer = AutoTokenizer.from_pretrained(
-        model_name_or_path,
-        trust_remote_code=trust_remote_code,
-    )
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer = load_tokenizer(model_name_or_path, trust_remote_code=trust_remote_code)
 
     if checkpoint_meta and checkpoint_meta.get("format") == "raw_state_dict":
         base_model_id = str(checkpoint_meta.get("base_model_id", "")).strip()
@@ -122,12 +230,16 @@ def load_model_and_tokenizer(
             device_map=device_map,
         )
 
-        state_path = Path(model_name_or_path) / "pytorch_model.bin"
-        if not state_path.exists():
-            raise RuntimeError(f"Missing raw checkpoint weights at {state_path}")
-
-        state_dict = torch.load(state_path, map_location="cpu", weights_only=False)
-        missing, unexpected = model.load_state_dict(state_dict, strict=False)
+        checkpoint_dir = Path(model_name_or_path)
+        state_path = checkpoint_dir / "pytorch_model.bin"
+        if (checkpoint_dir / RAW_INDEX_NAME).exists():
+            missing, unexpected = load_sharded_state_dict_into(model, checkpoint_dir)
+        elif state_path.exists():
+            # Checkpoints written before the safetensors fallback.
+            state_dict = torch.load(state_path, map_location="cpu", mmap=True, weights_only=True)
+            missing, unexpected = model.load_state_dict(state_dict, strict=False)
+        else:
+            raise RuntimeError(f"Missing raw checkpoint weights in {checkpoint_dir}")
         print(
             "[model] loaded raw_state_dict checkpoint "
             f"(missing={len(missing)}, unexpected={len(unexpected)})"